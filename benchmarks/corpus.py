@@ -0,0 +1,159 @@
+import datetime
+import random
+from email.mime.application import MIMEApplication
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import format_datetime
+
+from mime_parser import extract_body, payload_from_eml
+
+WORDS = (
+    "project budget review schedule customer release design report team quarter plan contract invoice "
+    "meeting deadline proposal feedback launch update question support account travel hotel flight "
+    "onboarding migration server database dashboard metrics roadmap hiring interview offer renewal"
+).split()
+PROJECTS = ["Phoenix", "Atlas", "Orion", "Nimbus", "Helix", "Quartz", "Vega", "Zephyr"]
+PEOPLE = ["Ann Lee", "Raj Patel", "Maria Garcia", "Tom Becker", "Yuki Tanaka", "Sam Okafor", "Lena Novak"]
+
+# How often each kind of email shows up in the mailbox
+KINDS = {
+    "meeting": 12, "question": 14, "update": 10, "reply": 14, "urgent": 4, "attachment": 8,
+    "forward": 4, "latin1": 3, "newsletter": 20, "notification": 11,
+}
+
+def sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+def paragraphs(rng, count):
+    return "\n\n".join(" ".join(sentence(rng, rng.randint(6, 18)) for _ in range(rng.randint(2, 6)))
+                       for _ in range(count))
+
+def address(name):
+    return f"{name} <{name.lower().replace(' ', '.')}@example.com>"
+
+def build_mime(kind, rng, project, person, earlier=None):
+    """Builds the MIME message of one email of the given kind."""
+    body = paragraphs(rng, rng.choice([1, 1, 2, 3, 5, 12]))
+    if kind == "meeting":
+        text = f"Hi,\n\nCan we meet next week to discuss {project}? Tuesday or Wednesday afternoon would work.\n\n{body}\n\nBest,\n{person}"
+        message = MIMEText(text)
+        subject = f"Meeting about {project}"
+    elif kind in ("question", "urgent"):
+        text = f"Hi,\n\nWhat is the current status of the {project} budget, and who is the contact?\n\n{body}\n\nThanks,\n{person}"
+        html = "<html><body>" + "".join(f"<p>{line}</p>" for line in text.split("\n\n")) + "</body></html>"
+        message = MIMEMultipart("alternative")
+        message.attach(MIMEText(text, "plain"))
+        message.attach(MIMEText(html, "html"))
+        subject = f"{'URGENT: ' if kind == 'urgent' else ''}Question about {project}"
+    elif kind == "update":
+        html = f"<html><body><h1>{project} update</h1>" + "".join(
+            f"<p>{p}</p>" for p in body.split("\n\n")) + f"<p>Regards,<br>{person}</p></body></html>"
+        message = MIMEText(html, "html")
+        subject = f"{project} weekly update"
+    elif kind == "reply":
+        quoted = "\n".join("> " + line for line in earlier["text"].splitlines())
+        text = f"Thanks, that helps.\n\n{sentence(rng)}\n\nOn Mon, 3 Jun 2024 at 10:00, {earlier['from']} wrote:\n{quoted}"
+        message = MIMEText(text)
+        subject = "Re: " + earlier["subject"]
+        message["In-Reply-To"] = earlier["message_id"]
+        message["References"] = earlier["message_id"]
+    elif kind == "attachment":
+        message = MIMEMultipart("mixed")
+        message.attach(MIMEText(f"Hi,\n\nPlease find the {project} report attached.\n\n{body}\n\n-- \n{person}\nSent with care"))
+        attachment = MIMEApplication(rng.randbytes(rng.randint(1, 50) * 1024), "pdf")
+        attachment.add_header("Content-Disposition", "attachment", filename=f"{project.lower()}-report.pdf")
+        message.attach(attachment)
+        subject = f"{project} report"
+    elif kind == "forward":
+        inner = MIMEText(f"{body}\n\n{person}")
+        inner["From"] = address(person)
+        inner["Subject"] = f"{project} contract"
+        message = MIMEMultipart("mixed")
+        message.attach(MIMEText("FYI, see the forwarded message below. Can you take a look?"))
+        message.attach(MIMEMessage(inner))
+        subject = f"Fwd: {project} contract"
+    elif kind == "latin1":
+        message = MIMEText(f"Bonjour,\n\nPourriez-vous confirmer la réunion du projet {project} ? Merci d'avance.\n\n{body}",
+                           "plain", "iso-8859-1")
+        subject = f"Réunion {project}"
+    elif kind == "newsletter":
+        html = f"<html><head><style>p{{color:#333}}</style></head><body><h2>This week in {project}</h2>" + "".join(
+            f"<p>{p}</p>" for p in body.split("\n\n")) + '<a href="https://example.com/unsubscribe">Unsubscribe</a></body></html>'
+        message = MIMEMultipart("alternative")
+        message.attach(MIMEText(body, "plain"))
+        message.attach(MIMEText(html, "html"))
+        message["List-Unsubscribe"] = "<https://example.com/unsubscribe>"
+        message["Precedence"] = "bulk"
+        subject = f"{project} newsletter #{rng.randint(1, 300)}"
+    else:
+        message = MIMEText(f"Your {rng.choice(WORDS)} request #{rng.randint(10000, 99999)} was processed.\n\n{sentence(rng)}")
+        message["Auto-Submitted"] = "auto-generated"
+        subject = f"Notification: {rng.choice(WORDS)} processed"
+    return message, subject
+
+def generate_mailbox(count, seed=0):
+    """
+    Generates count Gmail message resources (format='full') with a realistic mix of MIME
+    structures: plain text, HTML only, multipart/alternative, attachments, forwarded
+    messages, other charsets, bulk mail and replies in existing threads.
+    """
+    rng = random.Random(seed)
+    kinds, weights = zip(*KINDS.items())
+    messages = []
+    conversations = []
+    start = 1_700_000_000_000
+    for index in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "reply" and not conversations:
+            kind = "meeting"
+        project, person = rng.choice(PROJECTS), rng.choice(PEOPLE)
+        earlier = rng.choice(conversations) if kind == "reply" else None
+        mime, subject = build_mime(kind, rng, project, person, earlier)
+        sender = (f"{project} News <news@{project.lower()}.example.com>" if kind == "newsletter" else
+                  "no-reply@notifications.example.com" if kind == "notification" else address(person))
+        internal_date = start + index * 60_000
+        message_id = f"<{seed}.{index}@example.com>"
+        mime["From"] = sender
+        mime["To"] = "me@example.com"
+        mime["Subject"] = subject
+        mime["Message-ID"] = message_id
+        mime["Date"] = format_datetime(datetime.datetime.fromtimestamp(internal_date / 1000).astimezone())
+
+        msg_id = f"{index:016x}"
+        thread_id = earlier["thread_id"] if earlier else msg_id
+        labels = ["INBOX", "UNREAD"]
+        if kind == "newsletter":
+            labels.append("CATEGORY_PROMOTIONS")
+        if kind == "urgent":
+            labels.append("IMPORTANT")
+        payload = payload_from_eml(mime.as_bytes())
+        text = extract_body(payload)
+        messages.append({
+            "id": msg_id,
+            "threadId": thread_id,
+            "labelIds": labels,
+            "snippet": " ".join(text.split())[:150],
+            "historyId": str(1000 + index),
+            "internalDate": str(internal_date),
+            "sizeEstimate": len(mime.as_bytes()),
+            "payload": payload,
+        })
+        if kind in ("meeting", "question", "update"):
+            conversations.append({"thread_id": thread_id, "message_id": message_id, "subject": subject,
+                                  "from": sender, "text": text[:400]})
+    return messages
+
+def generate_notes(count, seed=0):
+    """Generates count knowledge base notes about the projects and people in the mailbox."""
+    rng = random.Random(seed + 1)
+    notes = []
+    for index in range(count):
+        project, person = rng.choice(PROJECTS), rng.choice(PEOPLE)
+        notes.append(
+            f"Project {project}: the contact is {person} ({address(person)}). "
+            f"Budget {rng.randint(10, 900)}k, deadline in week {rng.randint(1, 52)}. {sentence(rng, 20)}"
+            if index % 2 == 0 else
+            f"{person} prefers meetings in the {rng.choice(['morning', 'afternoon'])}. {sentence(rng, 25)}"
+        )
+    return notes
@@ -0,0 +1,322 @@
+import base64
+import datetime
+import json
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from email.parser import BytesParser, Parser
+
+import httplib2
+
+# Labels every mailbox has, by name (their IDs are the same as their names)
+SYSTEM_LABELS = ["INBOX", "SENT", "IMPORTANT", "UNREAD", "SPAM", "CATEGORY_PROMOTIONS", "CATEGORY_SOCIAL"]
+
+# historyTypes of history.list, and the field of a history record each one is listed in
+HISTORY_TYPES = {"messageAdded": "messagesAdded", "labelAdded": "labelsAdded", "labelRemoved": "labelsRemoved"}
+
+class FakeMailbox:
+    """
+    An in-memory Gmail account that answers Gmail and Calendar REST requests.
+
+    Every request is counted by API method, and latency seconds are added to
+    every HTTP round trip (a batch request is one round trip), so batching and
+    caching show up in the numbers the way they would against the real API.
+
+    Messages added with add_message(), sent messages and label changes are
+    recorded in the mailbox history, so history.list (incremental sync after a
+    push notification) sees them like it would in Gmail.
+    """
+
+    def __init__(self, messages, latency=0.0, email_address="me@example.com"):
+        self.messages = {message['id']: message for message in messages}
+        self.order = [message['id'] for message in messages]
+        self.labels = {name: name for name in SYSTEM_LABELS}
+        self.latency = latency
+        self.email_address = email_address
+        self.history_id = 1000 + len(messages)
+        # History records, oldest first; older history IDs are answered with 404 like expired ones
+        self.history = []
+        self.first_history_id = self.history_id
+        self.sent = []
+        self.http_requests = 0
+        self.api_calls = Counter()
+        self._lock = threading.Lock()
+
+    # --- Changes ---
+
+    def add_message(self, message):
+        """Delivers a new message into the mailbox and returns the history ID it was recorded under."""
+        with self._lock:
+            self.messages[message['id']] = message
+            self.order.insert(0, message['id'])
+            self._record("messagesAdded", message)
+            return self.history_id
+
+    def _record(self, kind, message, label_ids=None):
+        self.history_id += 1
+        entry = {"message": {"id": message['id'], "threadId": message['threadId'], "labelIds": list(message['labelIds'])}}
+        if label_ids is not None:
+            entry["labelIds"] = label_ids
+        self.history.append({"id": str(self.history_id), kind: [entry]})
+
+    # --- Requests ---
+
+    def handle(self, method, path, query, body):
+        """Answers one API request. Returns (status, response dict)."""
+        with self._lock:
+            match = re.match(r"^/gmail/v1/users/[^/]+/(.*)$", path)
+            if match:
+                return self._gmail(method, match.group(1), query, json.loads(body) if body else None)
+            if path == "/calendar/v3/freeBusy" and method == "POST":
+                self.api_calls["calendar.freebusy.query"] += 1
+                return 200, self._freebusy(json.loads(body))
+            return 404, {"error": {"code": 404, "message": f"Unknown path {path}"}}
+
+    def _gmail(self, method, rest, query, body):
+        parts = rest.split("/")
+        resource = parts[0]
+        if resource == "profile":
+            self.api_calls["gmail.users.getProfile"] += 1
+            return 200, {"emailAddress": self.email_address, "historyId": str(self.history_id)}
+        if resource == "watch":
+            self.api_calls["gmail.users.watch"] += 1
+            expiration = int((time.time() + 7 * 24 * 3600) * 1000)
+            return 200, {"historyId": str(self.history_id), "expiration": str(expiration)}
+        if resource == "history":
+            self.api_calls["gmail.users.history.list"] += 1
+            return self._history(query)
+        if resource == "labels":
+            if method == "GET":
+                self.api_calls["gmail.users.labels.list"] += 1
+                return 200, {"labels": [{"id": label_id, "name": name} for name, label_id in self.labels.items()]}
+            self.api_calls["gmail.users.labels.create"] += 1
+            if body["name"] in self.labels:
+                return 409, {"error": {"code": 409, "message": "Label name exists or conflicts"}}
+            self.labels[body["name"]] = f"Label_{len(self.labels)}"
+            return 200, {"id": self.labels[body["name"]], "name": body["name"]}
+        if resource == "threads" and len(parts) == 2:
+            self.api_calls["gmail.users.threads.get"] += 1
+            thread = [self._render(message, query) for message in self.messages.values() if message['threadId'] == parts[1]]
+            if not thread:
+                return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+            return 200, {"id": parts[1], "messages": sorted(thread, key=lambda m: int(m['internalDate']))}
+        if resource == "messages":
+            return self._messages(method, parts[1:], query, body)
+        return 404, {"error": {"code": 404, "message": f"Unknown resource {rest}"}}
+
+    def _messages(self, method, parts, query, body):
+        if not parts and method == "GET":
+            self.api_calls["gmail.users.messages.list"] += 1
+            return 200, self._list(query)
+        if parts == ["send"]:
+            self.api_calls["gmail.users.messages.send"] += 1
+            return 200, self._send(body)
+        if parts == ["batchModify"]:
+            self.api_calls["gmail.users.messages.batchModify"] += 1
+            for msg_id in body["ids"]:
+                self._modify(msg_id, body)
+            return 204, {}
+        message = self.messages.get(parts[0])
+        if len(parts) == 2 and parts[1] == "modify":
+            self.api_calls["gmail.users.messages.modify"] += 1
+            if message is None:
+                return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+            return 200, self._modify(parts[0], body)
+        self.api_calls["gmail.users.messages.get"] += 1
+        if message is None:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+        return 200, self._render(message, query)
+
+    def _list(self, query):
+        q = query.get("q", [""])[0]
+        label_ids = query.get("labelIds", [])
+        if q.startswith("rfc822msgid:"):
+            wanted = "<" + q[len("rfc822msgid:"):] + ">"
+            found = [m for m in list(self.messages.values()) + self.sent if header(m, "Message-ID") == wanted]
+            return {"messages": [{"id": m['id'], "threadId": m['threadId']} for m in found[:1]]}
+
+        excluded = [self.labels.get(name, name) for name in re.findall(r"-label:(\S+)", q)]
+        matches = [
+            msg_id for msg_id in self.order
+            if all(label in self.messages[msg_id]['labelIds'] for label in label_ids)
+            and not any(label in self.messages[msg_id]['labelIds'] for label in excluded)
+        ]
+        offset = int(query.get("pageToken", ["0"])[0])
+        page_size = int(query.get("maxResults", ["100"])[0])
+        page = matches[offset:offset + page_size]
+        response = {"messages": [{"id": msg_id, "threadId": self.messages[msg_id]['threadId']} for msg_id in page],
+                    "resultSizeEstimate": len(matches)}
+        if offset + page_size < len(matches):
+            response["nextPageToken"] = str(offset + page_size)
+        return response
+
+    def _history(self, query):
+        start = int(query.get("startHistoryId", ["0"])[0])
+        if start < self.first_history_id:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+        kinds = [HISTORY_TYPES[kind] for kind in query.get("historyTypes", [])] or list(HISTORY_TYPES.values())
+        label_id = query.get("labelId", [None])[0]
+        records = []
+        for record in self.history:
+            if int(record["id"]) <= start:
+                continue
+            changes = {kind: [entry for entry in record.get(kind, [])
+                              if label_id is None or label_id in entry["message"]["labelIds"]]
+                       for kind in kinds}
+            changes = {kind: entries for kind, entries in changes.items() if entries}
+            if changes:
+                records.append(dict(changes, id=record["id"]))
+        offset = int(query.get("pageToken", ["0"])[0])
+        page_size = int(query.get("maxResults", ["100"])[0])
+        response = {"history": records[offset:offset + page_size], "historyId": str(self.history_id)}
+        if offset + page_size < len(records):
+            response["nextPageToken"] = str(offset + page_size)
+        return 200, response
+
+    def _modify(self, msg_id, body):
+        message = self.messages.get(msg_id)
+        if message is None:
+            return {}
+        added = [label for label in body.get("addLabelIds", []) if label not in message['labelIds']]
+        removed = [label for label in body.get("removeLabelIds", []) if label in message['labelIds']]
+        message['labelIds'] = [label for label in message['labelIds'] if label not in removed] + added
+        if added:
+            self._record("labelsAdded", message, added)
+        if removed:
+            self._record("labelsRemoved", message, removed)
+        return {"id": msg_id, "threadId": message['threadId'], "labelIds": message['labelIds']}
+
+    def _send(self, body):
+        raw = base64.urlsafe_b64decode(body["raw"] + "=" * (-len(body["raw"]) % 4))
+        parsed = BytesParser().parsebytes(raw)
+        sent = {
+            "id": f"sent{len(self.sent)}",
+            "threadId": body.get("threadId", f"sent{len(self.sent)}"),
+            "labelIds": ["SENT"],
+            "internalDate": str(int(time.time() * 1000)),
+            "payload": {"mimeType": "text/plain", "headers": [{"name": k, "value": v} for k, v in parsed.items()]},
+        }
+        self.sent.append(sent)
+        self._record("messagesAdded", sent)
+        return {"id": sent['id'], "threadId": sent['threadId'], "labelIds": sent['labelIds']}
+
+    def _render(self, message, query):
+        """A message in the requested format ('full', 'metadata' or 'minimal')."""
+        message_format = query.get("format", ["full"])[0]
+        if message_format == "full":
+            return message
+        rendered = {key: value for key, value in message.items() if key != "payload"}
+        if message_format == "metadata":
+            wanted = {name.lower() for name in query.get("metadataHeaders", [])}
+            rendered["payload"] = {
+                "mimeType": message['payload']['mimeType'],
+                "headers": [h for h in message['payload']['headers'] if not wanted or h['name'].lower() in wanted],
+            }
+        return rendered
+
+    def _freebusy(self, body):
+        # A meeting every weekday at 10:00 and 14:00 UTC, so there is something to schedule around
+        start = datetime.datetime.fromisoformat(body["timeMin"]).replace(minute=0, second=0, microsecond=0)
+        end = datetime.datetime.fromisoformat(body["timeMax"])
+        busy = []
+        day = start.replace(hour=0)
+        while day < end:
+            if day.weekday() < 5:
+                for hour in (10, 14):
+                    slot = day.replace(hour=hour)
+                    busy.append({"start": slot.isoformat(), "end": (slot + datetime.timedelta(hours=1)).isoformat()})
+            day += datetime.timedelta(days=1)
+        return {"calendars": {item["id"]: {"busy": busy} for item in body["items"]}}
+
+    # --- Stats ---
+
+    def stats(self):
+        with self._lock:
+            return {
+                "http_requests": self.http_requests,
+                "api_calls": sum(self.api_calls.values()),
+                "api_calls_by_method": dict(sorted(self.api_calls.items())),
+                "sent": len(self.sent),
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.http_requests = 0
+            self.api_calls.clear()
+
+
+def header(message, name):
+    """Returns a header of a message resource, or ''."""
+    return next((h['value'] for h in message.get('payload', {}).get('headers', [])
+                 if h['name'].lower() == name.lower()), "")
+
+
+class FakeHttp:
+    """An httplib2.Http stand-in that sends every request to a FakeMailbox, batch requests included."""
+
+    def __init__(self, mailbox, credentials):
+        self.mailbox = mailbox
+        self.credentials = credentials
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        with self.mailbox._lock:
+            self.mailbox.http_requests += 1
+        if self.mailbox.latency:
+            time.sleep(self.mailbox.latency)
+        parsed = urllib.parse.urlparse(uri)
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        if parsed.path == "/batch" or parsed.path.startswith("/batch/"):
+            return self._batch(body, headers or {})
+        status, data = self.mailbox.handle(method, parsed.path, urllib.parse.parse_qs(parsed.query), body)
+        return (httplib2.Response({"status": str(status), "content-type": "application/json; charset=UTF-8"}),
+                json.dumps(data).encode("utf-8"))
+
+    def _batch(self, body, headers):
+        content_type = next(value for key, value in headers.items() if key.lower() == "content-type")
+        batch = Parser().parsestr(f"Content-Type: {content_type}\r\n\r\n{body}")
+        boundary = "fake_batch_boundary"
+        parts = []
+        for part in batch.get_payload():
+            request_line, _, rest = part.get_payload().partition("\n")
+            method, target, _ = request_line.split(" ", 2)
+            request_body = re.split(r"\r?\n\r?\n", rest, maxsplit=1)[1] if re.search(r"\r?\n\r?\n", rest) else ""
+            target = urllib.parse.urlparse(target)
+            status, data = self.mailbox.handle(method, target.path, urllib.parse.parse_qs(target.query),
+                                               request_body.strip() or None)
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'].strip('<>')}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status < 300 else 'Error'}\r\n"
+                f"Content-Type: application/json; charset=UTF-8\r\n\r\n{json.dumps(data)}\r\n"
+            )
+        content = "".join(parts) + f"--{boundary}--\r\n"
+        return (httplib2.Response({"status": "200", "content-type": f"multipart/mixed; boundary={boundary}"}),
+                content.encode("utf-8"))
+
+
+class FakeCredentials:
+    """Credentials that authorize HTTP objects against a FakeMailbox instead of Google."""
+
+    access_token = "fake-token"
+    access_token_expired = False
+
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def authorize(self, http):
+        return FakeHttp(self.mailbox, self)
+
+    def apply(self, headers):
+        headers["authorization"] = f"Bearer {self.access_token}"
+
+    def refresh(self, http):
+        pass
+
+
+def build_fake_gmail_service(mailbox):
+    """Builds a real googleapiclient Gmail service whose requests all go to mailbox."""
+    from gmail_service import build_service
+    return build_service("gmail", "v1", FakeCredentials(mailbox))
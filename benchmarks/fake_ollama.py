@@ -0,0 +1,145 @@
+import asyncio
+import json
+import threading
+import time
+import zlib
+from collections import Counter
+
+# (word in the email, intent, priority), checked in order
+INTENT_RULES = [
+    ("unsubscribe", "spam", "low"),
+    ("urgent", "information_request", "high"),
+    ("meet", "meeting_request", "medium"),
+    ("réunion", "meeting_request", "medium"),
+    ("update", "project_update", "low"),
+    ("?", "information_request", "medium"),
+]
+REPLY_WORDS = "thanks for your email I will look into this and get back to you shortly with the details".split()
+
+class FakeOllamaClient:
+    """
+    A deterministic stand-in for ollama.Client.
+
+    Responses depend only on the prompt. Each call takes as long as a model
+    with the given load time, prompt processing rate and generation rate would
+    take (times time_scale, so long runs can be sped up), and reports the same
+    token counts and durations Ollama does.
+    """
+
+    def __init__(self, load_time=0.0, prompt_tokens_per_second=2000.0, tokens_per_second=40.0,
+                 reply_tokens=120, time_scale=1.0, chars_per_token=3.5):
+        self.load_time = load_time
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.time_scale = time_scale
+        self.chars_per_token = chars_per_token
+        self.calls = Counter()
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _plan(self, messages, format, options):
+        """Works out the response text, token counts and durations of a call."""
+        prompt = "".join(message['content'] for message in messages)
+        email = messages[-1]['content'].lower()
+        intent, priority = next(((i, p) for word, i, p in INTENT_RULES if word in email), ("other", "medium"))
+        # The reply length varies a little per email, but the same email always gets the same reply
+        variation = zlib.crc32(email.encode("utf-8")) % 40
+        num_predict = (options or {}).get("num_predict") or self.reply_tokens
+        eval_tokens = min(self.reply_tokens - 20 + variation, num_predict)
+        reply = " ".join(REPLY_WORDS[i % len(REPLY_WORDS)] for i in range(eval_tokens))
+
+        if format is None:
+            kind, content = "reply", reply
+        elif isinstance(format, dict) and "reply" in format.get("properties", {}):
+            kind = "classify_and_reply"
+            content = json.dumps({"intent": intent, "priority": priority, "reply": "" if intent == "spam" else reply})
+        else:
+            kind, eval_tokens = "classify", min(12, num_predict)
+            content = json.dumps({"intent": intent, "priority": priority})
+
+        with self._lock:
+            self.calls[kind] += 1
+            load = 0.0 if self._loaded else self.load_time
+            self._loaded = True
+        prompt_tokens = int(len(prompt) / self.chars_per_token)
+        durations = {
+            "load_duration": load,
+            "prompt_eval_duration": prompt_tokens / self.prompt_tokens_per_second,
+            "eval_duration": eval_tokens / self.tokens_per_second,
+        }
+        return content, prompt_tokens, eval_tokens, durations
+
+    def _response(self, content, prompt_tokens, eval_tokens, durations, done=True):
+        response = {
+            "model": "fake", "done": done, "message": {"role": "assistant", "content": content},
+            "prompt_eval_count": prompt_tokens, "eval_count": eval_tokens,
+            "total_duration": int(sum(durations.values()) * 1e9),
+        }
+        response.update({key: int(value * 1e9) for key, value in durations.items()})
+        return response
+
+    def chat(self, model, messages, format=None, options=None, keep_alive=None, stream=False):
+        if not messages:
+            # An empty chat only loads the model
+            with self._lock:
+                load, self._loaded = (0.0 if self._loaded else self.load_time), True
+            time.sleep(load * self.time_scale)
+            return {"model": "fake", "done": True, "message": {"role": "assistant", "content": ""},
+                    "load_duration": int(load * 1e9)}
+        content, prompt_tokens, eval_tokens, durations = self._plan(messages, format, options)
+        if stream:
+            return self._stream(content, prompt_tokens, eval_tokens, durations)
+        time.sleep(sum(durations.values()) * self.time_scale)
+        return self._response(content, prompt_tokens, eval_tokens, durations)
+
+    def _stream(self, content, prompt_tokens, eval_tokens, durations):
+        time.sleep((durations["load_duration"] + durations["prompt_eval_duration"]) * self.time_scale)
+        words = content.split(" ")
+        for index, word in enumerate(words):
+            time.sleep(self.time_scale / self.tokens_per_second)
+            yield {"done": False, "message": {"role": "assistant", "content": word + (" " if index < len(words) - 1 else "")}}
+        yield self._response("", prompt_tokens, eval_tokens, durations)
+
+
+class FakeAsyncOllamaClient(FakeOllamaClient):
+    """The ollama.AsyncClient version of FakeOllamaClient."""
+
+    async def chat(self, model, messages, format=None, options=None, keep_alive=None, stream=False):
+        if not messages:
+            return {"model": "fake", "done": True, "message": {"role": "assistant", "content": ""}}
+        content, prompt_tokens, eval_tokens, durations = self._plan(messages, format, options)
+        if stream:
+            return self._astream(content, prompt_tokens, eval_tokens, durations)
+        await asyncio.sleep(sum(durations.values()) * self.time_scale)
+        return self._response(content, prompt_tokens, eval_tokens, durations)
+
+    async def _astream(self, content, prompt_tokens, eval_tokens, durations):
+        await asyncio.sleep((durations["load_duration"] + durations["prompt_eval_duration"]) * self.time_scale)
+        words = content.split(" ")
+        for index, word in enumerate(words):
+            await asyncio.sleep(self.time_scale / self.tokens_per_second)
+            yield {"done": False, "message": {"role": "assistant", "content": word + (" " if index < len(words) - 1 else "")}}
+        yield self._response("", prompt_tokens, eval_tokens, durations)
+
+
+class FakeEncoder:
+    """
+    A stand-in for the SentenceTransformer model, for machines without the model downloaded.
+    Words are hashed into a fixed number of dimensions, so texts sharing words are similar.
+    """
+
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, texts, batch_size=64, normalize_embeddings=True, convert_to_numpy=True, **kwargs):
+        import numpy as np
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                vectors[row, zlib.crc32(word.encode("utf-8")) % self.dimension] += 1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
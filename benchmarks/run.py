@@ -0,0 +1,338 @@
+import argparse
+import builtins
+import contextlib
+import datetime
+import functools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+# Runs from any directory; every scenario works in its own temporary folder
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from scheduler import percentile
+
+SCENARIOS = ["process_single_email", "process_email_for_server", "pipeline", "query_rag"]
+RESULTS_DIR = REPO_ROOT / "benchmarks" / "results"
+# With --compare, a scenario whose throughput dropped by more than this fraction is a regression
+REGRESSION_TOLERANCE = 0.10
+# The options that describe a run; they are passed on to every scenario and stored with the results
+SETTINGS = {
+    "messages": (int, 1000, "Number of messages in the generated mailbox"),
+    "notes": (int, 200, "Number of notes in the generated knowledge base"),
+    "queries": (int, 200, "Number of RAG queries in the query_rag scenario"),
+    "seed": (int, 0, "Seed of the generated mailbox and notes"),
+    "gmail_latency": (float, 0.005, "Seconds added to every Gmail HTTP round trip"),
+    "gmail_quota": (float, 0.0, "Gmail quota units per second calls are paced to (0: unpaced, the fake Gmail has no quota)"),
+    "load_time": (float, 5.0, "Seconds the fake Ollama takes to load the model on the first call"),
+    "prefill_rate": (float, 2000.0, "Prompt tokens per second of the fake Ollama"),
+    "token_rate": (float, 40.0, "Generated tokens per second of the fake Ollama"),
+    "time_scale": (float, 0.02, "Factor applied to every fake Ollama delay, so long runs finish quickly"),
+}
+
+
+class StageTimer:
+    """Collects how long every call of each stage took."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def wrap(self, stage, func):
+        """Returns func, timed as stage."""
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.samples[stage].append(time.perf_counter() - started)
+        return timed
+
+    def summary(self):
+        """Returns the count, total and p50/p95/p99 (in seconds) of every stage."""
+        report = {}
+        for stage, values in self.samples.items():
+            values = sorted(values)
+            report[stage] = {
+                "count": len(values),
+                "total": sum(values),
+                "p50": percentile(values, 0.50),
+                "p95": percentile(values, 0.95),
+                "p99": percentile(values, 0.99),
+            }
+        return report
+
+
+def peak_rss_mb():
+    """The peak resident memory of this process in MB, or None where it cannot be read."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def setup(args, timer):
+    """Generates the mailbox and the notes and swaps in the fake Gmail, Ollama and (optionally) embedding model."""
+    from benchmarks.corpus import generate_mailbox, generate_notes
+    from benchmarks.fake_gmail import FakeHttp, FakeMailbox, build_fake_gmail_service
+    from benchmarks.fake_ollama import FakeAsyncOllamaClient, FakeEncoder, FakeOllamaClient
+    from llm_handler import backend
+    import gmail_service
+
+    gmail_service.GMAIL_QUOTA_UNITS_PER_SECOND = args.gmail_quota
+    mailbox = FakeMailbox(generate_mailbox(args.messages, args.seed), latency=args.gmail_latency)
+    FakeHttp.request = timer.wrap("gmail_http", FakeHttp.request)
+    ollama_settings = dict(load_time=args.load_time, prompt_tokens_per_second=args.prefill_rate,
+                           tokens_per_second=args.token_rate, time_scale=args.time_scale)
+    backend._client = FakeOllamaClient(**ollama_settings)
+    backend._async_client = FakeAsyncOllamaClient(**ollama_settings)
+
+    if args.fake_embeddings:
+        from embedding_service import get_embedding_service
+        get_embedding_service()._model = FakeEncoder()
+    if args.notes:
+        from rag_service import get_collection
+        notes = generate_notes(args.notes, args.seed)
+        for start in range(0, len(notes), 500):
+            get_collection().add(ids=[f"note{i}" for i in range(start, start + len(notes[start:start + 500]))],
+                                 documents=notes[start:start + 500])
+    return mailbox, build_fake_gmail_service(mailbox)
+
+
+# --- Scenarios ---
+# Each one processes ids and returns (emails handled, emails failed, extra results)
+
+def run_process_single_email(service, mailbox, ids, timer, args):
+    """The command-line assistant's per-email path, with every reply confirmed."""
+    import main
+    main.parse_email = timer.wrap("parse", main.parse_email)
+    main.analyze_email = timer.wrap("analyze", main.analyze_email)
+    main.confirm_and_send = timer.wrap("deliver", main.confirm_and_send)
+    main.apply_label_to_email = timer.wrap("label", main.apply_label_to_email)
+    process = timer.wrap("total", main.process_single_email)
+    failed = 0
+    for msg_id in ids:
+        try:
+            process(service, {'id': msg_id})
+        except Exception:
+            failed += 1
+    return len(ids) - failed, failed, {}
+
+def run_process_email_for_server(service, mailbox, ids, timer, args):
+    """The server's per-email path, which sends replies without confirmation."""
+    import server
+    server.parse_email = timer.wrap("parse", server.parse_email)
+    server.analyze_email = timer.wrap("analyze", server.analyze_email)
+    server.send_reply_for_server = timer.wrap("deliver", server.send_reply_for_server)
+    server.apply_label_to_email = timer.wrap("label", server.apply_label_to_email)
+    process = timer.wrap("total", server.process_email_for_server)
+    failed = 0
+    for msg_id in ids:
+        try:
+            process(service, {'id': msg_id})
+        except Exception:
+            failed += 1
+    return len(ids) - failed, failed, {}
+
+def run_pipeline(service, mailbox, ids, timer, args):
+    """The staged pipeline main_loop uses, with the work queue, thread store and priorities."""
+    import main
+    from calendar_service import get_calendar_availability
+    from pipeline import EmailPipeline
+    from scheduler import get_latency_stats
+    from thread_store import get_thread_store
+    from triage import estimate_priority
+    from work_queue import get_work_queue
+
+    analyze = functools.partial(main.analyze_email, defer_reply=main.STREAM_REPLIES,
+                                calendar=get_calendar_availability(service))
+    pipeline = EmailPipeline(
+        service, timer.wrap("parse", main.parse_email), timer.wrap("analyze", analyze),
+        timer.wrap("deliver", main.confirm_and_send), prepare=timer.wrap("prepare", main.prefetch_notes),
+        work_queue=get_work_queue(), prioritize=estimate_priority, thread_store=get_thread_store()
+    )
+    pipeline.run(ids)
+    return len(pipeline.processed_ids), len(pipeline.failed_ids), {"latency_by_priority": get_latency_stats()}
+
+def run_query_rag(service, mailbox, ids, timer, args):
+    """RAG lookups for the first emails of the mailbox, one at a time and then in batches like the pipeline's."""
+    import rag_service
+    from main import parse_email, rag_query_text
+    texts = [rag_query_text(parse_email(mailbox.messages[msg_id])) for msg_id in ids[:args.queries]]
+    query = timer.wrap("query_rag", rag_service.query_rag)
+    for text in texts:
+        query(text)
+    # Start the batched pass with an empty query cache, so it embeds every query too
+    rag_service._query_cache.clear()
+    retrieve = timer.wrap("retrieve_notes_batch", rag_service.retrieve_notes)
+    for start in range(0, len(texts), 50):
+        retrieve(texts[start:start + 50])
+    return len(texts), 0, {}
+
+SCENARIO_FUNCTIONS = {
+    "process_single_email": run_process_single_email,
+    "process_email_for_server": run_process_email_for_server,
+    "pipeline": run_pipeline,
+    "query_rag": run_query_rag,
+}
+
+
+def run_scenario(args):
+    """Runs one scenario in this process and writes its results to args.result_file."""
+    from benchmarks.fake_gmail import FakeHttp  # noqa: F401 (patched in setup)
+    from llm_handler import backend
+    from sync_service import list_unprocessed_message_ids
+
+    workdir = tempfile.mkdtemp(prefix="mail-benchmark-")
+    # Every state file (work queue, caches, knowledge base) is created in the temporary folder
+    os.chdir(workdir)
+    # The command-line assistant asks before sending every reply
+    builtins.input = lambda prompt="": "yes"
+    timer = StageTimer()
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            mailbox, service = setup(args, timer)
+            ids = list_unprocessed_message_ids(service)
+            mailbox.reset_stats()
+            timer.samples.clear()
+            started = time.perf_counter()
+            processed, failed, extra = SCENARIO_FUNCTIONS[args.child](service, mailbox, ids, timer, args)
+            elapsed = time.perf_counter() - started
+    finally:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    calls = backend._client.calls + backend._async_client.calls
+    result = {
+        "emails": processed,
+        "failed": failed,
+        "wall_seconds": elapsed,
+        "emails_per_minute": processed / elapsed * 60 if elapsed else 0.0,
+        "stages": timer.summary(),
+        "gmail": mailbox.stats(),
+        "ollama": {"calls": dict(calls), "metrics": backend.get_metrics()},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    result.update(extra)
+    with open(args.result_file, "w") as f:
+        json.dump(result, f)
+
+
+def print_result(scenario, result):
+    if "error" in result:
+        print(f"  {scenario}: {result['error']}")
+        return
+    gmail = result["gmail"]
+    rss = f"{result['peak_rss_mb']:.0f} MB" if result["peak_rss_mb"] else "n/a"
+    print(f"  {result['emails']} handled, {result['failed']} failed in {result['wall_seconds']:.1f}s "
+          f"({result['emails_per_minute']:.0f}/min); {gmail['api_calls']} Gmail API call(s) in "
+          f"{gmail['http_requests']} HTTP request(s); peak RSS {rss}")
+    for stage, stats in result["stages"].items():
+        print(f"    {stage:<22} n={stats['count']:<6} p50 {stats['p50'] * 1000:8.1f}ms  "
+              f"p95 {stats['p95'] * 1000:8.1f}ms  p99 {stats['p99'] * 1000:8.1f}ms")
+
+def compare(baseline, report, tolerance=REGRESSION_TOLERANCE):
+    """Prints how a report differs from a baseline report. Returns the scenarios that regressed."""
+    regressions = []
+    print(f"\nCompared with {baseline.get('created_at', 'the baseline')}:")
+    if baseline.get("settings") != report["settings"]:
+        print("  (the runs used different settings, so the numbers may not be comparable)")
+    for scenario, result in report["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(scenario)
+        if not old or "error" in old or "error" in result or not old["emails_per_minute"]:
+            continue
+        change = result["emails_per_minute"] / old["emails_per_minute"] - 1
+        calls = result["gmail"]["api_calls"] - old["gmail"]["api_calls"]
+        rss = (result["peak_rss_mb"] or 0) - (old["peak_rss_mb"] or 0)
+        regressed = change < -tolerance
+        print(f"  {scenario}: throughput {change:+.1%}, Gmail API calls {calls:+d}, peak RSS {rss:+.0f} MB"
+              f"{'  <-- REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(scenario)
+    return regressions
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the assistant against a fake Gmail and a fake Ollama.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Comma-separated scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    for name, (kind, default, help_text) in SETTINGS.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=kind, default=default, help=f"{help_text} (default {default})")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="Use a hashing stand-in instead of the SentenceTransformer model")
+    parser.add_argument("--output", help="Where to write the JSON results (default: benchmarks/results/<time>.json)")
+    parser.add_argument("--compare", help="A previous results file to compare with; exits with 1 on a regression")
+    # Used internally to run one scenario per process, so each gets its own peak RSS
+    parser.add_argument("--child", choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.child:
+        run_scenario(args)
+        return 0
+
+    settings = {name: getattr(args, name) for name in SETTINGS}
+    settings["fake_embeddings"] = args.fake_embeddings
+    passed_on = [f"--{name.replace('_', '-')}={getattr(args, name)}" for name in SETTINGS]
+    if args.fake_embeddings:
+        passed_on.append("--fake-embeddings")
+
+    results = {}
+    for scenario in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+        if scenario not in SCENARIOS:
+            print(f"Unknown scenario {scenario}, skipping it.")
+            continue
+        print(f"Running {scenario} on {args.messages} message(s)...")
+        handle, result_file = tempfile.mkstemp(suffix=".json")
+        os.close(handle)
+        try:
+            completed = subprocess.run([sys.executable, "-m", "benchmarks.run", "--child", scenario,
+                                        "--result-file", result_file] + passed_on, cwd=REPO_ROOT)
+            if completed.returncode == 0:
+                with open(result_file) as f:
+                    results[scenario] = json.load(f)
+            else:
+                results[scenario] = {"error": f"the scenario exited with status {completed.returncode}"}
+        finally:
+            os.remove(result_file)
+        print_result(scenario, results[scenario])
+
+    report = {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "settings": settings,
+        "scenarios": results,
+    }
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{datetime.datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), report):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
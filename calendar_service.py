@@ -1,53 +1,188 @@
+import bisect
 import datetime
-from googleapiclient.discovery import build
+import os
+import threading
+import time
+import weakref
 # Import the authenticator from your gmail_service script
-from gmail_service import get_gmail_service
+from gmail_service import build_service, get_gmail_service
+from metrics import configure_logging, get_logger
 
-def check_calendar_availability(service, date_to_check):
-    """Checks for busy time slots on a given date."""
-    try:
-        # Build the calendar service object using the existing credentials
-        calendar_service = build('calendar', 'v3', credentials=service.credentials)
+logger = get_logger(__name__)
 
-        # Set the time range for the entire day
-        time_min = date_to_check.isoformat() + "T00:00:00Z" # Start of day in UTC
-        time_max = date_to_check.isoformat() + "T23:59:59Z" # End of day in UTC
+# How many days ahead free/busy is fetched, in a single request
+CALENDAR_WINDOW_DAYS = int(os.environ.get("CALENDAR_WINDOW_DAYS", "14"))
+# How long fetched free/busy stays valid before it is fetched again
+CALENDAR_CACHE_TTL = int(os.environ.get("CALENDAR_CACHE_TTL", "300"))
+# Slots are only offered on weekdays between these hours (local time)
+WORKDAY_START_HOUR = int(os.environ.get("WORKDAY_START_HOUR", "9"))
+WORKDAY_END_HOUR = int(os.environ.get("WORKDAY_END_HOUR", "17"))
+MEETING_DURATION = datetime.timedelta(minutes=30)
+# Offered slots start on the hour or half hour
+SLOT_STEP = datetime.timedelta(minutes=30)
+
+class CalendarAvailability:
+    """
+    Keeps the free/busy times of a calendar in memory.
+
+    The busy intervals of the next window_days are fetched in one freebusy
+    request and merged into a sorted index, so is_free() and next_free_slots()
+    are answered without an API call. The index is fetched again once it is
+    older than ttl seconds.
+    """
+
+    def __init__(self, service, calendar_id='primary', window_days=CALENDAR_WINDOW_DAYS, ttl=CALENDAR_CACHE_TTL):
+        # The calendar client gets its own HTTP connection, so it can be used next to the Gmail service
+        self.calendar_service = build_service('calendar', 'v3', service._http.credentials)
+        self.calendar_id = calendar_id
+        self.window_days = window_days
+        self.ttl = ttl
+        self.requests = 0
+        self._starts = []
+        self._ends = []
+        self._window_end = None
+        self._fetched_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """Fetches free/busy again if the index is older than the TTL (or always, with force)."""
+        with self._lock:
+            if not force and self._fetched_at is not None and time.monotonic() - self._fetched_at < self.ttl:
+                return
+            now = datetime.datetime.now(datetime.timezone.utc)
+            window_end = now + datetime.timedelta(days=self.window_days)
+            freebusy_query = {
+                "timeMin": now.isoformat(),
+                "timeMax": window_end.isoformat(),
+                "items": [{"id": self.calendar_id}]
+            }
+            self.requests += 1
+            results = self.calendar_service.freebusy().query(body=freebusy_query).execute()
+            busy = sorted(
+                (datetime.datetime.fromisoformat(slot['start']), datetime.datetime.fromisoformat(slot['end']))
+                for slot in results['calendars'][self.calendar_id].get('busy', [])
+            )
+            # Merge overlapping events, so every point in time is in at most one interval
+            starts, ends = [], []
+            for start, end in busy:
+                if ends and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self._starts, self._ends = starts, ends
+            self._window_end = window_end
+            self._fetched_at = time.monotonic()
+
+    def _overlaps_busy(self, start, end):
+        # Only the last interval starting before `end` can overlap [start, end)
+        index = bisect.bisect_left(self._starts, end) - 1
+        return index >= 0 and self._ends[index] > start
 
-        print(f"Checking for busy slots on {date_to_check.strftime('%Y-%m-%d')}...")
+    def is_free(self, start, duration=MEETING_DURATION):
+        """
+        Tells whether the calendar is free from start (an aware datetime) for duration.
+        Returns None if that time is beyond the fetched window.
+        """
+        self.refresh()
+        end = start + duration
+        if end > self._window_end:
+            return None
+        return not self._overlaps_busy(start, end)
 
-        freebusy_query = {
-            "timeMin": time_min,
-            "timeMax": time_max,
-            "timeZone": "UTC",
-            "items": [{"id": "primary"}] # 'primary' refers to your main calendar
-        }
+    def busy_between(self, start, end):
+        """Returns the (start, end) busy intervals overlapping [start, end)."""
+        self.refresh()
+        index = bisect.bisect_right(self._ends, start)
+        intervals = []
+        while index < len(self._starts) and self._starts[index] < end:
+            intervals.append((self._starts[index], self._ends[index]))
+            index += 1
+        return intervals
 
-        results = calendar_service.freebusy().query(body=freebusy_query).execute()
+    def next_free_slots(self, count=3, duration=MEETING_DURATION, after=None):
+        """Returns the start times of the next count free slots in working hours, in local time."""
+        self.refresh()
+        candidate = (after or datetime.datetime.now()).astimezone()
+        # Round up to the next slot boundary
+        candidate = candidate.replace(second=0, microsecond=0)
+        step_minutes = int(SLOT_STEP.total_seconds() // 60)
+        if candidate.minute % step_minutes:
+            candidate += datetime.timedelta(minutes=step_minutes - candidate.minute % step_minutes)
+
+        slots = []
+        while len(slots) < count and candidate + duration <= self._window_end:
+            day_start = candidate.replace(hour=WORKDAY_START_HOUR, minute=0)
+            day_end = candidate.replace(hour=WORKDAY_END_HOUR, minute=0)
+            if candidate.weekday() >= 5 or candidate + duration > day_end:
+                # Jump to the start of the next day's working hours
+                candidate = day_start + datetime.timedelta(days=1)
+                continue
+            if candidate < day_start:
+                candidate = day_start
+                continue
+            if self._overlaps_busy(candidate, candidate + duration):
+                candidate += SLOT_STEP
+                continue
+            slots.append(candidate)
+            candidate += duration
+        return slots
+
+    def describe_free_slots(self, count=5, duration=MEETING_DURATION):
+        """Describes the next free slots in a sentence the LLM can use in a reply."""
+        slots = self.next_free_slots(count, duration)
+        if not slots:
+            return f"My calendar has no free {int(duration.total_seconds() // 60)}-minute slot in working hours in the next {self.window_days} days."
+        times = "; ".join(slot.strftime('%A %d %B at %I:%M %p') for slot in slots)
+        return f"My next free {int(duration.total_seconds() // 60)}-minute slots are: {times} ({slots[0].strftime('%Z')})."
+
+_availabilities = weakref.WeakKeyDictionary()
+_availabilities_lock = threading.Lock()
+
+def get_calendar_availability(service):
+    """Returns the shared CalendarAvailability for the account of the given Gmail service."""
+    with _availabilities_lock:
+        if service not in _availabilities:
+            _availabilities[service] = CalendarAvailability(service)
+        return _availabilities[service]
+
+def check_calendar_availability(service, date_to_check):
+    """Checks for busy time slots on a given date."""
+    try:
+        # Set the time range for the entire day
+        time_min = datetime.datetime.combine(date_to_check, datetime.time.min, datetime.timezone.utc) # Start of day in UTC
+        time_max = time_min + datetime.timedelta(days=1) # End of day in UTC
 
-        # The 'calendars' object contains the busy intervals
-        busy_slots = results['calendars']['primary']['busy']
+        # Answered from the cached free/busy index; only fetched again when it is out of date
+        busy_slots = [
+            {'start': start.isoformat(), 'end': end.isoformat()}
+            for start, end in get_calendar_availability(service).busy_between(time_min, time_max)
+        ]
 
-        if not busy_slots:
-            print("-> Calendar is completely free.")
-        else:
-            print("-> Found busy slots:")
-            for slot in busy_slots:
-                start = datetime.datetime.fromisoformat(slot['start']).strftime('%I:%M %p')
-                end = datetime.datetime.fromisoformat(slot['end']).strftime('%I:%M %p')
-                print(f"  - Busy from {start} to {end}")
+        logger.info("Checked busy slots", extra={
+            "date": date_to_check.strftime('%Y-%m-%d'),
+            "busy": ", ".join(
+                f"{datetime.datetime.fromisoformat(slot['start']).strftime('%I:%M %p')}-"
+                f"{datetime.datetime.fromisoformat(slot['end']).strftime('%I:%M %p')}"
+                for slot in busy_slots
+            ) or "none",
+        })
 
         return busy_slots
 
     except Exception as e:
-        print(f"An error occurred with the Calendar API: {e}")
+        logger.error("Calendar API error", extra={"error": str(e)})
         return None
 
 
 if __name__ == "__main__":
+    configure_logging()
     # 1. Get the authenticated service object (will trigger browser auth if token.json is gone)
     google_service_creds = get_gmail_service()
 
     if google_service_creds:
         # 2. Check availability for tomorrow
         tomorrow = datetime.date.today() + datetime.timedelta(days=1)
-        check_calendar_availability(google_service_creds, tomorrow)
\ No newline at end of file
+        check_calendar_availability(google_service_creds, tomorrow)
+        # 3. Suggest meeting times, answered from the same cached free/busy data
+        print(get_calendar_availability(google_service_creds).describe_free_slots())
@@ -1,36 +1,42 @@
-import chromadb
+import sys
+import time
 from pathlib import Path
-
-client = chromadb.PersistentClient(path="my_knowledge_base")
-collection = client.get_or_create_collection(name="personal_knowledge")
-
-try:
-    # Get the directory where the script is located
-    script_dir = Path(__file__).parent
-    # Create a full, absolute path to my_notes.txt
-    file_path = script_dir / 'my_notes.txt'
-
-    # This new print statement will show you the EXACT path it's trying to use.
-    print(f"Attempting to read knowledge base file from: {file_path}")
-
-    with open(file_path, 'r') as f:
-        # Read all lines from the file
-        documents = [line.strip() for line in f.readlines() if line.strip()]
-
-except FileNotFoundError:
-    print(f"ERROR: File not found at {file_path}")
-    print("Please make sure 'my_notes.txt' is in the same folder as your 'create_knowledge_base.py' script.")
-    documents = [] # Ensure documents is an empty list on error
-
-# This print statement will now have the correct count
-print(f"Adding {len(documents)} documents to the collection...")
-
-# This will now throw the ValueError if the file was truly not found
-# and the documents list is empty.
-collection.add(
-    documents=documents,
-    ids=[f"doc_{i}" for i in range(len(documents))]
-)
-
-print("\nKnowledge base created successfully.")
-print(f"Total documents in collection: {collection.count()}")
\ No newline at end of file
+from knowledge_ingest import sync_knowledge_base
+from rag_service import collection_name, get_collection, manifest_path
+from tenants import DEFAULT_ACCOUNT, TENANT_STATE_DIR
+
+# `python create_knowledge_base.py <account>` indexes the notes of one account (see tenants.py)
+account = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] != DEFAULT_ACCOUNT else None
+
+# Get the directory where the script is located
+script_dir = Path(__file__).parent
+if account is None:
+    # Index my_notes.txt and everything in the notes/ folder (.txt, .md, .html and .eml files)
+    sources = [script_dir / 'my_notes.txt', script_dir / 'notes']
+else:
+    # An account's notes live next to its other state, in accounts/<account>/notes
+    sources = [script_dir / TENANT_STATE_DIR / account / 'notes']
+
+# This print statement will show you the EXACT paths it's trying to use.
+print(f"Indexing knowledge base files into '{collection_name(account)}' from:")
+for source in sources:
+    print(f"  - {source}{'' if source.exists() else ' (not found, skipped)'}")
+
+if not any(source.exists() for source in sources):
+    print("ERROR: No notes found.")
+    if account is None:
+        print("Please make sure 'my_notes.txt' or a 'notes' folder is in the same folder as your 'create_knowledge_base.py' script.")
+    else:
+        print(f"Please put the notes of account '{account}' in the '{sources[0]}' folder.")
+    # Syncing no sources would remove every note from the knowledge base
+    sys.exit(1)
+
+collection = get_collection(account)
+started = time.perf_counter()
+# Only new or changed notes are embedded; notes that were edited or deleted are removed
+result = sync_knowledge_base(collection, sources, manifest_file=manifest_path(account))
+
+print(f"\nRead {result['files_read']} changed file(s): added {result['added']} chunk(s), "
+      f"removed {result['removed']}, kept {result['kept']} unchanged.")
+print(f"Knowledge base updated successfully in {time.perf_counter() - started:.1f}s.")
+print(f"Total documents in collection: {collection.count()}")
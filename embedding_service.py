@@ -0,0 +1,221 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from chromadb import Documents, EmbeddingFunction, Embeddings
+
+from metrics import inc
+
+# The same model Chroma uses by default, so vectors already in the database stay comparable
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+# How many texts are encoded per forward pass
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "64"))
+# Beyond this many new texts, encoding is spread over one process per CPU core
+MULTI_PROCESS_THRESHOLD = 2000
+# Vectors are cached on disk by text hash, one folder per model
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "embedding_cache")
+
+def text_hash(text):
+    """The cache key of a text."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """
+    Stores embedding vectors in a memory-mapped file of float32 rows, one row per text,
+    with an SQLite index from text hash to row.
+
+    Several processes (e.g. the server and create_knowledge_base.py) can share a cache:
+    rows are handed out inside an SQLite write transaction, a vector is written before
+    its index entry is committed, and the file only ever grows in place, so a process
+    never overwrites another's rows or loses its mapping of them.
+    """
+
+    def __init__(self, cache_dir, dimension, initial_rows=1024):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.dimension = dimension
+        self.initial_rows = initial_rows
+        self.vectors_file = os.path.join(cache_dir, "vectors.f32")
+        self._lock = threading.Lock()
+        # Transactions are begun by hand, so adding takes the write lock before it picks rows
+        self._conn = sqlite3.connect(os.path.join(cache_dir, "index.sqlite3"), timeout=60,
+                                     isolation_level=None, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS vectors (hash TEXT PRIMARY KEY, row INTEGER NOT NULL UNIQUE)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        with self._write_transaction():
+            stored = self._conn.execute("SELECT value FROM settings WHERE name = 'dimension'").fetchone()
+            if stored is None or stored[0] != dimension:
+                # New, or written by a model with a different dimension: start over
+                self._conn.execute("DELETE FROM vectors")
+                self._conn.execute("INSERT OR REPLACE INTO settings (name, value) VALUES ('dimension', ?)", (dimension,))
+                with open(self.vectors_file, "wb"):
+                    pass
+        self.vectors = None
+        self._map()
+
+    @contextmanager
+    def _write_transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _map(self):
+        """Maps the whole vectors file, which may have been grown by another process."""
+        capacity = os.path.getsize(self.vectors_file) // (4 * self.dimension)
+        self.vectors = np.memmap(self.vectors_file, dtype=np.float32, mode="r+",
+                                 shape=(capacity, self.dimension)) if capacity else None
+
+    def _capacity(self):
+        return 0 if self.vectors is None else self.vectors.shape[0]
+
+    def get_many(self, hashes):
+        """Returns {hash: vector} for the hashes that are cached."""
+        with self._lock:
+            rows = {}
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                rows.update(self._conn.execute(
+                    f"SELECT hash, row FROM vectors WHERE hash IN ({','.join('?' * len(batch))})", batch
+                ).fetchall())
+            if rows and max(rows.values()) >= self._capacity():
+                self._map()
+            return {h: np.array(self.vectors[row]) for h, row in rows.items()}
+
+    def add_many(self, hashes, vectors):
+        """Stores the vectors of the given hashes."""
+        with self._lock, self._write_transaction():
+            new = {}
+            for h, vector in zip(hashes, vectors):
+                new.setdefault(h, vector)
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                for (h,) in self._conn.execute(
+                    f"SELECT hash FROM vectors WHERE hash IN ({','.join('?' * len(batch))})", batch
+                ):
+                    new.pop(h, None)
+            if not new:
+                return
+            next_row = self._conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM vectors").fetchone()[0]
+            needed = next_row + len(new)
+            if needed > self._capacity():
+                self._grow(needed)
+            for row, vector in enumerate(new.values(), start=next_row):
+                self.vectors[row] = vector
+            # The vectors are on disk before any process can find them in the index
+            self.vectors.flush()
+            self._conn.executemany("INSERT INTO vectors (hash, row) VALUES (?, ?)",
+                                   [(h, row) for row, h in enumerate(new, start=next_row)])
+
+    def _grow(self, needed):
+        # Extended in place, never replaced, so the mappings other processes hold stay valid
+        size = os.path.getsize(self.vectors_file) // (4 * self.dimension)
+        capacity = max(needed, size * 2, self.initial_rows)
+        if capacity > size:
+            with open(self.vectors_file, "r+b") as f:
+                f.truncate(capacity * 4 * self.dimension)
+        self._map()
+
+class EmbeddingService:
+    """
+    Turns texts into embedding vectors with one SentenceTransformer model,
+    loaded once per process. Texts seen before are served from the on-disk cache.
+    """
+
+    def __init__(self, model_name=EMBEDDING_MODEL, batch_size=EMBEDDING_BATCH_SIZE, cache_dir=EMBEDDING_CACHE_DIR):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache_dir = os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name))
+        self._model = None
+        self._cache = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                # Imported here because loading torch takes a few seconds
+                from sentence_transformers import SentenceTransformer
+                self._model = SentenceTransformer(self.model_name)
+            return self._model
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            # Outside the lock, since loading the model takes it
+            dimension = self.model.get_sentence_embedding_dimension()
+            with self._lock:
+                if self._cache is None:
+                    self._cache = EmbeddingCache(self.cache_dir, dimension)
+        return self._cache
+
+    def encode(self, texts, use_cache=True):
+        """
+        Returns a (len(texts), dimension) float32 array of normalized embeddings.
+        With use_cache=False the on-disk cache is neither read nor written (e.g. for one-off query texts).
+        """
+        texts = list(texts)
+        hashes = [text_hash(text) for text in texts]
+        cached = self.cache.get_many(hashes) if use_cache else {}
+
+        # Encode every text that is not cached yet, once
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in cached and h not in missing:
+                missing[h] = text
+        if use_cache:
+            inc("cache_lookups_total", len(texts) - len(missing), cache="embedding", result="hit")
+            inc("cache_lookups_total", len(missing), cache="embedding", result="miss")
+        if missing:
+            new_vectors = self._encode_uncached(list(missing.values()))
+            if use_cache:
+                self.cache.add_many(list(missing), new_vectors)
+            cached.update(zip(missing, new_vectors))
+
+        if not texts:
+            return np.zeros((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        return np.stack([cached[h] for h in hashes]).astype(np.float32)
+
+    def _encode_uncached(self, texts):
+        # Large jobs (e.g. indexing a whole notes folder) use every CPU core
+        if len(texts) >= MULTI_PROCESS_THRESHOLD and (os.cpu_count() or 1) > 1:
+            pool = self.model.start_multi_process_pool()
+            try:
+                return self.model.encode_multi_process(
+                    texts, pool, batch_size=self.batch_size, normalize_embeddings=True
+                )
+            finally:
+                self.model.stop_multi_process_pool(pool)
+        return self.model.encode(
+            texts, batch_size=self.batch_size, normalize_embeddings=True, convert_to_numpy=True
+        )
+
+class ServiceEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Lets Chroma embed documents and queries with an EmbeddingService."""
+
+    def __init__(self, service):
+        self.service = service
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return list(self.service.encode(input))
+
+_service = None
+_service_lock = threading.Lock()
+
+def get_embedding_service():
+    """Returns the EmbeddingService shared by the whole process."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = EmbeddingService()
+        return _service
+
+def get_embedding_function():
+    """The Chroma embedding function every collection should use, for ingestion and queries alike."""
+    return ServiceEmbeddingFunction(get_embedding_service())
@@ -0,0 +1,42 @@
+import json
+import os
+import sys
+import urllib.parse
+import urllib.request
+
+from sync_service import build_push_notification, load_sync_state
+from tenants import get_tenant_registry
+
+# Posts a Gmail push notification to a locally running server, the way Pub/Sub would,
+# so push mode can be tried without a Google Cloud project:
+#   python fake_push.py [account] [history_id]
+# The notification is for the email address of one of the configured accounts (see tenants.py),
+# the first one if none is named; the server ignores notifications for addresses it does not know.
+# Without a history ID, one past the account's saved sync state is used, so the server picks it up.
+SERVER_URL = os.environ.get("SERVER_URL", "http://127.0.0.1:8000")
+
+if __name__ == "__main__":
+    registry = get_tenant_registry()
+    try:
+        tenant = registry.get(sys.argv[1] if len(sys.argv) > 1 else None)
+    except KeyError as e:
+        print(f"ERROR: {e.args[0]}. Accounts: {', '.join(t.name for t in registry.tenants())}")
+        sys.exit(1)
+    email_address = tenant.get_email_address()
+    if len(sys.argv) > 2:
+        history_id = int(sys.argv[2])
+    else:
+        history_id = int(load_sync_state(tenant.sync_state_file).get("history_id") or 0) + 1
+
+    url = f"{SERVER_URL}/gmail/push"
+    if os.environ.get("GMAIL_PUSH_TOKEN"):
+        url += "?" + urllib.parse.urlencode({"token": os.environ["GMAIL_PUSH_TOKEN"]})
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(build_push_notification(email_address, history_id)).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(request) as response:
+        print(f"Posted a notification for {email_address} ({tenant.name}), history ID {history_id}: "
+              f"HTTP {response.status}")
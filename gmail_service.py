@@ -1,11 +1,17 @@
 import os.path
 import base64
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+import functools
+import random
+import threading
+import time
+import weakref
+from collections import Counter
 from googleapiclient.errors import HttpError
 
+from metrics import configure_logging, get_logger, inc, observe, stage
+
+logger = get_logger(__name__)
+
 # If modifying these scopes, delete the file token.json.
 # In gmail_service.py
 SCOPES = [
@@ -13,60 +19,524 @@ SCOPES = [
     "https://www.googleapis.com/auth/calendar.readonly"
 ]
 
-def get_gmail_service():
-    """Shows basic usage of the Gmail API.
-    Logs in the user and returns the Gmail API service object.
+@functools.lru_cache(maxsize=None)
+def get_discovery_document(api, version):
+    """Returns the discovery document of a Google API, read once from the copy bundled with googleapiclient."""
+    from googleapiclient.discovery_cache import get_static_doc
+    return get_static_doc(api, version)
+
+# --- Quota and retries ---
+# Gmail allows 15,000 quota units per minute per user (250 per second); calls are paced to stay
+# under it. 0 turns the pacing off.
+GMAIL_QUOTA_UNITS_PER_SECOND = float(os.environ.get("GMAIL_QUOTA_UNITS_PER_SECOND", "250"))
+# Gmail averages the limit over a minute, so up to this many unused units can be saved up for a burst
+GMAIL_QUOTA_BURST = float(os.environ.get("GMAIL_QUOTA_BURST", "2500"))
+# How many times a call that was rate limited or hit a server error is tried again
+GMAIL_MAX_RETRIES = int(os.environ.get("GMAIL_MAX_RETRIES", "5"))
+# Retries wait a random time of up to 1, 2, 4, ... seconds, but never more than GMAIL_BACKOFF_MAX
+GMAIL_BACKOFF_BASE = 1.0
+GMAIL_BACKOFF_MAX = float(os.environ.get("GMAIL_BACKOFF_MAX", "32"))
+
+# Quota units of each Gmail method (https://developers.google.com/gmail/api/reference/quota)
+QUOTA_UNITS = {
+    "gmail.users.getProfile": 1,
+    "gmail.users.watch": 100,
+    "gmail.users.history.list": 2,
+    "gmail.users.labels.list": 1,
+    "gmail.users.labels.get": 1,
+    "gmail.users.labels.create": 5,
+    "gmail.users.messages.list": 5,
+    "gmail.users.messages.get": 5,
+    "gmail.users.messages.modify": 5,
+    "gmail.users.messages.batchModify": 50,
+    "gmail.users.messages.send": 100,
+    "gmail.users.threads.get": 10,
+    "gmail.users.drafts.create": 10,
+}
+# Gmail methods missing from the table; other APIs (Calendar) have quotas of their own and are not paced
+DEFAULT_QUOTA_UNITS = 5
+
+# Methods that may have done their work even if the response was a server error, so only
+# a rate limit (where Gmail did nothing) is retried; send_email_once handles the rest
+NON_IDEMPOTENT_METHODS = {"gmail.users.messages.send", "gmail.users.drafts.create"}
+
+def quota_units(method):
+    """The Gmail quota units one call of an API method costs (0 outside Gmail)."""
+    if not method.startswith("gmail."):
+        return 0
+    return QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS)
+
+class QuotaBucket:
+    """
+    A token bucket of Gmail quota units for one user: calls wait until the bucket has
+    their units, so bursts go out at the highest rate Gmail accepts instead of failing.
+
+    When Gmail rate limits anyway (other clients share the quota), throttle() halves the
+    rate, which then climbs back to the full rate over a minute.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.max_rate = GMAIL_QUOTA_UNITS_PER_SECOND if rate is None else rate
+        self.rate = self.max_rate
+        self.burst = GMAIL_QUOTA_BURST if burst is None else burst
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 60 * elapsed)
+        self.tokens = min(self.burst, self.tokens + self.rate * elapsed)
+
+    def acquire(self, units):
+        """Takes units from the bucket, waiting until there are enough. Returns the seconds waited."""
+        if units <= 0 or self.max_rate <= 0:
+            return 0.0
+        waited = 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            # A call bigger than the bucket only waits for a full bucket and leaves it in debt
+            missing = min(units, self.burst) - self.tokens
+            if missing > 0:
+                waited = missing / self.rate
+                # Sleeping under the lock keeps the waiting calls in order
+                time.sleep(waited)
+                self._refill(time.monotonic())
+            self.tokens -= units
+        if waited:
+            inc("gmail_quota_wait_seconds_total", waited)
+        return waited
+
+    def throttle(self):
+        """Halves the rate after Gmail reported a rate limit, and empties the bucket."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+# One bucket per user, i.e. per credentials object; every service built from the same credentials shares it
+_quota_buckets = weakref.WeakKeyDictionary()
+_quota_buckets_lock = threading.Lock()
+_default_quota_bucket = None
+
+def get_quota_bucket(http):
+    """Returns the QuotaBucket of the user an authorized http object belongs to."""
+    global _default_quota_bucket
+    credentials = getattr(http, "credentials", None)
+    with _quota_buckets_lock:
+        if credentials is None:
+            if _default_quota_bucket is None:
+                _default_quota_bucket = QuotaBucket()
+            return _default_quota_bucket
+        if credentials not in _quota_buckets:
+            _quota_buckets[credentials] = QuotaBucket()
+        return _quota_buckets[credentials]
+
+def is_rate_limit_error(error):
+    """Tells whether an HttpError means Gmail wants fewer calls (429, or 403 rateLimitExceeded)."""
+    status = error.resp.status
+    if status == 429:
+        return True
+    return status == 403 and b"ratelimitexceeded" in (error.content or b"").lower()
+
+def is_retryable_error(error, method=""):
+    """Tells whether a failed call is worth trying again: rate limits, and server errors for idempotent calls."""
+    if is_rate_limit_error(error):
+        return True
+    return error.resp.status >= 500 and method not in NON_IDEMPOTENT_METHODS
+
+def backoff_delay(attempt, error=None):
+    """How long to wait before retry number attempt + 1: exponential with full jitter, or Retry-After if longer."""
+    delay = random.uniform(0, min(GMAIL_BACKOFF_MAX, GMAIL_BACKOFF_BASE * 2 ** attempt))
+    retry_after = error.resp.get("retry-after") if error is not None else None
+    if retry_after and str(retry_after).isdigit():
+        delay = max(delay, min(GMAIL_BACKOFF_MAX, int(retry_after)))
+    return delay
+
+# --- Connections ---
+# httplib2 connections are not thread-safe, so every thread gets its own authorized http
+# per user, and keeps its connection to Google alive across calls
+_http_pool = threading.local()
+
+def _authorized_http(credentials):
+    from googleapiclient.http import build_http
+    if hasattr(credentials, "authorize"):
+        # oauth2client-style credentials (and the benchmark's fake ones)
+        return credentials.authorize(build_http())
+    import google_auth_httplib2
+    return google_auth_httplib2.AuthorizedHttp(credentials, http=build_http())
+
+def pooled_http(http):
+    """Returns this thread's http object for the user of http (a service's authorized http)."""
+    credentials = getattr(http, "credentials", None)
+    if credentials is None:
+        return http
+    connections = getattr(_http_pool, "connections", None)
+    if connections is None:
+        connections = _http_pool.connections = weakref.WeakKeyDictionary()
+    if credentials not in connections:
+        connections[credentials] = _authorized_http(credentials)
+    return connections[credentials]
+
+@functools.lru_cache(maxsize=None)
+def instrumented_request_class():
     """
+    An HttpRequest that paces calls to the user's Gmail quota, retries rate limits and
+    server errors with backoff, runs on this thread's pooled connection, and counts and
+    times every call in the metrics, by API method.
+    """
+    from googleapiclient.http import HttpRequest
+
+    class InstrumentedHttpRequest(HttpRequest):
+        def execute(self, http=None, num_retries=0):
+            method = self.methodId or "unknown"
+            if http is None:
+                http = pooled_http(self.http)
+            bucket = get_quota_bucket(self.http)
+            units = quota_units(method)
+            for attempt in range(GMAIL_MAX_RETRIES + 1):
+                bucket.acquire(units)
+                inc("gmail_api_calls_total", method=method)
+                inc("gmail_http_requests_total")
+                if units:
+                    inc("gmail_quota_units_total", units, method=method)
+                started = time.perf_counter()
+                try:
+                    return super().execute(http=http, num_retries=num_retries)
+                except HttpError as error:
+                    inc("gmail_api_errors_total", method=method, status=error.resp.status)
+                    if attempt == GMAIL_MAX_RETRIES or not is_retryable_error(error, method):
+                        raise
+                    if is_rate_limit_error(error):
+                        bucket.throttle()
+                    delay = backoff_delay(attempt, error)
+                    inc("gmail_api_retries_total", method=method, status=error.resp.status)
+                    logger.warning("Gmail call failed, retrying", extra={"method": method, "status": error.resp.status,
+                                                                         "attempt": attempt + 1, "delay": round(delay, 2)})
+                    time.sleep(delay)
+                finally:
+                    observe("gmail_api_seconds", time.perf_counter() - started, method=method)
+
+    return InstrumentedHttpRequest
+
+def build_service(api, version, credentials):
+    """
+    Builds a Google API service object from the bundled discovery document, so
+    no discovery request goes over the network and the file is only read once.
+    Every call made through it is counted in the metrics.
+    """
+    # googleapiclient is imported on first use; it is slow to import and most entry points need it only later
+    from googleapiclient.discovery import build, build_from_document
+    document = get_discovery_document(api, version)
+    if document is None:
+        return build(api, version, credentials=credentials, static_discovery=True,
+                     requestBuilder=instrumented_request_class())
+    return build_from_document(document, credentials=credentials, requestBuilder=instrumented_request_class())
+
+def save_credentials(creds, token_file):
+    with open(token_file, "w") as token:
+        token.write(creds.to_json())
+
+def load_credentials(token_file="token.json", interactive=True):
+    """
+    Loads the credentials saved in token_file, refreshing them if they expired.
+    Without valid credentials the user is asked to log in in the browser, or with
+    interactive=False a RuntimeError is raised.
+    """
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
     creds = None
-    # The file token.json stores the user's access and refresh tokens, and is
+    # The token file stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+    if os.path.exists(token_file):
+        creds = Credentials.from_authorized_user_file(token_file, SCOPES)
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
-        else:
+        elif interactive:
             flow = InstalledAppFlow.from_client_secrets_file(
                 "credentials.json", SCOPES
             )
             creds = flow.run_local_server(port=0)
+        else:
+            raise RuntimeError(f"No valid credentials in {token_file}")
         # Save the credentials for the next run
-        with open("token.json", "w") as token:
-            token.write(creds.to_json())
+        save_credentials(creds, token_file)
+    return creds
+
+def refresh_credentials(creds, token_file):
+    """
+    Refreshes credentials that have expired (or are about to) and saves the new token,
+    so the refresh happens before a request instead of in the middle of one.
+    """
+    if getattr(creds, 'valid', True) or not getattr(creds, 'refresh_token', None):
+        return
+    from google.auth.transport.requests import Request
+    creds.refresh(Request())
+    save_credentials(creds, token_file)
 
+def get_gmail_service(token_file="token.json"):
+    """Shows basic usage of the Gmail API.
+    Logs in the user and returns the Gmail API service object.
+    """
+    creds = load_credentials(token_file)
     try:
-        service = build("gmail", "v1", credentials=creds)
+        service = build_service("gmail", "v1", creds)
         return service
     except HttpError as error:
-        print(f"An error occurred: {error}")
+        logger.error("Could not build the Gmail service", extra={"error": str(error)})
         return None
+
+def clone_gmail_service(service):
+    """Builds a second Gmail service object using the same credentials.
+
+    Calls made through it already run on the calling thread's pooled connection
+    and share the user's quota bucket; the clone keeps its own caches (labels).
+    """
+    return build_service("gmail", "v1", service._http.credentials)
+
 # Add this entire function to gmail_service.py
 
+class LabelRegistry:
+    """Resolves Gmail label names to IDs for one service.
+
+    The labels are listed once and kept in memory. Missing labels are created
+    on first use, and the cache is dropped whenever Gmail reports that a label
+    ID no longer exists.
+    """
+
+    def __init__(self, service, user_id='me'):
+        self.service = service
+        self.user_id = user_id
+        self._label_ids = None
+        self._lock = threading.Lock()
+
+    def get_label_id(self, label_name, create=True):
+        """Returns the ID of the label, creating the label if needed and allowed."""
+        with self._lock:
+            if self._label_ids is None:
+                self._load()
+            label_id = self._label_ids.get(label_name)
+            if label_id is None and create:
+                label_id = self._create(label_name)
+            return label_id
+
+    def invalidate(self):
+        """Forgets all cached label IDs so the next lookup lists them again."""
+        with self._lock:
+            self._label_ids = None
+
+    def _load(self):
+        results = self.service.users().labels().list(userId=self.user_id).execute()
+        self._label_ids = {label['name']: label['id'] for label in results.get('labels', [])}
+
+    def _create(self, label_name):
+        body = {'name': label_name, 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'}
+        try:
+            label = self.service.users().labels().create(userId=self.user_id, body=body).execute()
+        except HttpError as error:
+            if error.resp.status != 409:
+                raise
+            # Someone else created it in the meantime, so just list the labels again
+            self._load()
+            return self._label_ids.get(label_name)
+        logger.info("Created missing label", extra={"label": label_name})
+        self._label_ids[label_name] = label['id']
+        return label['id']
+
+# One registry per service object, shared by everything that uses that service
+_label_registries = weakref.WeakKeyDictionary()
+_label_registries_lock = threading.Lock()
+
+def get_label_registry(service, user_id='me'):
+    """Returns the shared LabelRegistry for the given service."""
+    with _label_registries_lock:
+        registries = _label_registries.setdefault(service, {})
+        if user_id not in registries:
+            registries[user_id] = LabelRegistry(service, user_id)
+        return registries[user_id]
+
+def get_label_id(service, user_id, label_name, create=True):
+    """Looks up the ID of a label by its name, creating the label if it does not exist."""
+    return get_label_registry(service, user_id).get_label_id(label_name, create=create)
+
+def _is_stale_label_error(error):
+    """Tells whether an HttpError means a cached label ID is no longer valid."""
+    if error.resp.status == 404:
+        return True
+    return error.resp.status == 400 and 'label' in str(error).lower()
+
+def _modify_with_label(service, user_id, label_name, modify):
+    """Calls modify(label_id), re-resolving the label once if its cached ID went stale."""
+    registry = get_label_registry(service, user_id)
+    try:
+        return modify(registry.get_label_id(label_name))
+    except HttpError as error:
+        if not _is_stale_label_error(error):
+            raise
+        logger.info("Cached label ID is stale, refreshing labels", extra={"label": label_name})
+        registry.invalidate()
+        return modify(registry.get_label_id(label_name))
+
+@stage("label")
 def apply_label_to_email(service, user_id, msg_id, label_name):
     """Applies a label to a specific email."""
     try:
-        # First, get the list of all labels to find the ID of our target label
-        results = service.users().labels().list(userId=user_id).execute()
-        labels = results.get('labels', [])
-        label_id = None
-        for label in labels:
-            if label['name'] == label_name:
-                label_id = label['id']
-                break
-
-        if not label_id:
-            print(f"Label '{label_name}' not found. Please create it in Gmail.")
-            return
+        def modify(label_id):
+            body = {'addLabelIds': [label_id], 'removeLabelIds': []}
+            service.users().messages().modify(userId=user_id, id=msg_id, body=body).execute()
 
-        # Apply the label to the message
-        body = {'addLabelIds': [label_id], 'removeLabelIds': []}
-        service.users().messages().modify(userId=user_id, id=msg_id, body=body).execute()
-        print(f"Successfully applied label '{label_name}' to message ID {msg_id}")
+        # The label ID comes from the shared registry, so labels are only listed once
+        _modify_with_label(service, user_id, label_name, modify)
+        logger.info("Applied label", extra={"label": label_name, "msg_id": msg_id})
 
     except HttpError as error:
-        print(f'An error occurred while applying label: {error}')
+        logger.error("Could not apply label", extra={"label": label_name, "msg_id": msg_id, "error": str(error)})
+
+# Gmail accepts up to 100 calls in one batch, but recommends 50 to stay clear of rate limits.
+BATCH_GET_CHUNK_SIZE = 50
+# messages().batchModify accepts at most 1000 message IDs per call.
+BATCH_MODIFY_CHUNK_SIZE = 1000
+
+def _batch_get(service, make_request, ids, chunk_size, max_retries, kind):
+    """
+    Runs make_request(id) for every ID in Gmail batch requests, paced to the user's quota.
+    The calls that were rate limited or hit a server error are tried again after a backoff.
+    """
+    results = {}
+    errors = {}
+    methods = {}
+    # IDs whose failure is not worth retrying (e.g. a message that was deleted)
+    given_up = set()
+    bucket = get_quota_bucket(service._http)
+    http = pooled_http(service._http)
+
+    def handle_response(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+            status = exception.resp.status if isinstance(exception, HttpError) else "error"
+            inc("gmail_api_errors_total", method=methods[request_id], status=status)
+            if isinstance(exception, HttpError) and not is_retryable_error(exception, methods[request_id]):
+                given_up.add(request_id)
+        else:
+            results[request_id] = response
+
+    # Batch request IDs must be unique, so drop duplicates but keep the order
+    pending = list(dict.fromkeys(ids))
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            rate_limited = [error for error in errors.values() if isinstance(error, HttpError) and is_rate_limit_error(error)]
+            if rate_limited:
+                bucket.throttle()
+            for item_id in pending:
+                error = errors.get(item_id)
+                status = error.resp.status if isinstance(error, HttpError) else "error"
+                inc("gmail_api_retries_total", method=methods.get(item_id, "unknown"), status=status)
+            time.sleep(backoff_delay(attempt - 1, rate_limited[0] if rate_limited else None))
+        errors.clear()
+
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start + chunk_size]
+            batch = service.new_batch_http_request(callback=handle_response)
+            units = 0
+            for item_id in chunk:
+                request = make_request(item_id)
+                methods[item_id] = request.methodId or "unknown"
+                units += quota_units(methods[item_id])
+                inc("gmail_api_calls_total", method=methods[item_id])
+                batch.add(request, request_id=item_id)
+            # Every call in a batch counts against the quota, so a batch waits for all of its units
+            bucket.acquire(units)
+            inc("gmail_http_requests_total")
+            for method, count in Counter(methods[item_id] for item_id in chunk).items():
+                if quota_units(method):
+                    inc("gmail_quota_units_total", quota_units(method) * count, method=method)
+            try:
+                batch.execute(http=http)
+            except HttpError as error:
+                # The whole batch failed, so none of its items were fetched
+                inc("gmail_api_errors_total", method="batch", status=error.resp.status)
+                for item_id in chunk:
+                    if item_id not in results:
+                        errors[item_id] = error
+                        if not is_retryable_error(error):
+                            given_up.add(item_id)
+
+        pending = [item_id for item_id in pending if item_id not in results and item_id not in given_up]
+        if not pending:
+            break
+
+    failed_ids = [item_id for item_id in dict.fromkeys(ids) if item_id not in results]
+    for item_id in failed_ids:
+        logger.error(f"Could not fetch {kind}", extra={"id": item_id, "error": str(errors.get(item_id))})
+    return results, failed_ids
+
+def batch_get_messages(service, user_id, msg_ids, msg_format='full',
+                       chunk_size=BATCH_GET_CHUNK_SIZE, max_retries=GMAIL_MAX_RETRIES):
+    """Fetches many messages at once using Gmail batch HTTP requests.
+
+    Args:
+      service: Authorized Gmail API service instance.
+      user_id: User's email address. The special value 'me' can be used.
+      msg_ids: IDs of the messages to fetch.
+      msg_format: The format to fetch the messages in ('full', 'metadata', ...).
+      chunk_size: How many gets to send in a single batch request.
+      max_retries: How many more times to try the messages that were rate limited or hit a server error.
+
+    Returns:
+      A tuple (messages, failed_ids). messages maps each fetched message ID to
+      its message resource, failed_ids lists the IDs that could not be fetched.
+    """
+    with stage("get"):
+        return _batch_get(
+            service,
+            lambda msg_id: service.users().messages().get(userId=user_id, id=msg_id, format=msg_format),
+            msg_ids, chunk_size, max_retries, "message"
+        )
+
+def batch_get_threads(service, user_id, thread_ids, metadata_headers=('From', 'Subject', 'Message-ID'),
+                      chunk_size=BATCH_GET_CHUNK_SIZE, max_retries=GMAIL_MAX_RETRIES):
+    """Fetches many threads at once, in format='metadata' (headers and snippets, no bodies).
+
+    Returns:
+      A tuple (threads, failed_ids) like batch_get_messages.
+    """
+    return _batch_get(
+        service,
+        lambda thread_id: service.users().threads().get(
+            userId=user_id, id=thread_id, format='metadata', metadataHeaders=list(metadata_headers)
+        ),
+        thread_ids, chunk_size, max_retries, "thread"
+    )
+
+@stage("label")
+def batch_apply_label(service, user_id, msg_ids, label_name, chunk_size=BATCH_MODIFY_CHUNK_SIZE):
+    """Applies a label to many emails using messages().batchModify.
+
+    Returns:
+      The list of message IDs the label could not be applied to.
+    """
+    msg_ids = list(dict.fromkeys(msg_ids))
+    failed_ids = []
+    for start in range(0, len(msg_ids), chunk_size):
+        chunk = msg_ids[start:start + chunk_size]
+
+        def modify(label_id):
+            body = {'ids': chunk, 'addLabelIds': [label_id], 'removeLabelIds': []}
+            service.users().messages().batchModify(userId=user_id, body=body).execute()
+
+        try:
+            _modify_with_label(service, user_id, label_name, modify)
+            logger.info("Applied label", extra={"label": label_name, "messages": len(chunk)})
+        except HttpError as error:
+            logger.error("Could not apply label", extra={"label": label_name, "messages": len(chunk), "error": str(error)})
+            failed_ids.extend(chunk)
+    return failed_ids
 
 def get_latest_email(service):
     """Gets the most recent email from the inbox."""
@@ -76,7 +546,7 @@ def get_latest_email(service):
         messages = results.get("messages", [])
 
         if not messages:
-            print("No new messages found.")
+            logger.info("No new messages found")
             return
 
         msg_id = messages[0]['id']
@@ -87,10 +557,10 @@ def get_latest_email(service):
         headers = message['payload']['headers']
         subject = next((header['value'] for header in headers if header['name'] == 'Subject'), 'No Subject')
 
-        print(f"Latest email subject: {subject}\n")
+        logger.info("Latest email", extra={"subject": subject})
 
     except HttpError as error:
-        print(f"An error occurred: {error}")
+        logger.error("Could not get the latest email", extra={"error": str(error)})
 
 # ... (add this to your existing gmail_service.py file) ...
 from email.mime.text import MIMEText
@@ -126,11 +596,11 @@ def create_draft(service, user_id, message_body, original_message):
         create_message = {'message': {'raw': encoded_message, 'threadId': original_message['threadId']}}
 
         draft = service.users().drafts().create(userId=user_id, body=create_message).execute()
-        print(f"Draft created successfully. Draft ID: {draft['id']}")
+        logger.info("Draft created", extra={"draft_id": draft['id']})
         return draft
 
     except HttpError as error:
-        print(f"An error occurred: {error}")
+        logger.error("Could not create the draft", extra={"error": str(error)})
         return None
 # Add this entire function to the bottom of gmail_service.py
 
@@ -151,13 +621,51 @@ def send_email(service, user_id, message):
         body = {'raw': raw_message}
         
         sent_message = service.users().messages().send(userId=user_id, body=body).execute()
-        print(f"Message sent successfully. Message ID: {sent_message['id']}")
+        logger.info("Message sent", extra={"msg_id": sent_message['id']})
         return sent_message
     except HttpError as error:
-        print(f'An error occurred: {error}')
+        logger.error("Could not send the message", extra={"error": str(error)})
         return None
 
+def find_sent_message(service, user_id, message_id_header):
+    """Returns the Gmail ID of the message with the given Message-ID header, or None if there is none."""
+    results = service.users().messages().list(
+        userId=user_id,
+        q=f"rfc822msgid:{message_id_header.strip().strip('<>')}",
+        includeSpamTrash=True,
+        maxResults=1
+    ).execute()
+    messages = results.get('messages', [])
+    return messages[0]['id'] if messages else None
+
+@stage("send")
+def send_email_once(service, user_id, message):
+    """Sends a message unless a message with the same Message-ID header was already sent.
+
+    The Message-ID works as an idempotency key: if a crash happened after the
+    send but before this was recorded anywhere, retrying does not send the
+    message a second time.
+
+    Returns:
+      The sent message, {'id': ..., 'already_sent': True} if it had been sent before,
+      or None if sending failed.
+    """
+    message_id_header = message['Message-ID']
+    if message_id_header:
+        try:
+            existing_id = find_sent_message(service, user_id, message_id_header)
+        except HttpError as error:
+            logger.error("Could not check whether the message was already sent",
+                         extra={"message_id": message_id_header, "error": str(error)})
+            return None
+        if existing_id:
+            logger.info("Message was already sent, not sending it again",
+                        extra={"message_id": message_id_header, "msg_id": existing_id})
+            return {'id': existing_id, 'already_sent': True}
+    return send_email(service, user_id, message)
+
 if __name__ == "__main__":
+    configure_logging()
     gmail_service_client = get_gmail_service()
     if gmail_service_client:
         get_latest_email(gmail_service_client)
\ No newline at end of file
@@ -1,28 +1,19 @@
 import chromadb
-from sentence_transformers import SentenceTransformer
+from embedding_service import get_embedding_function
+from knowledge_ingest import sync_knowledge_base
 
 # 1. Initialize ChromaDB client and create a collection
 client = chromadb.Client()
-# Use SentenceTransformer for creating embeddings locally
+# This is an in-memory database, so the notes are indexed from scratch every time.
 # Or, you can use `client = chromadb.PersistentClient(path="/path/to/db")` to save to disk
-collection = client.get_or_create_collection(name="personal_knowledge")
+# Embeddings are computed locally with the SentenceTransformer model from embedding_service
+collection = client.get_or_create_collection(name="personal_knowledge", embedding_function=get_embedding_function())
 
 print("Reading knowledge base file...")
-# 2. Read the text file and split it into "documents" (by line)
-with open('my_notes.txt', 'r') as f:
-    documents = [line.strip() for line in f.readlines() if line.strip()]
-
-# 3. Generate a unique ID for each document
-ids = [f"doc_{i}" for i in range(len(documents))]
-
-print(f"Adding {len(documents)} documents to the collection...")
-# 4. Add the documents to the ChromaDB collection
-# ChromaDB will automatically use its default embedding model if not specified,
-# but explicitly using SentenceTransformer is good practice.
-collection.add(
-    documents=documents,
-    ids=ids
-)
-
+# 2. Split the notes into overlapping chunks of a few lines each and add them to the
+# ChromaDB collection, using content-hash IDs.
+# The database is in memory, so there is no manifest to keep next to it.
+result = sync_knowledge_base(collection, ['my_notes.txt'])
+print(f"Added {result['added']} chunks to the collection.")
 print("\nKnowledge base created successfully.")
-print(f"Total documents in collection: {collection.count()}")
\ No newline at end of file
+print(f"Total documents in collection: {collection.count()}")
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+from email import policy
+from email.parser import BytesParser
+from html.parser import HTMLParser
+from pathlib import Path
+
+# Note files that are indexed, by extension
+NOTE_EXTENSIONS = {".txt", ".md", ".html", ".htm", ".eml"}
+# Chunks are built from whole lines up to about this many characters...
+CHUNK_SIZE = 500
+# ...and repeat up to this many characters of the previous chunk, so facts on a boundary are not cut off
+CHUNK_OVERLAP = 100
+# How many chunks are embedded and written to Chroma per call
+UPSERT_BATCH_SIZE = 256
+# Remembers which chunks every file produced, so unchanged files are not read again
+MANIFEST_FILE = "kb_manifest.json"
+
+# HTML elements whose text is a block of its own
+BLOCK_TAGS = {"p", "div", "li", "tr", "h1", "h2", "h3", "h4"}
+
+class _HTMLTextExtractor(HTMLParser):
+    """Collects the visible text of an HTML document."""
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style"):
+            self._skip += 1
+        elif tag in ("br", "hr") or tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style") and self._skip:
+            self._skip -= 1
+        elif tag in BLOCK_TAGS:
+            # Text after a block (e.g. a link after a paragraph) starts a line of its own
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+def html_to_text(html):
+    """Turns HTML into plain text, one block per line."""
+    extractor = _HTMLTextExtractor()
+    extractor.feed(html)
+    return "".join(extractor.parts)
+
+def read_note_file(path):
+    """Reads the text of a note file, whatever its format."""
+    suffix = path.suffix.lower()
+    if suffix == ".eml":
+        with open(path, "rb") as f:
+            message = BytesParser(policy=policy.default).parse(f)
+        body = message.get_body(preferencelist=("plain", "html"))
+        text = body.get_content() if body else ""
+        if body is not None and body.get_content_type() == "text/html":
+            text = html_to_text(text)
+        return f"Subject: {message.get('subject', '')}\n{text}"
+    text = path.read_text(encoding="utf-8", errors="replace")
+    if suffix in (".html", ".htm"):
+        text = html_to_text(text)
+    return text
+
+def iter_note_files(sources):
+    """Yields every note file in the given files and directories (searched recursively)."""
+    for source in sources:
+        source = Path(source)
+        if source.is_file():
+            yield source
+        elif source.is_dir():
+            for path in sorted(source.rglob("*")):
+                if path.is_file() and path.suffix.lower() in NOTE_EXTENSIONS:
+                    yield path
+
+def chunk_text(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """
+    Splits text into chunks of whole lines of up to chunk_size characters.
+    Each chunk starts with the last lines (up to overlap characters) of the one before.
+    """
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        # A line longer than a chunk is cut into pieces that overlap
+        while len(line) > chunk_size:
+            lines.append(line[:chunk_size])
+            line = line[chunk_size - overlap:]
+        if line:
+            lines.append(line)
+
+    chunks = []
+    current = []
+    current_size = 0
+    for line in lines:
+        if current and current_size + len(line) + 1 > chunk_size:
+            chunks.append("\n".join(current))
+            # Carry the tail of this chunk over into the next one
+            carried = []
+            carried_size = 0
+            for previous in reversed(current):
+                if carried_size + len(previous) + 1 > overlap:
+                    break
+                carried.insert(0, previous)
+                carried_size += len(previous) + 1
+            current, current_size = carried, carried_size
+        current.append(line)
+        current_size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def chunk_id(source, chunk):
+    """A stable ID for a chunk, derived from its file and its content."""
+    return hashlib.sha256(f"{source}\0{chunk}".encode("utf-8")).hexdigest()[:32]
+
+def load_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    try:
+        with open(manifest_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(manifest, manifest_file):
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, manifest_file)
+
+def sync_knowledge_base(collection, sources, manifest_file=None, batch_size=UPSERT_BATCH_SIZE,
+                        chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """
+    Brings the collection in line with the note files in sources.
+
+    Files whose size and modification time did not change since the last run are
+    not read again. Only chunks the collection does not have yet are embedded and
+    upserted, in batches, and chunks of deleted or edited notes are removed.
+    The file sizes and times are kept in manifest_file, which belongs next to the
+    collection's database; without one (e.g. for an in-memory client) every file is read.
+
+    Returns a dict with the number of files read, chunks added, removed and kept.
+    """
+    manifest = load_manifest(manifest_file) if manifest_file else {}
+    existing_ids = set(collection.get(include=[])["ids"])
+
+    new_manifest = {}
+    wanted_ids = set()
+    to_add = {}
+    files_read = 0
+    for path in iter_note_files(sources):
+        source = str(path)
+        stat = path.stat()
+        entry = manifest.get(source)
+        unchanged = (
+            entry is not None
+            and entry["mtime"] == stat.st_mtime
+            and entry["size"] == stat.st_size
+            and existing_ids.issuperset(entry["ids"])
+        )
+        if unchanged:
+            ids = entry["ids"]
+        else:
+            files_read += 1
+            ids = []
+            for index, chunk in enumerate(chunk_text(read_note_file(path), chunk_size, overlap)):
+                doc_id = chunk_id(source, chunk)
+                ids.append(doc_id)
+                if doc_id not in existing_ids:
+                    to_add[doc_id] = (chunk, {"source": source, "chunk": index})
+        new_manifest[source] = {"mtime": stat.st_mtime, "size": stat.st_size, "ids": ids}
+        wanted_ids.update(ids)
+
+    add_ids = list(to_add)
+    for start in range(0, len(add_ids), batch_size):
+        batch = add_ids[start:start + batch_size]
+        collection.upsert(
+            ids=batch,
+            documents=[to_add[doc_id][0] for doc_id in batch],
+            metadatas=[to_add[doc_id][1] for doc_id in batch],
+        )
+
+    stale_ids = list(existing_ids - wanted_ids)
+    for start in range(0, len(stale_ids), batch_size):
+        collection.delete(ids=stale_ids[start:start + batch_size])
+
+    if manifest_file:
+        save_manifest(new_manifest, manifest_file)
+    return {
+        "files_read": files_read,
+        "added": len(add_ids),
+        "removed": len(stale_ids),
+        "kept": len(wanted_ids) - len(add_ids),
+    }
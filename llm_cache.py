@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Where cached LLM results are stored, how long they stay valid and how many are kept
+LLM_CACHE_FILE = os.environ.get("LLM_CACHE_FILE", "llm_cache.sqlite3")
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "10000"))
+# Set LLM_CACHE_ENABLED=0 to always call the LLM
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "1") != "0"
+
+def normalize_content(text, strip_digits=False):
+    """
+    Normalizes text before hashing so trivially different copies of an email share a key.
+    Case and whitespace are ignored; with strip_digits, numbers (dates, order and
+    tracking numbers in notifications) are ignored too.
+    """
+    text = re.sub(r"\s+", " ", text).strip().casefold()
+    if strip_digits:
+        text = re.sub(r"\d+", "0", text)
+    return text
+
+class LLMCache:
+    """
+    An SQLite-backed cache of LLM results.
+
+    Entries expire after ttl seconds, and once there are more than max_entries
+    the least recently used ones are evicted. Hits and misses are counted so
+    the hit rate can be reported.
+    """
+
+    def __init__(self, path=LLM_CACHE_FILE, ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(kind, content, model, prompt_version, strip_digits=False):
+        """Builds the cache key for a request from its normalized content, model and prompt version."""
+        normalized = normalize_content(content, strip_digits=strip_digits)
+        return hashlib.sha256(f"{kind}\0{model}\0{prompt_version}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns the cached value for key, or None if there is no fresh entry."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        """Stores a JSON-serializable value, evicting the least recently used entries if needed."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now)
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN "
+                    "(SELECT key FROM llm_cache ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._conn.commit()
+
+    def stats(self):
+        """Returns the number of hits, misses, the hit rate and the number of stored entries."""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+            }
+
+# The cache is opened on first use, so importing this module does not create the file
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_llm_cache():
+    """Returns the shared LLMCache, or None if caching is turned off."""
+    global _cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMCache()
+        return _cache
@@ -1,129 +1,381 @@
-
+import asyncio
+import functools
+import hashlib
+import os
+import threading
 import time
-import datetime
-from googleapiclient.discovery import build
 from email.mime.text import MIMEText
-import base64
 
 # Import our custom service functions
-from gmail_service import get_gmail_service, send_email, apply_label_to_email
-from llm_handler import classify_email_intent_local, generate_reply_local
-from rag_service import query_rag
+from gmail_service import send_email_once, apply_label_to_email
+from llm_handler import (
+    LLM_MODE, classify_email_intent_local, generate_reply_local, classify_and_reply_local,
+    classify_email_intent_async, generate_reply_async, classify_and_reply_async, format_llm_stats, backend,
+    generate_reply_stream_local, generate_reply_stream_async
+)
+from llm_cache import get_llm_cache
+from token_budget import context_items
+from rag_service import retrieve_notes
+from calendar_service import get_calendar_availability
+from sync_service import AdaptivePollInterval
+from tenants import collect_new_mail, fair_batches, get_tenant_registry, thread_store_for
+from triage import check_headers, estimate_priority, triage_email, get_triage_stats
+from pipeline import EmailPipeline
+from scheduler import format_latency_stats
+from mime_parser import extract_body
+from metrics import configure_logging, get_logger, stage
+
+logger = get_logger(__name__)
+
+# Set to 1 to stream replies into the confirmation prompt as they are written. The LLM workers
+# then only classify ahead of time, and each reply is generated while you watch, one at a time;
+# by default the replies are drafted by the LLM workers in parallel, ahead of the prompt.
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "0") == "1"
 
 # --- Helper Functions ---
 def get_email_body(message):
-    if 'parts' in message['payload']:
-        parts = message['payload']['parts']
-        data = ""
-        for part in parts:
-            if part.get('mimeType') == 'text/plain' and 'data' in part['body']:
-                data = part['body']['data']
-                return base64.urlsafe_b64decode(data).decode('utf-8')
-    elif 'data' in message['payload']['body']:
-        data = message['payload']['body']['data']
-        return base64.urlsafe_b64decode(data).decode('utf-8')
-    return ""
-
-def process_single_email(service, message_info):
+    """Returns the readable text of a Gmail message, without quoted history and cut to the LLM's budget."""
+    return extract_body(message['payload'])
+
+def get_header(message, name, default=''):
+    """Returns the value of a header of a Gmail message (case-insensitive)."""
+    return next((h['value'] for h in message['payload']['headers'] if h['name'].lower() == name.lower()), default)
+
+@stage("parse")
+def parse_email(message_data):
+    """Pulls out everything the later steps need from a full Gmail message."""
+    original_sender = get_header(message_data, 'from', 'No Sender')
+    original_subject = get_header(message_data, 'subject', 'No Subject')
+    email_content = get_email_body(message_data)
+    return {
+        'id': message_data['id'],
+        'thread_id': message_data.get('threadId'),
+        'label_ids': message_data.get('labelIds', []),
+        'headers': {h['name'].lower(): h['value'] for h in message_data['payload']['headers']},
+        'sender': original_sender,
+        'subject': original_subject,
+        'message_id_header': get_header(message_data, 'message-id'),
+        'internal_date': int(message_data.get('internalDate', 0)),
+        'body': email_content,
+        'content_for_llm': f"Subject: {original_subject}\nFrom: {original_sender}\n\n{email_content}",
+    }
+
+def rag_query_text(email):
+    """The text notes are looked up by: the subject and body, without the sender's address."""
+    return f"{email['subject']}\n{email['body']}"
+
+def prefetch_notes(emails):
     """
-    Contains the logic to process one single email.
+    In single_pass mode, looks up the notes for a batch of emails at once and stores them in email['notes'].
+    Every email that gets past triage has its notes in the prompt there, so one embedding call and one
+    query serve the whole batch. Emails that triage will settle are skipped, since they never get a reply.
+
+    In two_pass mode only information requests are given notes, and the intent is only known after
+    classification, so nothing is looked up here: get_notes_context looks them up for those emails alone.
     """
-    msg_id = message_info['id']
-    
-    # Get the full message details
-    message_data = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-    
-    email_content = get_email_body(message_data)
-    original_sender = next((h['value'] for h in message_data['payload']['headers'] if h['name'].lower() == 'from'), 'No Sender')
-    original_subject = next((h['value'] for h in message_data['payload']['headers'] if h['name'].lower() == 'subject'), 'No Subject')
+    if LLM_MODE != 'single_pass':
+        return
+    emails = [email for email in emails if check_headers(email) is None]
+    # Every account has its own notes
+    by_account = {}
+    for email in emails:
+        by_account.setdefault(email.get('account'), []).append(email)
+    for account, account_emails in by_account.items():
+        notes_per_email = retrieve_notes([rag_query_text(email) for email in account_emails], account=account)
+        for email, notes in zip(account_emails, notes_per_email):
+            email['notes'] = notes
+
+def get_notes_context(email):
+    """
+    Looks up notes relevant to the email in the knowledge base.
+    Returns them most relevant first, so the least relevant are dropped first if the prompt is too long.
+    """
+    if 'notes' in email:
+        retrieved_docs = email['notes']
+    else:
+        retrieved_docs = retrieve_notes([rag_query_text(email)], account=email.get('account'))[0]
+    return list(retrieved_docs) or None
+
+def get_calendar_context(calendar):
+    """Describes the next free slots in the calendar, or None if the calendar cannot be read."""
+    if calendar is None:
+        return None
+    try:
+        # Answered from the cached free/busy window; a burst of meeting requests costs one API call
+        return calendar.describe_free_slots()
+    except Exception as e:
+        logger.error("Calendar API error", extra={"error": str(e)})
+        return None
+
+def with_thread_history(email, context):
+    """
+    Adds the summary of the earlier messages in the email's thread (see thread_store) to the context.
+    It goes last, so it is the first thing left out when the prompt gets too long.
+    """
+    items = context_items(context)
+    if email.get('thread_history'):
+        items.append(email['thread_history'])
+    return items or None
+
+def get_context_for_llm(email, intent, calendar=None):
+    """Gathers extra context (RAG notes, calendar, thread history) for the reply, or None if there is none."""
+    # Add context logic (RAG, Calendar)
+    context = None
+    if intent == 'meeting_request':
+        context = get_calendar_context(calendar)
+    elif intent == 'information_request':
+        context = get_notes_context(email)
+    return with_thread_history(email, context)
+
+def get_single_pass_context(email, calendar=None):
+    """
+    The context for single_pass mode, where the intent is only known after the call:
+    the notes, then the free slots of calendar for in case it is a meeting request.
+    """
+    return context_items(get_notes_context(email)) + context_items(get_calendar_context(calendar))
+
+def analyze_email(email, defer_reply=False, calendar=None):
+    """
+    Classifies an email and, unless it is spam, drafts a reply using the local LLM.
+    Returns a dict with the 'classification' and the 'reply_body' (None if no reply was drafted).
+    Replies to meeting requests are given the free slots of calendar (a CalendarAvailability), if any.
+
+    With defer_reply the reply is not generated here: the result gets 'deferred': True
+    and the 'context' for the reply, so it can be streamed to the user later.
+    """
+    # Obvious bulk and automated mail is settled from its headers, without the LLM
+    classification = triage_email(email)
+    if classification:
+        return {'classification': classification, 'reply_body': None}
 
-    print(f"\n-> Processing email from: {original_sender} | Subject: {original_subject}")
+    email_content_for_llm = email['content_for_llm']
+    if LLM_MODE == 'single_pass':
+        # The intent is only known after the call, so the notes and the calendar are always looked up
+        context_for_llm = with_thread_history(email, get_single_pass_context(email, calendar))
+        classification, reply_body = classify_and_reply_local(email_content_for_llm, context=context_for_llm)
+        return {'classification': classification, 'reply_body': reply_body}
 
-    # Classify, get context, and generate a reply
-    email_content_for_llm = f"Subject: {original_subject}\nFrom: {original_sender}\n\n{email_content}"
     classification = classify_email_intent_local(email_content_for_llm)
-    print(f"-> Classification: {classification}")
+    reply_body = None
 
     if classification and classification.get('intent') != 'spam':
         intent = classification.get('intent')
-        context_for_llm = None
-        
-        # Add context logic (RAG, Calendar)
-        if intent == 'meeting_request':
-            # Add calendar checking logic here if desired
-            pass
-        elif intent == 'information_request':
-            retrieved_docs = query_rag(email_content_for_llm)
-            if retrieved_docs:
-                context_for_llm = "Relevant notes:\n" + "\n".join(retrieved_docs)
-
+        context_for_llm = get_context_for_llm(email, intent, calendar)
+        if defer_reply:
+            return {'classification': classification, 'reply_body': None, 'deferred': True, 'context': context_for_llm}
         reply_body = generate_reply_local(email_content_for_llm, intent, context=context_for_llm)
-        
-        if reply_body:
-            # --- SAFETY CONFIRMATION STEP ---
-            print("\n" + "="*50)
-            print("!! AI-GENERATED REPLY TO BE SENT !!")
-            print(f"   RECIPIENT: {original_sender}")
-            print("="*50)
-            print(reply_body)
-            print("="*50)
 
-            confirmation = input(">>> Send this reply? (yes/no): ")
-
-            if confirmation.lower() == 'yes':
-                print("\nUser confirmed. Sending email...")
-                message = MIMEText(reply_body)
-                message['to'] = original_sender
-                message['subject'] = f"Re: {original_subject}"
-                original_msg_id_header = next((h['value'] for h in message_data['payload']['headers'] if h['name'].lower() == 'message-id'), '')
-                if original_msg_id_header:
-                    message['In-Reply-To'] = original_msg_id_header
-                    message['References'] = original_msg_id_header
-                send_email(service, 'me', message)
-            else:
-                print("\nSend operation cancelled by user.")
+    return {'classification': classification, 'reply_body': reply_body}
+
+async def analyze_email_async(email, on_token=None, calendar=None):
+    """
+    Same as analyze_email, but awaits the LLM and runs the RAG lookup in a worker thread.
+    If on_token is given, the reply is streamed and on_token(text) is called for every piece.
+    """
+    classification = triage_email(email)
+    if classification:
+        return {'classification': classification, 'reply_body': None}
+
+    email_content_for_llm = email['content_for_llm']
+    if LLM_MODE == 'single_pass':
+        context_for_llm = with_thread_history(email, await asyncio.to_thread(get_single_pass_context, email, calendar))
+        classification, reply_body = await classify_and_reply_async(email_content_for_llm, context=context_for_llm)
+        return {'classification': classification, 'reply_body': reply_body}
+
+    classification = await classify_email_intent_async(email_content_for_llm)
+    reply_body = None
+
+    if classification and classification.get('intent') != 'spam':
+        intent = classification.get('intent')
+        context_for_llm = await asyncio.to_thread(get_context_for_llm, email, intent, calendar)
+        if on_token:
+            parts = []
+            async for text in generate_reply_stream_async(email_content_for_llm, intent, context=context_for_llm):
+                parts.append(text)
+                on_token(text)
+            reply_body = "".join(parts) or None
+        else:
+            reply_body = await generate_reply_async(email_content_for_llm, intent, context=context_for_llm)
+
+    return {'classification': classification, 'reply_body': reply_body}
+
+def reply_message_id(email):
+    """
+    The Message-ID header of the reply to an email. It only depends on the email,
+    so a retried send can find out whether the reply already went out.
+    """
+    digest = hashlib.sha256(f"reply\0{email['id']}".encode("utf-8")).hexdigest()[:32]
+    return f"<{digest}@intelligent-mail-assistant>"
+
+def build_reply_message(email, reply_body):
+    """Creates the MIME reply to an email, threaded onto the original message."""
+    message = MIMEText(reply_body)
+    message['to'] = email['sender']
+    message['subject'] = f"Re: {email['subject']}"
+    message['Message-ID'] = reply_message_id(email)
+    if email['message_id_header']:
+        message['In-Reply-To'] = email['message_id_header']
+        message['References'] = email['message_id_header']
+    return message
+
+def confirm_and_send(service, email, analysis):
+    """
+    Shows the drafted reply and sends it only after the user confirms it.
+    Returns a string describing the outcome. Raises if the LLM failed, so the email
+    is not labeled and gets retried.
+    """
+    classification = analysis['classification']
+    reply_body = analysis['reply_body']
+
+    logger.info("Processing email", extra={"sender": email['sender'], "subject": email['subject'],
+                                           "classification": classification})
+
+    if not classification:
+        raise RuntimeError("The email could not be classified")
+    if classification.get('intent') == 'spam':
+        logger.info("Email is spam, no action taken", extra={"msg_id": email['id']})
+        return "Email classified as spam. No action taken."
+    if not reply_body and not analysis.get('deferred'):
+        raise RuntimeError("Reply generation failed")
+
+    # --- SAFETY CONFIRMATION STEP ---
+    print("\n" + "="*50)
+    print("!! AI-GENERATED REPLY TO BE SENT !!")
+    print(f"   RECIPIENT: {email['sender']}")
+    print("="*50)
+    if analysis.get('deferred'):
+        # Show the reply word by word while the LLM is still writing it
+        parts = []
+        for text in generate_reply_stream_local(email['content_for_llm'], classification.get('intent'), context=analysis['context']):
+            parts.append(text)
+            print(text, end="", flush=True)
+        print()
+        reply_body = "".join(parts)
+        if not reply_body:
+            print("="*50)
+            raise RuntimeError("Reply generation failed")
     else:
-        print("-> Email is spam or could not be classified. No action taken.")
+        print(reply_body)
+    print("="*50)
+
+    confirmation = input(">>> Send this reply? (yes/no): ")
+
+    if confirmation.lower() == 'yes':
+        print("\nUser confirmed. Sending email...")
+        # Never sends the same reply twice, even if we crashed right after sending it last time
+        if send_email_once(service, 'me', build_reply_message(email, reply_body)) is None:
+            raise RuntimeError("The reply could not be sent")
+        thread_store_for(email).record_reply(email, reply_message_id(email), reply_body)
+        return "AI-generated reply sent."
+    print("\nSend operation cancelled by user.")
+    return "Send operation cancelled by user."
+
+def process_single_email(service, message_info, message_data=None, apply_label=True):
+    """
+    Contains the logic to process one single email.
+    If message_data is given (e.g. from a batch fetch) it is used instead of fetching the message.
+    With apply_label=False the caller is responsible for labeling the email afterwards.
+    """
+    msg_id = message_info['id']
+    
+    # Get the full message details
+    if message_data is None:
+        with stage("get"):
+            message_data = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+
+    email = parse_email(message_data)
+    analysis = analyze_email(email, defer_reply=STREAM_REPLIES, calendar=get_calendar_availability(service))
+    confirm_and_send(service, email, analysis)
 
     # IMPORTANT: Apply the label regardless of action to prevent re-processing
-    apply_label_to_email(service, 'me', msg_id, 'ProcessedByAI')
+    if apply_label:
+        apply_label_to_email(service, 'me', msg_id, 'ProcessedByAI')
+
 
+def log_run_stats():
+    """Logs how the LLM, the triage and the caches did so far."""
+    logger.info(f"Latency by priority (fetched to handled):\n{format_latency_stats()}")
+    logger.info(f"LLM usage so far ({LLM_MODE} mode):\n{format_llm_stats()}")
+    ollama_metrics = backend.get_metrics()
+    logger.info("Ollama", extra={"requests": ollama_metrics['requests'], "cold_loads": ollama_metrics['cold_loads'],
+                                 "load_seconds": round(ollama_metrics['load_duration'], 1),
+                                 "tokens_per_second": round(ollama_metrics['eval_tokens_per_second'], 1)})
+    triage_stats = get_triage_stats()
+    logger.info("Triage", extra={"settled": triage_stats['settled'], "checked": triage_stats['checked'],
+                                 "llm_calls_avoided": f"{triage_stats['llm_calls_avoided']:.0%}"})
+    llm_cache = get_llm_cache()
+    if llm_cache:
+        cache_stats = llm_cache.stats()
+        logger.info("LLM cache", extra={"hit_rate": f"{cache_stats['hit_rate']:.0%}", "hits": cache_stats['hits'],
+                                        "misses": cache_stats['misses'], "entries": cache_stats['entries']})
 
 def main_loop():
     """The main continuous loop of the application."""
-    print("Starting Intelligent Mail Assistant Service...")
-    service = get_gmail_service()
-    if not service:
-        print("Could not connect to Gmail. Exiting.")
+    configure_logging()
+    logger.info("Starting Intelligent Mail Assistant Service")
+    registry = get_tenant_registry()
+    # Log in to every account once; the services (and their connections) are reused from then on
+    tenants = []
+    for tenant in registry.tenants():
+        try:
+            tenant.get_service()
+            tenants.append(tenant)
+        except Exception as e:
+            logger.error("Could not connect to Gmail", extra={"account": tenant.name, "error": str(e)})
+    if not tenants:
+        logger.error("Could not connect to Gmail, exiting")
         return
+    logger.info("Accounts", extra={"accounts": ", ".join(tenant.name for tenant in tenants)})
 
+    # Check again soon while mail keeps coming in, less often while the inboxes are quiet
+    poll_interval = AdaptivePollInterval()
     while True:
+        found_mail = False
         try:
-            print(f"\n--- Checking for new mail at {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
-            
-            # Fetch only messages that are in INBOX and DO NOT have the 'ProcessedByAI' label
-            results = service.users().messages().list(
-                userId='me', 
-                labelIds=['INBOX'],
-                q="-label:ProcessedByAI" # The magic query
-            ).execute()
-            
-            messages = results.get('messages', [])
-            
-            if not messages:
-                print("No new mail to process.")
+            logger.info("Checking for new mail")
+
+            # Only look at messages added since the last check (or everything unprocessed on the first run)
+            ready_ids = {}
+            for tenant in tenants:
+                try:
+                    ready_ids[tenant] = collect_new_mail(tenant)
+                except Exception as e:
+                    # One account failing (e.g. a revoked token) does not hold up the others
+                    logger.error("Could not check for new mail", extra={"account": tenant.name, "error": str(e)})
+
+            if not any(ready_ids.values()):
+                logger.info("No new mail to process")
             else:
-                print(f"Found {len(messages)} new email(s). Processing one by one...")
-                for message_info in messages:
-                    process_single_email(service, message_info)
+                found_mail = True
+                # Load the model while the first emails are being fetched
+                threading.Thread(target=backend.warm_up, daemon=True).start()
+                # The accounts take turns, a batch each, so a flooded inbox cannot starve the others
+                for tenant, msg_ids in fair_batches(ready_ids):
+                    service = tenant.get_service()
+                    logger.info("Processing emails in a pipeline", extra={"account": tenant.name, "emails": len(msg_ids)})
+                    # Fetching, LLM work and confirming/sending overlap; the user is still asked about every reply
+                    analyze = functools.partial(analyze_email, defer_reply=STREAM_REPLIES,
+                                                calendar=get_calendar_availability(service))
+                    # Urgent mail goes through the LLM and gets to you first; bulk mail waits
+                    pipeline = EmailPipeline(service, parse_email, analyze, confirm_and_send, prepare=prefetch_notes,
+                                             work_queue=tenant.work_queue(), prioritize=estimate_priority,
+                                             thread_store=tenant.thread_store(), account=tenant.name)
+                    pipeline.run(msg_ids)
+                for tenant in ready_ids:
+                    work_queue = tenant.work_queue()
+                    queue_stats = work_queue.stats()
+                    logger.info("Work queue", extra={"account": tenant.name, "done": queue_stats['stages']['labeled'],
+                                                     "retrying": queue_stats['retrying'], "given_up": queue_stats['given_up']})
+                    work_queue.prune()
+                    tenant.thread_store().prune()
+                log_run_stats()
 
         except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-            print("Continuing...")
+            logger.exception("An unexpected error occurred, continuing", extra={"error": str(e)})
 
-        # Wait for 10 minutes before the next check
-        print("\n Waiting for 10 minutes (600 seconds) before next check")
-        time.sleep(600)
+        wait = poll_interval.next(found_mail)
+        logger.info("Waiting before the next check", extra={"seconds": wait})
+        time.sleep(wait)
 
 
 if __name__ == '__main__':
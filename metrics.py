@@ -0,0 +1,214 @@
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+# --- Logging ---
+# 'text' keeps the console readable; 'json' writes one JSON object per line for log collectors
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+
+# --- Tracing ---
+# Set to 1 to also wrap every stage in an OpenTelemetry span. Needs opentelemetry-api, and a
+# configured SDK to send the spans anywhere (e.g. run the app under `opentelemetry-instrument`).
+OTEL_ENABLED = os.environ.get("OTEL_ENABLED", "0") == "1"
+
+# --- Metrics ---
+METRIC_PREFIX = "mail_assistant_"
+# Histogram buckets in seconds, from a cached lookup up to a long generation
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRIC_HELP = {
+    "stage_seconds": "Time spent in each processing stage (list, get, parse, classify, retrieve, generate, send, label).",
+    "stage_errors_total": "Stages that ended with an exception.",
+    "gmail_api_calls_total": "Gmail and Calendar API calls by method, calls inside batch requests included.",
+    "gmail_api_errors_total": "Gmail and Calendar API calls that failed, by method and HTTP status.",
+    "gmail_api_seconds": "Duration of Gmail and Calendar API calls made outside batch requests.",
+    "gmail_http_requests_total": "HTTP round trips to Google APIs (a batch request is one).",
+    "gmail_api_retries_total": "Gmail and Calendar API calls tried again after a rate limit or server error, by method and HTTP status.",
+    "gmail_quota_units_total": "Gmail quota units used, by method.",
+    "gmail_quota_wait_seconds_total": "Time calls spent waiting for Gmail quota.",
+    "cache_lookups_total": "Cache lookups by cache and result (hit or miss).",
+}
+
+_counters = {}
+_histograms = {}
+_collectors = []
+_metrics_lock = threading.Lock()
+
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def inc(name, amount=1, **labels):
+    """Adds amount to a counter, e.g. inc("cache_lookups_total", cache="llm", result="hit")."""
+    key = _key(name, labels)
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def observe(name, value, buckets=STAGE_BUCKETS, **labels):
+    """Records one observation (e.g. a duration in seconds) in a histogram."""
+    key = _key(name, labels)
+    with _metrics_lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            # One count per bucket, then the sum and the count of all observations
+            histogram = _histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for index, bound in enumerate(histogram["buckets"]):
+            if value <= bound:
+                histogram["counts"][index] += 1
+                break
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+def register_collector(collector):
+    """
+    Registers a function that is called on every scrape and returns (name, type, help, labels, value)
+    samples, for numbers that are already counted elsewhere (e.g. the Ollama timings).
+    """
+    _collectors.append(collector)
+
+def record_stage(name, seconds, error=False):
+    """Records how long one run of a stage took."""
+    observe("stage_seconds", seconds, stage=name)
+    if error:
+        inc("stage_errors_total", stage=name)
+
+_tracer = None
+
+def get_tracer():
+    """The OpenTelemetry tracer stages are reported to, or None when spans are off."""
+    global _tracer
+    if _tracer is None:
+        _tracer = False
+        if OTEL_ENABLED:
+            try:
+                from opentelemetry import trace
+                _tracer = trace.get_tracer("intelligent-mail-assistant")
+            except ImportError:
+                get_logger(__name__).warning("OTEL_ENABLED is set, but opentelemetry-api is not installed. Spans are off.")
+    return _tracer or None
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Times a block (or, used as a decorator, a function) as one run of a stage, in an
+    OpenTelemetry span if those are on. Exceptions are counted and passed on.
+    """
+    tracer = get_tracer()
+    started = time.perf_counter()
+    failed = False
+    with tracer.start_as_current_span(name) if tracer else contextlib.nullcontext():
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            record_stage(name, time.perf_counter() - started, failed)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+def _format_value(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+def render_prometheus():
+    """Returns every metric in the Prometheus text exposition format."""
+    with _metrics_lock:
+        counters = dict(_counters)
+        histograms = {key: dict(value, counts=list(value["counts"])) for key, value in _histograms.items()}
+
+    # name -> (type, help, sample lines)
+    families = {}
+
+    def add(name, kind, help_text, labels, value, suffix=""):
+        family = families.setdefault(METRIC_PREFIX + name, (kind, help_text or METRIC_HELP.get(name, name), []))
+        family[2].append(f"{METRIC_PREFIX}{name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+
+    for (name, labels), value in sorted(counters.items()):
+        add(name, "counter", None, labels, value)
+    for (name, labels), histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(histogram["buckets"], histogram["counts"]):
+            cumulative += count
+            add(name, "histogram", None, labels + (("le", repr(float(bound))),), cumulative, "_bucket")
+        add(name, "histogram", None, labels + (("le", "+Inf"),), histogram["count"], "_bucket")
+        add(name, "histogram", None, labels, histogram["sum"], "_sum")
+        add(name, "histogram", None, labels, histogram["count"], "_count")
+    for collector in list(_collectors):
+        try:
+            for name, kind, help_text, labels, value in collector():
+                add(name, kind, help_text, tuple(sorted((key, str(v)) for key, v in labels.items())), value)
+        except Exception as e:
+            get_logger(__name__).warning("A metrics collector failed", extra={"error": str(e)})
+
+    lines = []
+    for name, (kind, help_text, samples) in families.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+# --- Structured logging ---
+# Attributes every log record has; anything else on a record was passed in extra= and is logged as a field
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats a record as its message followed by key=value fields, or with json_lines as one
+    JSON object per line. The fields are whatever was passed in extra=, e.g.
+    logger.info("Sent reply", extra={"msg_id": msg_id}).
+    """
+
+    def __init__(self, json_lines=False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+        message = record.getMessage()
+        if self.json_lines:
+            entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                     "message": message}
+            entry.update(fields)
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+        text = message + "".join(
+            f" {key}={json.dumps(value) if isinstance(value, str) and (' ' in value or not value) else value}"
+            for key, value in fields.items()
+        )
+        if record.levelno >= logging.WARNING:
+            text = f"{record.levelname}: {text}"
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+def get_logger(name):
+    """The logger of a module: every logger of the app sits under 'mail_assistant'."""
+    return logging.getLogger("mail_assistant." + name.rsplit(".", 1)[-1])
+
+_logging_configured = False
+
+def configure_logging(log_format=LOG_FORMAT, level=LOG_LEVEL):
+    """Sends the app's log records to stderr in the chosen format. Only the first call has an effect."""
+    global _logging_configured
+    if _logging_configured:
+        return
+    _logging_configured = True
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(StructuredFormatter(json_lines=log_format == "json"))
+    logger = logging.getLogger("mail_assistant")
+    logger.addHandler(handler)
+    logger.setLevel(level.upper())
+    # Uvicorn and friends configure the root logger; keep our records out of it so they are not printed twice
+    logger.propagate = False
@@ -0,0 +1,188 @@
+import base64
+import codecs
+import re
+import sys
+import time
+from email import policy
+from email.parser import BytesParser
+from pathlib import Path
+
+from knowledge_ingest import html_to_text
+from token_budget import HEAD_SHARE, estimate_tokens, truncate_head_tail
+
+# Only this much of each body part is decoded (its start and its end); anything in between would be cut off anyway
+MAX_PART_BYTES = 64 * 1024
+# A safety limit on the body, well above any prompt budget. How much of the body the LLM
+# sees is decided per stage by token_budget, which keeps the start and end of long emails.
+MAX_BODY_TOKENS = 16000
+
+# Lines that start the quoted history of a reply; everything from them on is dropped
+QUOTE_HEADERS = [
+    re.compile(r"^On .{0,300}wrote:$", re.DOTALL),
+    re.compile(r"^-{2,}\s*Original Message\s*-{2,}$", re.IGNORECASE),
+    re.compile(r"^_{20,}$"),
+    # Outlook puts the original headers in the body: "From: ...", then "Sent: ..." or "Date: ..."
+    re.compile(r"^From: .+\n(Sent|Date): ", re.IGNORECASE),
+]
+# Forwarded emails also start with "From: ..." lines, but their content is what the sender wants read
+FORWARD_HEADER = re.compile(r"^(-+\s*Forwarded message\s*-+|Begin forwarded message:)$", re.IGNORECASE)
+# "-- " on its own line starts a signature (RFC 3676)
+SIGNATURE_DELIMITER = re.compile(r"^--\s?$")
+MOBILE_SIGNATURE = re.compile(r"^Sent from my \w+", re.IGNORECASE)
+
+def get_part_header(part, name, default=''):
+    """Returns the value of a header of a MIME part (case-insensitive)."""
+    return next((h['value'] for h in part.get('headers', []) if h['name'].lower() == name.lower()), default)
+
+def is_attachment(part):
+    """Tells whether a MIME part is a file attachment rather than part of the message text."""
+    if part.get('filename'):
+        return True
+    return get_part_header(part, 'content-disposition').strip().lower().startswith('attachment')
+
+def get_charset(part):
+    """Returns the charset of a text part, falling back to UTF-8 for missing or unknown ones."""
+    match = re.search(r'charset="?([^";\s]+)', get_part_header(part, 'content-type'), re.IGNORECASE)
+    charset = match.group(1) if match else 'utf-8'
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        return 'utf-8'
+    return charset
+
+def decode_part(part, max_bytes=MAX_PART_BYTES):
+    """Decodes at most max_bytes of a part's body, from its start and its end, with the part's charset."""
+    data = part.get('body', {}).get('data')
+    if not data:
+        # Very large bodies only come with an attachmentId; they are skipped rather than fetched
+        return ""
+    # Every 4 base64 characters hold 3 bytes, so only the start and the end of the data have to be decoded
+    limit = (max_bytes + 2) // 3 * 4
+    if len(data) <= limit:
+        raw = b64decode(data)
+    else:
+        head_chars = int(limit * HEAD_SHARE) // 4 * 4
+        tail_start = (len(data) - (limit - head_chars)) // 4 * 4
+        raw = b64decode(data[:head_chars]) + b"\n[...]\n" + b64decode(data[tail_start:])
+    return raw.decode(get_charset(part), errors='replace')
+
+def b64decode(data):
+    """Decodes URL-safe base64 with or without its padding, as Gmail sends it."""
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def select_text_parts(part):
+    """
+    Walks a MIME tree and returns the parts that make up the readable body.
+    multipart/alternative contributes its plain-text version if it has one,
+    other multiparts contribute all their inline text parts, in order.
+    """
+    mime_type = part.get('mimeType', '').lower()
+    if mime_type.startswith('multipart/'):
+        selections = [select_text_parts(child) for child in part.get('parts', [])]
+        if mime_type == 'multipart/alternative':
+            for selection in selections:
+                if any(p.get('mimeType', '').lower() == 'text/plain' for p in selection):
+                    return selection
+            return next((selection for selection in selections if selection), [])
+        return [p for selection in selections for p in selection]
+    if mime_type == 'message/rfc822':
+        # A forwarded email as an attachment; its body is part of what the sender wants read
+        return [p for child in part.get('parts', []) for p in select_text_parts(child)]
+    if mime_type in ('text/plain', 'text/html') and not is_attachment(part):
+        return [part]
+    return []
+
+def strip_quotes_and_signature(text):
+    """Removes quoted reply history, '>' quoted lines and the signature from a plain-text body."""
+    lines = text.splitlines()
+    kept = []
+    forwarded = False
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if FORWARD_HEADER.match(stripped):
+            forwarded = True
+        # Quote headers like "On Mon, 1 Jan 2024, Ann <ann@example.com> wrote:" are often wrapped onto two lines
+        # (and HTML turned into text puts blank lines between them)
+        next_line = next((following.strip() for following in lines[index + 1:index + 3] if following.strip()), None)
+        two_lines = stripped + ("\n" + next_line if next_line else "")
+        if not forwarded and any(pattern.match(stripped) or pattern.match(two_lines) for pattern in QUOTE_HEADERS):
+            break
+        if SIGNATURE_DELIMITER.match(line) or MOBILE_SIGNATURE.match(stripped):
+            break
+        if stripped.startswith('>'):
+            continue
+        kept.append(line)
+    return "\n".join(kept)
+
+def clean_whitespace(text):
+    """Collapses runs of spaces and blank lines, which cost tokens without adding meaning."""
+    lines = [re.sub(r"[ \t\xa0]+", " ", line).strip() for line in text.splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+def extract_body(payload, max_tokens=MAX_BODY_TOKENS):
+    """
+    Extracts the readable body of a Gmail message payload (format='full').
+
+    The whole MIME tree is searched. Plain text is preferred over HTML, which is
+    converted to text. The quoted history and signature are removed, and a
+    result longer than max_tokens tokens keeps its start and its end.
+    """
+    parts = []
+    for part in select_text_parts(payload):
+        text = decode_part(part)
+        if part.get('mimeType', '').lower() == 'text/html':
+            text = html_to_text(text)
+        text = clean_whitespace(strip_quotes_and_signature(text))
+        if text:
+            parts.append(text)
+    return truncate_head_tail("\n\n".join(parts), max_tokens)
+
+def payload_from_eml(raw_bytes):
+    """Turns a raw RFC 822 message (e.g. an .eml file) into a payload shaped like the Gmail API's."""
+    message = BytesParser(policy=policy.compat32).parsebytes(raw_bytes)
+
+    def convert(part):
+        payload = {
+            'mimeType': part.get_content_type(),
+            'filename': part.get_filename() or '',
+            'headers': [{'name': name, 'value': str(value)} for name, value in part.items()],
+            'body': {},
+        }
+        if part.is_multipart():
+            payload['parts'] = [convert(child) for child in part.get_payload()]
+        else:
+            # Like Gmail, undo the transfer encoding but leave the charset to the reader
+            decoded = part.get_payload(decode=True) or b""
+            payload['body'] = {'size': len(decoded), 'data': base64.urlsafe_b64encode(decoded).decode('ascii')}
+        return payload
+
+    return convert(message)
+
+
+if __name__ == "__main__":
+    # Benchmark the parser on .eml files: python mime_parser.py <files or folders>
+    if len(sys.argv) < 2:
+        print("Usage: python mime_parser.py <.eml files or folders>")
+        sys.exit(1)
+
+    paths = []
+    for arg in sys.argv[1:]:
+        path = Path(arg)
+        paths.extend(sorted(path.rglob("*.eml")) if path.is_dir() else [path])
+
+    total_raw = total_body = 0
+    total_time = 0.0
+    for path in paths:
+        raw = path.read_bytes()
+        payload = payload_from_eml(raw)
+        started = time.perf_counter()
+        body = extract_body(payload)
+        elapsed = time.perf_counter() - started
+        total_raw += len(raw)
+        total_body += len(body)
+        total_time += elapsed
+        print(f"{path.name}: {len(raw)} bytes -> {len(body)} chars (~{estimate_tokens(body)} tokens) in {elapsed * 1000:.2f}ms")
+
+    if paths:
+        print(f"\n{len(paths)} email(s): {total_raw} bytes -> {total_body} chars "
+              f"({total_body / max(total_raw, 1):.0%}), {total_time / len(paths) * 1000:.2f}ms per email on average.")
@@ -0,0 +1,411 @@
+import asyncio
+import os
+import threading
+import time
+
+from gmail_service import BATCH_GET_CHUNK_SIZE, batch_apply_label, batch_get_messages, clone_gmail_service, get_label_id
+from metrics import get_logger
+from scheduler import AsyncPriorityScheduler, PriorityScheduler, normalize_priority, record_latency
+
+logger = get_logger(__name__)
+
+# How many emails the LLM stage works on at once. Ollama only serves
+# OLLAMA_NUM_PARALLEL requests per model at a time, so going higher just queues them there.
+LLM_CONCURRENCY = int(os.environ.get("OLLAMA_NUM_PARALLEL", "1"))
+# How many emails may wait between two stages before the earlier stage has to pause
+STAGE_QUEUE_SIZE = 20
+# How many fetched emails wait for the LLM, competing by priority; fetching pauses when this many are waiting.
+# The more there are, the further ahead an urgent email can jump.
+PRIORITY_WINDOW = int(os.environ.get("PRIORITY_WINDOW", "100"))
+# Processed emails are labeled in groups of this size instead of one call per email
+LABEL_BATCH_SIZE = 25
+
+
+class _PipelineBase:
+    """Settings and bookkeeping shared by the threaded and the asyncio pipeline."""
+
+    def __init__(self, service, parse, analyze, deliver, llm_workers=LLM_CONCURRENCY,
+                 fetch_chunk_size=BATCH_GET_CHUNK_SIZE, queue_size=STAGE_QUEUE_SIZE,
+                 label_name='ProcessedByAI', prepare=None, work_queue=None, prioritize=None,
+                 priority_window=PRIORITY_WINDOW, thread_store=None, account=None):
+        self.service = service
+        self.parse = parse
+        self.prepare = prepare
+        # prioritize(email) guesses 'high', 'medium' or 'low' before the LLM has classified the email
+        self.prioritize = prioritize
+        self.priority_window = max(1, priority_window)
+        # With a WorkQueue, every stage an email reaches is recorded so a restart can resume it
+        self.work_queue = work_queue
+        # With a ThreadStore, every email gets email['thread_history'], a summary of the earlier messages in its thread
+        self.thread_store = thread_store
+        # The account (see tenants) the emails belong to; it picks e.g. the knowledge base notes are looked up in
+        self.account = account
+        self.analyze = analyze
+        self.deliver = deliver
+        self.llm_workers = max(1, llm_workers)
+        self.fetch_chunk_size = fetch_chunk_size
+        self.queue_size = queue_size
+        self.label_name = label_name
+
+        self.processed_ids = []
+        self.skipped_ids = []
+        self.failed_ids = []
+        self.outcomes = []
+        self.elapsed = 0.0
+        self._workers_left = 0
+        self._workers_lock = threading.Lock()
+
+    @property
+    def handled_ids(self):
+        """IDs that need no further work: processed now, or already labeled earlier."""
+        return set(self.processed_ids) | set(self.skipped_ids)
+
+    def _parse_fetched(self, chunk, fetched, failed_ids, processed_label_id):
+        """Turns a fetched chunk into emails, skipping labeled messages and recording failures."""
+        for msg_id in failed_ids:
+            self._fail(msg_id, f"Could not fetch message ID {msg_id}. It will be retried later.")
+        emails = []
+        for msg_id in chunk:
+            message_data = fetched.get(msg_id)
+            if message_data is None:
+                continue
+            if processed_label_id in message_data.get('labelIds', []):
+                self.skipped_ids.append(msg_id)
+                self._advance(msg_id, 'labeled')
+                continue
+            try:
+                emails.append(self.parse(message_data))
+            except Exception as e:
+                self._fail(msg_id, f"Could not parse message ID {msg_id}: {e}")
+                continue
+            self._advance(msg_id, 'fetched')
+        for email in emails:
+            email['account'] = self.account
+            email['fetched_at'] = time.monotonic()
+            email['priority'] = self._priority(email, self._stored_analysis(email))
+        return emails
+
+    def _advance(self, msg_ids, stage, **kwargs):
+        if self.work_queue is not None:
+            self.work_queue.advance(msg_ids, stage, **kwargs)
+
+    def _stored_analysis(self, email):
+        """Returns the analysis of an email from an earlier run, so the LLM is not asked again."""
+        if self.work_queue is None:
+            return None
+        return self.work_queue.get_analysis(email['id'])
+
+    def _priority(self, email, analysis=None):
+        """The priority the LLM classified the email with, or else the guess of prioritize(email)."""
+        classification = (analysis or {}).get('classification') or {}
+        if classification.get('priority'):
+            return normalize_priority(classification['priority'])
+        return normalize_priority(self.prioritize(email)) if self.prioritize else "medium"
+
+    def _worker_finished(self):
+        """Tells whether the calling LLM worker was the last one still running."""
+        with self._workers_lock:
+            self._workers_left -= 1
+            return self._workers_left == 0
+
+    def _analysis_error(self, email, analysis):
+        """
+        Why an analysis cannot be delivered, or None if it can. The LLM functions return None
+        instead of raising, so a failed call shows up here; the email is then retried later.
+        """
+        classification = (analysis or {}).get('classification')
+        if not classification:
+            return f"Could not classify message ID {email['id']}. It will be retried later."
+        if classification.get('intent') != 'spam' and not analysis.get('reply_body') and not analysis.get('deferred'):
+            return f"Could not draft a reply to message ID {email['id']}. It will be retried later."
+        return None
+
+    def _store_analysis(self, email, analysis):
+        self._advance(email['id'], 'drafted' if analysis.get('reply_body') else 'classified', analysis=analysis)
+
+    def _already_sent(self, msg_ids):
+        """Splits off the emails that were delivered before a crash but never labeled; they only need the label."""
+        if self.work_queue is None:
+            return msg_ids, []
+        sent_ids = self.work_queue.ids_in_stage(msg_ids, 'sent')
+        if sent_ids:
+            logger.info("Emails were already handled before the last stop and only need to be labeled",
+                        extra={"emails": len(sent_ids)})
+        sent = set(sent_ids)
+        return [msg_id for msg_id in msg_ids if msg_id not in sent], sent_ids
+
+    def _fill_thread_history(self, service, emails):
+        # Runs in the fetch stage, since filling gaps in the store can take a Gmail call
+        if self.thread_store is None or not emails:
+            return
+        try:
+            self.thread_store.fill_gaps(service, emails)
+        except Exception as e:
+            logger.warning("Could not look up the thread history", extra={"emails": len(emails), "error": str(e)})
+
+    def _prepare(self, emails):
+        # Optional per-chunk work done in bulk (e.g. one RAG lookup for all emails); analyze still works without it
+        if self.prepare and emails:
+            try:
+                self.prepare(emails)
+            except Exception as e:
+                logger.warning("Could not prepare emails in bulk", extra={"emails": len(emails), "error": str(e)})
+        return emails
+
+    def _delivered(self, email, outcome):
+        self._advance(email['id'], 'sent', outcome=outcome)
+        record_latency(email['priority'], time.monotonic() - email['fetched_at'])
+        self.processed_ids.append(email['id'])
+        self.outcomes.append(f"Processing email from: {email['sender']} | Subject: {email['subject']}. {outcome}")
+
+    def _label(self, msg_ids):
+        if not msg_ids:
+            return
+        failed_ids = batch_apply_label(self.service, 'me', msg_ids, self.label_name)
+        for msg_id in failed_ids:
+            logger.warning("Email could not be labeled and may be processed again", extra={"msg_id": msg_id})
+            if self.work_queue is not None:
+                self.work_queue.fail(msg_id, "Could not apply the label")
+        failed = set(failed_ids)
+        self._advance([msg_id for msg_id in msg_ids if msg_id not in failed], 'labeled')
+
+    def _fail(self, msg_id, outcome):
+        logger.warning("Email failed", extra={"msg_id": msg_id, "outcome": outcome})
+        if self.work_queue is not None:
+            self.work_queue.fail(msg_id, outcome)
+        self.failed_ids.append(msg_id)
+        self.outcomes.append(outcome)
+
+    def _report(self):
+        rate = len(self.processed_ids) / self.elapsed * 60 if self.elapsed else 0.0
+        logger.info(
+            f"Pipeline processed {len(self.processed_ids)} email(s) in {self.elapsed:.1f}s ({rate:.1f} emails/min)",
+            extra={"processed": len(self.processed_ids), "failed": len(self.failed_ids),
+                   "already_labeled": len(self.skipped_ids), "emails_per_minute": round(rate, 1)}
+        )
+
+
+class EmailPipeline(_PipelineBase):
+    """
+    Processes emails in three overlapping stages:
+
+      1. fetch   - one thread fetching messages in Gmail batch requests,
+                   turning them into emails with parse(message_data), adding
+                   their thread history from thread_store, if given, and
+                   handing each chunk of emails to prepare(emails), if given,
+      2. analyze - a pool of LLM workers running analyze(email),
+      3. deliver - deliver(service, email, analysis) in the calling thread,
+                   followed by labeling in batches.
+
+    The queues between the stages are bounded, so a slow stage holds back the
+    one before it. They hand out emails by priority, earliest deadline first
+    (see scheduler.py): the guess of prioritize(email) until the email is
+    classified, the classification's priority after that. An exception while handling one email is recorded and the
+    email is left unlabeled; the remaining emails keep flowing. So is an email the LLM
+    could not classify or draft a reply to.
+
+    With a work_queue, the stage every email reaches is recorded in it. An
+    analysis stored by an earlier run is used instead of calling analyze again,
+    and emails delivered before a crash are only labeled, never delivered twice.
+    """
+
+    def __init__(self, service, parse, analyze, deliver, fetch_service=None, **kwargs):
+        super().__init__(service, parse, analyze, deliver, **kwargs)
+        # The fetch thread runs next to the deliver stage, so it gets its own connection
+        self.fetch_service = fetch_service or clone_gmail_service(service)
+
+    def run(self, msg_ids):
+        """Runs all stages over msg_ids and returns the list of outcome strings."""
+        started = time.perf_counter()
+        analyze_queue = PriorityScheduler(self.priority_window, self.llm_workers)
+        deliver_queue = PriorityScheduler(self.queue_size)
+        self._workers_left = self.llm_workers
+        # Skip anything that got labeled but was not yet recorded as done (e.g. after a crash)
+        processed_label_id = get_label_id(self.service, 'me', self.label_name)
+        msg_ids, sent_ids = self._already_sent(msg_ids)
+        self._label(sent_ids)
+        self.skipped_ids.extend(sent_ids)
+
+        threads = [threading.Thread(target=self._fetch_stage, args=(msg_ids, processed_label_id, analyze_queue), daemon=True)]
+        threads += [
+            threading.Thread(target=self._analyze_stage, args=(analyze_queue, deliver_queue), daemon=True)
+            for _ in range(self.llm_workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        to_label = []
+        try:
+            while True:
+                entry = deliver_queue.get()
+                if entry is None:
+                    break
+                (email, analysis), priority = entry
+                try:
+                    outcome = self.deliver(self.service, email, analysis)
+                except Exception as e:
+                    self._fail(email['id'], f"An error occurred while sending the reply: {e}")
+                    continue
+                finally:
+                    deliver_queue.task_done(priority)
+                self._delivered(email, outcome)
+                to_label.append(email['id'])
+                if len(to_label) >= LABEL_BATCH_SIZE:
+                    self._label(to_label)
+                    to_label = []
+        finally:
+            # Label whatever was delivered, even if we are stopping early
+            self._label(to_label)
+            self.elapsed = time.perf_counter() - started
+
+        self._report()
+        return self.outcomes
+
+    def _fetch_stage(self, msg_ids, processed_label_id, analyze_queue):
+        try:
+            for start in range(0, len(msg_ids), self.fetch_chunk_size):
+                chunk = msg_ids[start:start + self.fetch_chunk_size]
+                fetched, failed_ids = batch_get_messages(self.fetch_service, 'me', chunk)
+                emails = self._parse_fetched(chunk, fetched, failed_ids, processed_label_id)
+                self._fill_thread_history(self.fetch_service, emails)
+                emails = self._prepare(emails)
+                for email in emails:
+                    # Blocks while the LLM stage is busy, so we never fetch far ahead of it
+                    analyze_queue.put(email, email['priority'], email['fetched_at'])
+        except Exception as e:
+            logger.error("Fetching emails failed", extra={"error": str(e)})
+        finally:
+            analyze_queue.close()
+
+    def _analyze_stage(self, analyze_queue, deliver_queue):
+        while True:
+            entry = analyze_queue.get()
+            if entry is None:
+                if self._worker_finished():
+                    deliver_queue.close()
+                return
+            email, priority = entry
+            try:
+                analysis = self._stored_analysis(email)
+                if analysis is None:
+                    analysis = self.analyze(email)
+                    error = self._analysis_error(email, analysis)
+                    if error:
+                        self._fail(email['id'], error)
+                        continue
+                    self._store_analysis(email, analysis)
+            except Exception as e:
+                self._fail(email['id'], f"An error occurred while analyzing message ID {email['id']}: {e}")
+                continue
+            finally:
+                analyze_queue.task_done(priority)
+            email['priority'] = self._priority(email, analysis)
+            deliver_queue.put((email, analysis), email['priority'], email['fetched_at'])
+
+
+class AsyncEmailPipeline(_PipelineBase):
+    """
+    The asyncio version of EmailPipeline, used by the server so it never blocks the event loop.
+
+    analyze must be a coroutine function. Every Gmail call (fetching, deliver()
+    and labeling) runs on gmail_executor. It may have several threads: the
+    Gmail service gives every thread its own connection.
+    """
+
+    def __init__(self, service, parse, analyze, deliver, gmail_executor, **kwargs):
+        super().__init__(service, parse, analyze, deliver, **kwargs)
+        self.gmail_executor = gmail_executor
+
+    async def run(self, msg_ids):
+        """Runs all stages over msg_ids and returns the list of outcome strings."""
+        started = time.perf_counter()
+        analyze_queue = AsyncPriorityScheduler(self.priority_window, self.llm_workers)
+        deliver_queue = AsyncPriorityScheduler(self.queue_size)
+        self._workers_left = self.llm_workers
+        processed_label_id = await self._gmail(get_label_id, self.service, 'me', self.label_name)
+        msg_ids, sent_ids = self._already_sent(msg_ids)
+        await self._gmail(self._label, sent_ids)
+        self.skipped_ids.extend(sent_ids)
+
+        tasks = [asyncio.create_task(self._fetch_stage(msg_ids, processed_label_id, analyze_queue))]
+        tasks += [
+            asyncio.create_task(self._analyze_stage(analyze_queue, deliver_queue))
+            for _ in range(self.llm_workers)
+        ]
+        try:
+            await self._deliver_stage(deliver_queue)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.elapsed = time.perf_counter() - started
+
+        self._report()
+        return self.outcomes
+
+    async def _gmail(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.gmail_executor, func, *args)
+
+    async def _fetch_stage(self, msg_ids, processed_label_id, analyze_queue):
+        try:
+            for start in range(0, len(msg_ids), self.fetch_chunk_size):
+                chunk = msg_ids[start:start + self.fetch_chunk_size]
+                fetched, failed_ids = await self._gmail(batch_get_messages, self.service, 'me', chunk)
+                emails = self._parse_fetched(chunk, fetched, failed_ids, processed_label_id)
+                await self._gmail(self._fill_thread_history, self.service, emails)
+                emails = await asyncio.to_thread(self._prepare, emails)
+                for email in emails:
+                    # Waits while the LLM stage is busy, so we never fetch far ahead of it
+                    await analyze_queue.put(email, email['priority'], email['fetched_at'])
+        except Exception as e:
+            logger.error("Fetching emails failed", extra={"error": str(e)})
+        finally:
+            await analyze_queue.close()
+
+    async def _analyze_stage(self, analyze_queue, deliver_queue):
+        while True:
+            entry = await analyze_queue.get()
+            if entry is None:
+                if self._worker_finished():
+                    await deliver_queue.close()
+                return
+            email, priority = entry
+            try:
+                analysis = self._stored_analysis(email)
+                if analysis is None:
+                    analysis = await self.analyze(email)
+                    error = self._analysis_error(email, analysis)
+                    if error:
+                        self._fail(email['id'], error)
+                        continue
+                    self._store_analysis(email, analysis)
+            except Exception as e:
+                self._fail(email['id'], f"An error occurred while analyzing message ID {email['id']}: {e}")
+                continue
+            finally:
+                await analyze_queue.task_done(priority)
+            email['priority'] = self._priority(email, analysis)
+            await deliver_queue.put((email, analysis), email['priority'], email['fetched_at'])
+
+    async def _deliver_stage(self, deliver_queue):
+        to_label = []
+        try:
+            while True:
+                entry = await deliver_queue.get()
+                if entry is None:
+                    break
+                (email, analysis), priority = entry
+                try:
+                    outcome = await self._gmail(self.deliver, self.service, email, analysis)
+                except Exception as e:
+                    self._fail(email['id'], f"An error occurred while sending the reply: {e}")
+                    continue
+                finally:
+                    await deliver_queue.task_done(priority)
+                self._delivered(email, outcome)
+                to_label.append(email['id'])
+                if len(to_label) >= LABEL_BATCH_SIZE:
+                    await self._gmail(self._label, to_label)
+                    to_label = []
+        finally:
+            # Label whatever was delivered, even if we are stopping early
+            await self._gmail(self._label, to_label)
@@ -1,20 +1,231 @@
-import chromadb
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
 
-client = chromadb.PersistentClient(path="my_knowledge_base")
+from metrics import inc, stage
 
+# --- Retrieval settings ---
+# How many candidates the vector search and the keyword search each contribute
+RAG_CANDIDATES = 20
+# At most this many notes are returned per email...
+RAG_MAX_RESULTS = int(os.environ.get("RAG_MAX_RESULTS", "4"))
+# ...only notes scoring at least this much (0 to 1)...
+RAG_MIN_SCORE = float(os.environ.get("RAG_MIN_SCORE", "0.35"))
+# ...and only notes scoring at least this fraction of the best note, so a clear match is not padded with weak ones
+RAG_RELATIVE_CUTOFF = 0.75
+# How much of the score comes from BM25 keyword matching; the rest is embedding similarity
+RAG_BM25_WEIGHT = float(os.environ.get("RAG_BM25_WEIGHT", "0.3"))
+# How many query embeddings are kept in memory
+RAG_QUERY_CACHE_SIZE = 512
+# Only this much of an email is used as the query; the start of an email says what it is about
+RAG_QUERY_MAX_CHARS = 2000
+# Where the notes are stored. Every account (see tenants) has a collection of its own in the same
+# database; the default account keeps the original one.
+KNOWLEDGE_BASE_DIR = "my_knowledge_base"
+KNOWLEDGE_COLLECTION = "personal_knowledge"
 
-# Now, instead of get_collection, it's safer to use get_or_create_collection
-# This won't cause an error if the collection doesn't exist yet.
-collection = client.get_or_create_collection(name="personal_knowledge")
+# Common words that would make every note a keyword match
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "for", "from", "have", "hi", "i", "in",
+    "is", "it", "me", "my", "of", "on", "or", "please", "re", "so", "that", "the", "this", "to", "was",
+    "we", "what", "when", "where", "which", "who", "will", "with", "you", "your",
+}
 
-def query_rag(query_text):
-    """Queries the RAG knowledge base for relevant documents."""
-    # Query the collection
-    results = collection.query(
-        query_texts=[query_text],
-        n_results=2  # Ask for the top 2 most relevant results
+def tokenize(text):
+    """Splits text into lowercase keyword tokens, without stopwords."""
+    return [token for token in re.findall(r"[a-z0-9]+", text.lower()) if token not in STOPWORDS]
+
+class BM25Index:
+    """An Okapi BM25 keyword index over the chunks of the knowledge base."""
+
+    def __init__(self, ids, documents, k1=1.5, b=0.75):
+        self.ids = list(ids)
+        self.documents = list(documents)
+        self.k1 = k1
+        self.b = b
+        # term -> [(document index, term frequency)]
+        self.postings = {}
+        self.lengths = []
+        for index, document in enumerate(self.documents):
+            tokens = tokenize(document)
+            self.lengths.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                self.postings.setdefault(token, []).append((index, count))
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+
+    def search(self, query_text, n_results):
+        """Returns up to n_results (document index, score) pairs, best first."""
+        total = len(self.documents)
+        scores = {}
+        for token in set(tokenize(query_text)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for index, count in postings:
+                length_norm = 1 - self.b + self.b * self.lengths[index] / (self.average_length or 1)
+                scores[index] = scores.get(index, 0.0) + idf * count * (self.k1 + 1) / (count + self.k1 * length_norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:n_results]
+
+# The database and the embedding model are opened on first use, not on import,
+# so starting the assistant or the server does not wait for Chroma and torch
+_client = None
+_collections = {}
+_collection_lock = threading.Lock()
+# Collection name -> (BM25Index, the collection_version it was built from)
+_bm25_indexes = {}
+_bm25_lock = threading.Lock()
+_query_cache = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+def collection_name(account=None):
+    """The name of the collection holding an account's notes."""
+    if account is None or account == "default":
+        return KNOWLEDGE_COLLECTION
+    return f"{KNOWLEDGE_COLLECTION}_{account}"
+
+def get_collection(account=None):
+    """Returns the knowledge base collection of an account, opening the database the first time."""
+    global _client
+    name = collection_name(account)
+    with _collection_lock:
+        if name not in _collections:
+            import chromadb
+            from embedding_service import get_embedding_function
+            if _client is None:
+                _client = chromadb.PersistentClient(path=KNOWLEDGE_BASE_DIR)
+            # Now, instead of get_collection, it's safer to use get_or_create_collection
+            # This won't cause an error if the collection doesn't exist yet.
+            # Every collection embeds with the one shared model, so notes and queries stay comparable
+            _collections[name] = _client.get_or_create_collection(name=name, embedding_function=get_embedding_function())
+        return _collections[name]
+
+def manifest_path(account=None):
+    """The manifest of an account's collection (see knowledge_ingest), kept next to the database."""
+    from knowledge_ingest import MANIFEST_FILE
+    if account is None or account == "default":
+        return os.path.join(KNOWLEDGE_BASE_DIR, MANIFEST_FILE)
+    return os.path.join(KNOWLEDGE_BASE_DIR, f"{collection_name(account)}_{MANIFEST_FILE}")
+
+def collection_version(account=None):
+    """
+    Changes whenever the notes of an account change: every sync rewrites the manifest, and
+    chunks added or removed by other means change the count. Cheap enough for every lookup.
+    """
+    try:
+        manifest_mtime = os.stat(manifest_path(account)).st_mtime_ns
+    except OSError:
+        manifest_mtime = None
+    return get_collection(account).count(), manifest_mtime
+
+def get_bm25_index(account=None):
+    """Returns the keyword index of an account's notes, rebuilt whenever its chunks have changed."""
+    with _bm25_lock:
+        collection = get_collection(account)
+        version = collection_version(account)
+        index, built_version = _bm25_indexes.get(collection.name, (None, None))
+        if index is None or built_version != version:
+            results = collection.get(include=["documents"])
+            index = BM25Index(results["ids"], results["documents"])
+            _bm25_indexes[collection.name] = (index, version)
+        return index
+
+def embed_queries(query_texts):
+    """Embeds query texts in one call, reusing the embeddings of recently seen queries."""
+    from embedding_service import get_embedding_service, text_hash
+    hashes = [text_hash(text) for text in query_texts]
+    with _query_cache_lock:
+        found = {h: _query_cache[h] for h in hashes if h in _query_cache}
+        for h in found:
+            _query_cache.move_to_end(h)
+
+    missing = {}
+    for h, text in zip(hashes, query_texts):
+        if h not in found and h not in missing:
+            missing[h] = text
+    inc("cache_lookups_total", len(query_texts) - len(missing), cache="rag_query", result="hit")
+    inc("cache_lookups_total", len(missing), cache="rag_query", result="miss")
+    if missing:
+        # Emails are rarely seen twice, so they stay out of the on-disk embedding cache
+        vectors = get_embedding_service().encode(list(missing.values()), use_cache=False)
+        with _query_cache_lock:
+            for h, vector in zip(missing, vectors):
+                found[h] = vector
+                _query_cache[h] = vector
+            while len(_query_cache) > RAG_QUERY_CACHE_SIZE:
+                _query_cache.popitem(last=False)
+    return [found[h] for h in hashes]
+
+def select_results(scored, max_results=RAG_MAX_RESULTS, min_score=RAG_MIN_SCORE):
+    """Picks the documents worth putting in the prompt from (score, document) pairs, best first."""
+    scored = sorted(scored, key=lambda item: item[0], reverse=True)
+    if not scored or scored[0][0] < min_score:
+        return []
+    cutoff = max(min_score, scored[0][0] * RAG_RELATIVE_CUTOFF)
+    return [document for score, document in scored[:max_results] if score >= cutoff]
+
+@stage("retrieve")
+def retrieve_notes(query_texts, max_results=RAG_MAX_RESULTS, min_score=RAG_MIN_SCORE, account=None):
+    """
+    Looks up the notes relevant to each of several queries (e.g. a batch of emails),
+    in the knowledge base of the given account.
+
+    All queries are embedded in one call and searched in one Chroma query. Each
+    note is scored by a mix of embedding similarity and BM25 keyword matching,
+    so exact names and numbers count too. Returns one list of notes per query,
+    which may be empty if nothing is relevant enough.
+    """
+    query_texts = [text[:RAG_QUERY_MAX_CHARS] for text in query_texts]
+    if not query_texts:
+        return []
+    index = get_bm25_index(account)
+    if not index.documents:
+        return [[] for _ in query_texts]
+
+    n_candidates = min(RAG_CANDIDATES, len(index.documents))
+    vector_results = get_collection(account).query(
+        query_embeddings=embed_queries(query_texts),
+        n_results=n_candidates,
+        include=["documents", "distances"],
     )
-    return results['documents'][0]
+
+    all_results = []
+    for position, query_text in enumerate(query_texts):
+        # The embeddings are normalized, so the squared L2 distance Chroma returns is 2 - 2 * cosine
+        similarity = {}
+        documents = {}
+        for doc_id, document, distance in zip(vector_results["ids"][position],
+                                              vector_results["documents"][position],
+                                              vector_results["distances"][position]):
+            similarity[doc_id] = 1 - distance / 2
+            documents[doc_id] = document
+        # A keyword match outside the vector candidates is at most as similar as the last candidate
+        similarity_floor = min(similarity.values(), default=0.0)
+
+        keyword_matches = index.search(query_text, n_candidates)
+        best_keyword_score = keyword_matches[0][1] if keyword_matches else 0.0
+        keyword_score = {}
+        for doc_index, score in keyword_matches:
+            doc_id = index.ids[doc_index]
+            keyword_score[doc_id] = score / best_keyword_score
+            documents.setdefault(doc_id, index.documents[doc_index])
+
+        scored = [
+            ((1 - RAG_BM25_WEIGHT) * similarity.get(doc_id, similarity_floor)
+             + RAG_BM25_WEIGHT * keyword_score.get(doc_id, 0.0), document)
+            for doc_id, document in documents.items()
+        ]
+        all_results.append(select_results(scored, max_results, min_score))
+    return all_results
+
+def query_rag(query_text, account=None):
+    """Queries the RAG knowledge base for relevant documents."""
+    return retrieve_notes([query_text], account=account)[0]
 
 
 if __name__ == "__main__":
@@ -33,4 +244,4 @@ if __name__ == "__main__":
     retrieved_docs2 = query_rag(query2)
     print("Retrieved Context:")
     for doc in retrieved_docs2:
-        print(f"- {doc}")
\ No newline at end of file
+        print(f"- {doc}")
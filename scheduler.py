@@ -0,0 +1,187 @@
+import asyncio
+import bisect
+import itertools
+import math
+import os
+import threading
+import time
+from collections import deque
+
+# Most urgent first
+PRIORITIES = ["high", "medium", "low"]
+# How soon (in seconds) an email of each priority should be handled after it was fetched.
+# Emails are taken earliest deadline first, so a low-priority email that has waited long
+# enough goes before newly fetched high-priority mail and is never starved.
+PRIORITY_DEADLINES = {
+    "high": int(os.environ.get("DEADLINE_HIGH", "60")),
+    "medium": int(os.environ.get("DEADLINE_MEDIUM", "600")),
+    "low": int(os.environ.get("DEADLINE_LOW", "3600")),
+}
+# The share of a stage's workers emails of each priority may occupy at once (at least one).
+# With several LLM workers, bulk mail can then never take all of them.
+PRIORITY_MAX_SHARE = {"high": 1.0, "medium": 1.0, "low": 0.5}
+# Latencies are kept for this many recent emails per priority
+LATENCY_SAMPLES = 1000
+
+_latencies = {priority: deque(maxlen=LATENCY_SAMPLES) for priority in PRIORITIES}
+_deadline_misses = {priority: 0 for priority in PRIORITIES}
+_latency_lock = threading.Lock()
+
+def normalize_priority(priority):
+    """Returns priority if it is a known one, else 'medium'."""
+    return priority if priority in PRIORITY_DEADLINES else "medium"
+
+def record_latency(priority, seconds):
+    """Records how long an email of the given priority took from being fetched to being handled."""
+    priority = normalize_priority(priority)
+    with _latency_lock:
+        _latencies[priority].append(seconds)
+        if seconds > PRIORITY_DEADLINES[priority]:
+            _deadline_misses[priority] += 1
+
+def percentile(sorted_values, fraction):
+    """The nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(math.ceil(fraction * len(sorted_values)) - 1, 0)]
+
+def get_latency_stats():
+    """Returns the count, p50/p95/p99 latency (seconds) and missed deadlines of every priority."""
+    with _latency_lock:
+        samples = {priority: sorted(values) for priority, values in _latencies.items()}
+        misses = dict(_deadline_misses)
+    return {
+        priority: {
+            "count": len(values),
+            "p50": percentile(values, 0.50),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99),
+            "deadline": PRIORITY_DEADLINES[priority],
+            "deadline_misses": misses[priority],
+        }
+        for priority, values in samples.items()
+    }
+
+def format_latency_stats():
+    """Formats the latency stats as one line per priority that has seen any email."""
+    return "\n".join(
+        f"  {priority}: {stats['count']} email(s), p50 {stats['p50']:.1f}s, p95 {stats['p95']:.1f}s, "
+        f"p99 {stats['p99']:.1f}s, {stats['deadline_misses']} over the {stats['deadline']}s deadline"
+        for priority, stats in get_latency_stats().items() if stats['count']
+    )
+
+
+class _DeadlineQueue:
+    """
+    The scheduling shared by PriorityScheduler and AsyncPriorityScheduler.
+    Not thread-safe on its own; the subclasses hold a lock around every call.
+    """
+
+    def __init__(self, maxsize, workers):
+        self.maxsize = maxsize
+        self.limits = {priority: max(1, math.ceil(workers * share)) for priority, share in PRIORITY_MAX_SHARE.items()}
+        self.running = {priority: 0 for priority in PRIORITIES}
+        self.closed = False
+        # (deadline, sequence, priority, item), earliest deadline first; the sequence keeps ties in FIFO order
+        self._entries = []
+        self._sequence = itertools.count()
+
+    def _full(self):
+        return len(self._entries) >= self.maxsize
+
+    def _push(self, item, priority, enqueued_at=None):
+        priority = normalize_priority(priority)
+        deadline = (enqueued_at or time.monotonic()) + PRIORITY_DEADLINES[priority]
+        bisect.insort(self._entries, (deadline, next(self._sequence), priority, item))
+
+    def _pop(self):
+        """Takes the entry with the earliest deadline whose priority has a free worker, or returns None."""
+        for index, (_, _, priority, item) in enumerate(self._entries):
+            if self.running[priority] < self.limits[priority]:
+                del self._entries[index]
+                self.running[priority] += 1
+                return item, priority
+        return None
+
+    def _release(self, priority):
+        self.running[normalize_priority(priority)] -= 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class PriorityScheduler(_DeadlineQueue):
+    """
+    A bounded queue between two pipeline stages that hands out work earliest deadline first.
+
+    put(item, priority) blocks while the queue is full. get() blocks until an
+    item whose priority is below its concurrency limit is waiting, and returns
+    (item, priority); call task_done(priority) when it is handled. After
+    close(), get() returns None once the queue is empty.
+    """
+
+    def __init__(self, maxsize, workers=1):
+        super().__init__(maxsize, workers)
+        self._condition = threading.Condition()
+
+    def put(self, item, priority, enqueued_at=None):
+        with self._condition:
+            self._condition.wait_for(lambda: not self._full())
+            self._push(item, priority, enqueued_at)
+            self._condition.notify_all()
+
+    def get(self):
+        with self._condition:
+            while True:
+                entry = self._pop()
+                if entry is not None:
+                    self._condition.notify_all()
+                    return entry
+                if self.closed and not self._entries:
+                    return None
+                self._condition.wait()
+
+    def task_done(self, priority):
+        with self._condition:
+            self._release(priority)
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class AsyncPriorityScheduler(_DeadlineQueue):
+    """The asyncio version of PriorityScheduler; put(), get(), task_done() and close() are coroutines."""
+
+    def __init__(self, maxsize, workers=1):
+        super().__init__(maxsize, workers)
+        self._condition = asyncio.Condition()
+
+    async def put(self, item, priority, enqueued_at=None):
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._full())
+            self._push(item, priority, enqueued_at)
+            self._condition.notify_all()
+
+    async def get(self):
+        async with self._condition:
+            while True:
+                entry = self._pop()
+                if entry is not None:
+                    self._condition.notify_all()
+                    return entry
+                if self.closed and not self._entries:
+                    return None
+                await self._condition.wait()
+
+    async def task_done(self, priority):
+        async with self._condition:
+            self._release(priority)
+            self._condition.notify_all()
+
+    async def close(self):
+        async with self._condition:
+            self.closed = True
+            self._condition.notify_all()
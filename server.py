@@ -1,109 +1,432 @@
+import asyncio
+import datetime
+import functools
+import json
+import os
+import secrets
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
 import uvicorn
-from fastapi import FastAPI, HTTPException
-from email.mime.text import MIMEText
-import base64
-from gmail_service import get_gmail_service, send_email, apply_label_to_email
-from llm_handler import classify_email_intent_local, generate_reply_local
-from rag_service import query_rag
-from main import get_email_body 
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from gmail_service import send_email_once, apply_label_to_email
+from llm_handler import LLM_MODE, generate_reply_local, get_llm_stats, backend, token_budget
+from llm_cache import get_llm_cache
+from scheduler import get_latency_stats
+from triage import estimate_priority, get_triage_stats
+from main import parse_email, prefetch_notes, analyze_email, analyze_email_async, build_reply_message, reply_message_id
+from sync_service import (GMAIL_PUBSUB_TOPIC, WATCH_RENEW_INTERVAL, AdaptivePollInterval, is_history_processed,
+                          parse_push_notification, start_watch)
+from tenants import collect_new_mail, fair_batches, get_tenant_registry, thread_store_for
+from pipeline import AsyncEmailPipeline
+from calendar_service import get_calendar_availability
+from metrics import configure_logging, get_logger, render_prometheus, stage
+
+logger = get_logger(__name__)
+
+# --- Push notifications ---
+# Pub/Sub must push to /gmail/push?token=<this>, so nobody else can trigger processing
+GMAIL_PUSH_TOKEN = os.environ.get("GMAIL_PUSH_TOKEN")
+# With push enabled, the mailbox is still polled in case a notification gets lost,
+# backing off to this interval (in seconds) while notifications keep arriving or nothing changes
+PUSH_FALLBACK_MAX_INTERVAL = int(os.environ.get("PUSH_FALLBACK_MAX_INTERVAL", "1800"))
+
+@asynccontextmanager
+async def lifespan(app):
+    """Keeps the Gmail watch alive and polls as a fallback while the server runs, if push is enabled."""
+    configure_logging()
+    task = asyncio.create_task(watch_and_poll()) if GMAIL_PUBSUB_TOPIC else None
+    yield
+    if task:
+        task.cancel()
 
 app = FastAPI(
     title="Intelligent Mail Assistant API",
     description="An API to process incoming emails, generate replies using an LLM, and send them.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
-def process_email_for_server(service, message_info):
+def send_reply_for_server(service, email, analysis):
+    """
+    Sends the drafted reply for an analyzed email automatically, without user input.
+    Returns a string describing the outcome. Raises if the LLM failed, so the email
+    is not labeled and gets retried.
+    """
+    classification = analysis['classification']
+    reply_body = analysis['reply_body']
+    if not classification:
+        raise RuntimeError("The email could not be classified")
+    outcome = f"Classification: {classification.get('intent', 'unknown')}. "
+
+    if classification.get('intent') != 'spam':
+        if not reply_body and analysis.get('deferred'):
+            # The command-line assistant left the reply to be streamed (STREAM_REPLIES) and stopped
+            # before writing it; the work queue handed the email over to us, so write it now
+            reply_body = generate_reply_local(email['content_for_llm'], classification.get('intent'),
+                                              context=analysis.get('context'))
+        if not reply_body:
+            raise RuntimeError("Reply generation failed")
+        # The server sends the email automatically, but never the same reply twice
+        if send_email_once(service, 'me', build_reply_message(email, reply_body)) is None:
+            raise RuntimeError("The reply could not be sent")
+        thread_store_for(email).record_reply(email, reply_message_id(email), reply_body)
+        outcome += "AI-generated reply sent."
+    else:
+        outcome += "Email classified as spam. No action taken."
+    return outcome
+
+def process_email_for_server(service, message_info, message_data=None, apply_label=True):
     """
     Contains the logic to process one single email automatically without user input.
     Returns a string describing the outcome.
     """
     msg_id = message_info['id']
-    message_data = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-
-    email_content = get_email_body(message_data)
-    original_sender = next((h['value'] for h in message_data['payload']['headers'] if h['name'].lower() == 'from'), 'No Sender')
-    original_subject = next((h['value'] for h in message_data['payload']['headers'] if h['name'].lower() == 'subject'), 'No Subject')
-
-    outcome = f"Processing email from: {original_sender} | Subject: {original_subject}. "
-
-    email_content_for_llm = f"Subject: {original_subject}\nFrom: {original_sender}\n\n{email_content}"
-    classification = classify_email_intent_local(email_content_for_llm)
-    
-    outcome += f"Classification: {classification.get('intent', 'unknown')}. "
-
-    if classification and classification.get('intent') != 'spam':
-        intent = classification.get('intent')
-        context_for_llm = None
-        
-        if intent == 'information_request':
-            retrieved_docs = query_rag(email_content_for_llm)
-            if retrieved_docs:
-                context_for_llm = "Relevant notes:\n" + "\n".join(retrieved_docs)
-
-        reply_body = generate_reply_local(email_content_for_llm, intent, context=context_for_llm)
-        
-        if reply_body:
-            # The server sends the email automatically
-            message = MIMEText(reply_body)
-            message['to'] = original_sender
-            message['subject'] = f"Re: {original_subject}"
-            original_msg_id_header = next((h['value'] for h in message_data['payload']['headers'] if h['name'].lower() == 'message-id'), '')
-            if original_msg_id_header:
-                message['In-Reply-To'] = original_msg_id_header
-                message['References'] = original_msg_id_header
-            
-            send_email(service, 'me', message)
-            outcome += "AI-generated reply sent."
-        else:
-            outcome += "Reply generation failed."
-    else:
-        outcome += "Email classified as spam or could not be classified. No action taken."
+    if message_data is None:
+        with stage("get"):
+            message_data = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+
+    email = parse_email(message_data)
+    outcome = f"Processing email from: {email['sender']} | Subject: {email['subject']}. "
+    outcome += send_reply_for_server(service, email, analyze_email(email, calendar=get_calendar_availability(service)))
 
     # Apply the label to prevent re-processing
-    apply_label_to_email(service, 'me', msg_id, 'ProcessedByAI')
+    if apply_label:
+        apply_label_to_email(service, 'me', msg_id, 'ProcessedByAI')
     return outcome
 
 
-@app.post("/process-emails")
+# --- Background processing jobs ---
+# Gmail calls run on this small pool, which keeps the blocking googleapiclient calls off the event loop.
+# Every thread gets its own connection (gmail_service.pooled_http) and the shared caches hold locks, so
+# fetching the next batch can overlap sending a reply; the quota bucket still paces them per user.
+GMAIL_THREADS = int(os.environ.get("GMAIL_THREADS", "4"))
+gmail_executor = ThreadPoolExecutor(max_workers=GMAIL_THREADS, thread_name_prefix="gmail")
+
+# Recent jobs by ID, oldest first. Only the last MAX_JOBS are kept.
+MAX_JOBS = 100
+jobs = OrderedDict()
+# The ID of the job that is currently processing the mailbox, if any
+_running_job_id = None
+# Set when a check of every account is asked for during a job; the job then runs once more when it finishes
+_rerun_requested = False
+# The accounts that got a notification during a job; they are processed once more when it finishes
+_rerun_tenants = set()
+# When the last push notification arrived (time.monotonic())
+_last_push_at = None
+
+async def run_in_gmail_thread(func, *args):
+    """Runs a blocking Gmail call on a Gmail thread and waits for it without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(gmail_executor, func, *args)
+
+async def process_mailbox(job, tenants=None):
+    """Processes all new mail of the given accounts (every account if None) for a job, updating the job as it goes."""
+    global _running_job_id, _rerun_requested, _rerun_tenants
+    job['status'] = "running"
+    try:
+        # Each account's Gmail service is built once and reused, so per-service caches such as
+        # the label registry in gmail_service are shared by every job of that account
+        tenants = tenants or get_tenant_registry().tenants()
+        # Only look at messages added since the last run (or everything unprocessed on the first run)
+        ready_ids = {}
+        errors = []
+        for tenant in tenants:
+            try:
+                ready_ids[tenant] = await run_in_gmail_thread(collect_new_mail, tenant)
+            except Exception as e:
+                # One account failing (e.g. a revoked token) does not hold up the others
+                logger.exception("Could not check for new mail", extra={"account": tenant.name, "error": str(e)})
+                errors.append(f"{tenant.name}: {e}")
+        if not ready_ids:
+            raise RuntimeError(f"Could not connect to Gmail service. {'; '.join(errors)}")
+
+        total = sum(len(msg_ids) for msg_ids in ready_ids.values())
+        if not total:
+            job['message'] = "No new mail to process."
+        else:
+            loop = asyncio.get_running_loop()
+
+            async def analyze(email, calendar=None):
+                publish_event(job, 'email', {'id': email['id'], 'account': email.get('account'),
+                                             'sender': email['sender'], 'subject': email['subject']})
+                # The reply is streamed so /jobs/{job_id}/stream listeners see it as it is written
+                analysis = await analyze_email_async(
+                    email, on_token=lambda text: publish_event(job, 'token', {'id': email['id'], 'text': text}),
+                    calendar=calendar
+                )
+                publish_event(job, 'draft', {'id': email['id'], 'classification': analysis['classification'], 'reply': analysis['reply_body']})
+                return analysis
+
+            def deliver(service, email, analysis):
+                try:
+                    outcome = send_reply_for_server(service, email, analysis)
+                except Exception as e:
+                    outcome = f"An error occurred while sending the reply: {e}"
+                    raise
+                finally:
+                    # This runs on a Gmail thread, so hand the event over to the event loop
+                    loop.call_soon_threadsafe(publish_event, job, 'outcome', {'id': email['id'], 'outcome': outcome})
+                return outcome
+
+            # Load the model while the first emails are being fetched
+            asyncio.create_task(backend.awarm_up())
+            job['emails'] = total
+            processed = 0
+            # The accounts take turns, a batch each, so a flooded inbox cannot starve the others
+            for tenant, msg_ids in fair_batches(ready_ids):
+                # May refresh the account's credentials, which is blocking I/O, so not on the event loop
+                service = await run_in_gmail_thread(tenant.get_service)
+                # Free/busy is fetched once per account and answered from memory for every meeting request
+                calendar = get_calendar_availability(service)
+                # Fetching, LLM work and sending overlap in a staged pipeline
+                pipeline = AsyncEmailPipeline(service, parse_email, functools.partial(analyze, calendar=calendar), deliver,
+                                              gmail_executor, prepare=prefetch_notes, work_queue=tenant.work_queue(),
+                                              prioritize=estimate_priority, thread_store=tenant.thread_store(),
+                                              account=tenant.name)
+                await pipeline.run(msg_ids)
+                job['details'].extend(pipeline.outcomes)
+                processed += len(pipeline.processed_ids)
+            for tenant in ready_ids:
+                tenant.work_queue().prune()
+                tenant.thread_store().prune()
+            job['message'] = f"Processed {processed} of {total} email(s) in {len(ready_ids)} account(s)."
+        job['status'] = "succeeded"
+
+    except Exception as e:
+        logger.exception("Processing emails failed", extra={"job_id": job['job_id'], "error": str(e)})
+        job['status'] = "failed"
+        job['message'] = f"An internal error occurred: {str(e)}"
+    finally:
+        job['finished_at'] = datetime.datetime.now().isoformat()
+        _running_job_id = None
+        publish_event(job, 'done', job_summary(job))
+        # Mail that arrived while this job was running may not have been part of it
+        if _rerun_requested or _rerun_tenants:
+            rerun_tenants = None if _rerun_requested else sorted(_rerun_tenants, key=lambda tenant: tenant.name)
+            _rerun_requested = False
+            _rerun_tenants = set()
+            start_processing_job(rerun_tenants)
+
+def start_processing_job(tenants=None):
+    """
+    Starts a background job that processes the new mail of the given accounts (every account
+    if None) and returns it. If a job is already running, that job is returned instead of
+    starting a second one.
+    """
+    global _running_job_id
+    if _running_job_id is not None:
+        return jobs[_running_job_id], False
+
+    job = {
+        "job_id": uuid.uuid4().hex,
+        "status": "queued",
+        "started_at": datetime.datetime.now().isoformat(),
+        "finished_at": None,
+        "message": None,
+        "accounts": None if tenants is None else [tenant.name for tenant in tenants],
+        "emails": 0,
+        "details": [],
+        # Queues of the /jobs/{job_id}/stream clients following this job
+        "listeners": [],
+    }
+    jobs[job['job_id']] = job
+    while len(jobs) > MAX_JOBS:
+        jobs.popitem(last=False)
+
+    # Claim the mailbox before yielding to the event loop, so overlapping triggers see it
+    _running_job_id = job['job_id']
+    job['task'] = asyncio.create_task(process_mailbox(job, tenants))
+    return job, True
+
+def request_processing(tenant=None):
+    """
+    Starts a job for the new mail of an account (every account if None), or makes the
+    running job go once more for it when it is done.
+    """
+    global _rerun_requested
+    job, started = start_processing_job(None if tenant is None else [tenant])
+    if not started:
+        if tenant is None:
+            _rerun_requested = True
+        else:
+            _rerun_tenants.add(tenant)
+    return job, started
+
+async def watch_and_poll():
+    """
+    Renews the Gmail watch of every account every WATCH_RENEW_INTERVAL, and polls the
+    mailboxes as a fallback. The fallback poll is skipped while push notifications are
+    arriving, and backs off while polls find nothing.
+    """
+    poll_interval = AdaptivePollInterval(max_interval=PUSH_FALLBACK_MAX_INTERVAL)
+    wait = poll_interval.current
+    # Account name -> when its watch is due for renewal
+    renew_at = {}
+    while True:
+        for tenant in get_tenant_registry().tenants():
+            if time.time() < renew_at.get(tenant.name, 0):
+                continue
+            try:
+                service = await run_in_gmail_thread(tenant.get_service)
+                _, expiration = await run_in_gmail_thread(start_watch, service, GMAIL_PUBSUB_TOPIC)
+                # Renew well before the watch expires
+                renew_at[tenant.name] = min(time.time() + WATCH_RENEW_INTERVAL, expiration - 3600)
+                logger.info("Gmail watch active", extra={
+                    "account": tenant.name, "topic": GMAIL_PUBSUB_TOPIC,
+                    "until": datetime.datetime.fromtimestamp(expiration).isoformat()
+                })
+            except Exception as e:
+                logger.warning("Could not start the Gmail watch, retrying in 5 minutes and polling meanwhile",
+                               extra={"account": tenant.name, "error": str(e)})
+                renew_at[tenant.name] = time.time() + 300
+
+        await asyncio.sleep(wait)
+        if _last_push_at is not None and time.monotonic() - _last_push_at < wait:
+            # Notifications are getting through, so polling is not needed
+            wait = poll_interval.next(found_mail=False)
+            continue
+        job, _ = request_processing()
+        await asyncio.shield(job['task'])
+        wait = poll_interval.next(found_mail=job['emails'] > 0)
+
+def job_summary(job):
+    """The parts of a job that are returned by the API."""
+    return {key: value for key, value in job.items() if key not in ('task', 'listeners')}
+
+def publish_event(job, event, data):
+    """Sends a progress event to every client streaming the job."""
+    for listener in job['listeners']:
+        listener.put_nowait((event, data))
+
+def format_sse(event, data):
+    """Formats one Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/process-emails", status_code=202)
 async def trigger_email_processing():
     """
-    This endpoint triggers a one-time check for new emails.
-    It finds all unread emails, processes them, sends replies, and applies a label.
+    This endpoint triggers a one-time check for new emails in the background.
+    It returns a job ID straight away; use /jobs/{job_id} to follow its progress.
+    If a check is already running, its job is returned instead of starting another one.
+    """
+    logger.info("API endpoint /process-emails triggered")
+    job, started = start_processing_job()
+    return {
+        "status": "accepted" if started else "already_running",
+        "job_id": job['job_id'],
+    }
+
+
+@app.post("/gmail/push", status_code=204)
+async def receive_gmail_push(request: Request, token: str = ""):
+    """
+    Receives Gmail push notifications from a Pub/Sub push subscription and processes the
+    new mail of the notified account in the background. A notification carries the account's
+    new history ID, so its history is synced from the last saved history ID up to there.
+    Notifications for changes that were already processed are ignored.
+    Pub/Sub only needs a quick 2xx; anything else makes it deliver again.
     """
-    print("API endpoint /process-emails triggered.")
+    global _last_push_at
+    if GMAIL_PUSH_TOKEN and not secrets.compare_digest(token, GMAIL_PUSH_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid push token.")
     try:
-        service = get_gmail_service()
-        if not service:
-            raise HTTPException(status_code=500, detail="Could not connect to Gmail service.")
-
-        results = service.users().messages().list(
-            userId='me', 
-            labelIds=['INBOX'],
-            q="-label:ProcessedByAI"
-        ).execute()
-        
-        messages_to_process = results.get('messages', [])
-        
-        if not messages_to_process:
-            return {"status": "success", "message": "No new mail to process."}
-
-        processing_outcomes = []
-        for message_info in messages_to_process:
-            outcome = process_email_for_server(service, message_info)
-            processing_outcomes.append(outcome)
-            print(f"-> {outcome}")
-
-        return {
-            "status": "success",
-            "message": f"Processed {len(messages_to_process)} email(s).",
-            "details": processing_outcomes
-        }
+        email_address, history_id = parse_push_notification(await request.json())
+    except ValueError as e:
+        # Acknowledged anyway: delivering it again would not make it readable
+        logger.warning("Ignoring push notification", extra={"error": str(e)})
+        return Response(status_code=204)
+
+    # Every account's watch pushes to the same topic; the address says whose mailbox changed
+    tenant = await run_in_gmail_thread(get_tenant_registry().find_by_email, email_address)
+    if tenant is None:
+        logger.warning("Ignoring push notification for an unknown account", extra={"email_address": email_address})
+        return Response(status_code=204)
+    # Only notifications for our accounts show that push works and the fallback poll can wait
+    _last_push_at = time.monotonic()
+    if is_history_processed(history_id, state_file=tenant.sync_state_file):
+        return Response(status_code=204)
+    logger.info("Push notification", extra={"account": tenant.name, "email_address": email_address,
+                                            "history_id": history_id})
+    request_processing(tenant)
+    return Response(status_code=204)
 
-    except Exception as e:
-        print(f"An unexpected error occurred in the API endpoint: {e}")
-        raise HTTPException(status_code=500, detail=f"An internal server error occurred: {str(e)}")
 
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """Returns the status and outcomes of a processing job."""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job_summary(job)
+
+
+@app.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str):
+    """
+    Streams the progress of a processing job (started with POST /process-emails) as
+    Server-Sent Events: 'job' first, with the job as it is so far, then 'email', 'token'
+    (pieces of the reply as they are written), 'draft' and 'outcome' for each email,
+    and 'done' with the job summary. A finished job only gets 'job' and 'done'.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    listener = asyncio.Queue()
+    if job['finished_at'] is None:
+        job['listeners'].append(listener)
+    else:
+        listener.put_nowait(('done', job_summary(job)))
+
+    async def events():
+        try:
+            # What happened before the client connected is in the job's details
+            yield format_sse('job', job_summary(job))
+            while True:
+                event, data = await listener.get()
+                yield format_sse(event, data)
+                if event == 'done':
+                    return
+        finally:
+            # The job keeps running if the client goes away
+            if listener in job['listeners']:
+                job['listeners'].remove(listener)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/llm-stats")
+async def get_llm_usage():
+    """
+    Returns LLM token counts and latency per mode, to compare the two-pass and single-pass modes,
+    the load/eval timings reported by Ollama, the prompt tokens used per stage, the hit rate of
+    the LLM result cache, the share of emails the triage stage settled without the LLM, the
+    work queue of every account, and the latency percentiles of every priority.
+    """
+    llm_cache = get_llm_cache()
+    return {
+        "mode": LLM_MODE,
+        "triage": get_triage_stats(),
+        "stats": get_llm_stats(),
+        "ollama": backend.get_metrics(),
+        "prompt_budgets": token_budget.stats(),
+        "cache": llm_cache.stats() if llm_cache else None,
+        "work_queue": {tenant.name: tenant.work_queue().stats() for tenant in get_tenant_registry().tenants()},
+        "latency_by_priority": get_latency_stats(),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Returns the stage timings, Gmail API call and error counts, Ollama token counts and
+    durations and cache hit counts in the Prometheus text format, for scraping.
+    """
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+import base64
+import json
+import os
+from googleapiclient.errors import HttpError
+
+from metrics import get_logger, stage
+
+logger = get_logger(__name__)
+
+# The sync state (last seen historyId and messages still waiting to be processed)
+# is kept next to token.json so every poll only has to look at new mail.
+SYNC_STATE_FILE = "sync_state.json"
+
+# --- Push notifications ---
+# The Pub/Sub topic Gmail publishes inbox changes to, e.g. "projects/my-project/topics/gmail".
+# Gmail needs publish rights on it (grant them to gmail-api-push@system.gserviceaccount.com).
+GMAIL_PUBSUB_TOPIC = os.environ.get("GMAIL_PUBSUB_TOPIC")
+# A watch expires after 7 days; Google recommends renewing it once a day
+WATCH_RENEW_INTERVAL = 24 * 3600
+
+# --- Polling ---
+# Poll this often while mail keeps arriving...
+POLL_MIN_INTERVAL = int(os.environ.get("POLL_MIN_INTERVAL", "60"))
+# ...and back off to this while the mailbox is idle
+POLL_MAX_INTERVAL = int(os.environ.get("POLL_MAX_INTERVAL", "600"))
+
+def load_sync_state(state_file=SYNC_STATE_FILE):
+    """Loads the saved sync state, or an empty state if there is none yet."""
+    if not os.path.exists(state_file):
+        return {}
+    try:
+        with open(state_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as error:
+        logger.warning("Could not read the sync state, starting a full sync",
+                       extra={"state_file": state_file, "error": str(error)})
+        return {}
+
+def save_sync_state(history_id, pending_ids=(), state_file=SYNC_STATE_FILE):
+    """Saves the history ID to continue from and the messages that still need processing."""
+    state = {"history_id": history_id, "pending_ids": list(pending_ids)}
+    # Write to a temporary file first so a crash never leaves a half-written state behind
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_file, state_file)
+
+@stage("list")
+def list_unprocessed_message_ids(service, user_id='me'):
+    """Lists every inbox message without the 'ProcessedByAI' label, following all result pages."""
+    msg_ids = []
+    page_token = None
+    while True:
+        results = service.users().messages().list(
+            userId=user_id,
+            labelIds=['INBOX'],
+            q="-label:ProcessedByAI",
+            maxResults=500,
+            pageToken=page_token
+        ).execute()
+        msg_ids.extend(m['id'] for m in results.get('messages', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return msg_ids
+
+@stage("list")
+def list_added_message_ids(service, user_id, start_history_id):
+    """Lists the inbox messages added since start_history_id.
+
+    Returns:
+      A tuple (msg_ids, history_id) where history_id is the mailbox's latest history ID.
+      Raises HttpError with status 404 if start_history_id is too old.
+    """
+    msg_ids = []
+    page_token = None
+    while True:
+        results = service.users().history().list(
+            userId=user_id,
+            startHistoryId=start_history_id,
+            historyTypes=['messageAdded'],
+            labelId='INBOX',
+            pageToken=page_token
+        ).execute()
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message = added['message']
+                if 'INBOX' in message.get('labelIds', []):
+                    msg_ids.append(message['id'])
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return msg_ids, results.get('historyId', start_history_id)
+
+def get_new_message_ids(service, user_id='me', state_file=SYNC_STATE_FILE):
+    """Finds the messages that need processing since the previous run.
+
+    Uses users().history().list when a history ID was saved, and falls back to a
+    full paginated scan on the first run or when the saved history has expired.
+    Once the messages are handled, pass the returned history ID and whatever is
+    left unprocessed to save_sync_state().
+
+    Returns:
+      A tuple (msg_ids, history_id).
+    """
+    state = load_sync_state(state_file)
+    pending_ids = state.get("pending_ids", [])
+    start_history_id = state.get("history_id")
+
+    if start_history_id:
+        try:
+            new_ids, history_id = list_added_message_ids(service, user_id, start_history_id)
+            logger.info("Incremental sync", extra={"new_messages": len(new_ids), "since_history_id": start_history_id})
+            return list(dict.fromkeys(pending_ids + new_ids)), history_id
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+            logger.info("Saved history ID has expired, falling back to a full scan")
+
+    # Read the current history ID before scanning, so mail arriving during the scan is not missed
+    history_id = service.users().getProfile(userId=user_id).execute()['historyId']
+    msg_ids = list_unprocessed_message_ids(service, user_id)
+    logger.info("Full scan", extra={"unprocessed_messages": len(msg_ids)})
+    return list(dict.fromkeys(pending_ids + msg_ids)), history_id
+
+def start_watch(service, topic_name, user_id='me'):
+    """Asks Gmail to publish a notification to topic_name whenever the inbox changes.
+
+    Calling it again renews the watch.
+
+    Returns:
+      A tuple (history_id, expiration) with the expiration as a Unix timestamp.
+    """
+    response = service.users().watch(
+        userId=user_id,
+        body={'topicName': topic_name, 'labelIds': ['INBOX'], 'labelFilterBehavior': 'INCLUDE'}
+    ).execute()
+    return response['historyId'], int(response['expiration']) / 1000
+
+def parse_push_notification(body):
+    """Reads (email_address, history_id) from the JSON body of a Pub/Sub push request.
+
+    Raises ValueError if the body is not a Gmail notification.
+    """
+    try:
+        data = json.loads(base64.b64decode(body['message']['data']))
+        return data['emailAddress'], int(data['historyId'])
+    except (KeyError, TypeError, ValueError) as error:
+        raise ValueError(f"Not a Gmail push notification: {error}")
+
+def build_push_notification(email_address, history_id, message_id="1"):
+    """Builds the body Pub/Sub posts for a Gmail notification (used to fake one locally)."""
+    data = json.dumps({'emailAddress': email_address, 'historyId': int(history_id)})
+    return {
+        'message': {'data': base64.b64encode(data.encode('utf-8')).decode('ascii'), 'messageId': message_id},
+        'subscription': 'projects/local/subscriptions/fake',
+    }
+
+def is_history_processed(history_id, state_file=SYNC_STATE_FILE):
+    """Tells whether the changes up to history_id were already picked up by a previous sync."""
+    saved_history_id = load_sync_state(state_file).get("history_id")
+    return saved_history_id is not None and int(history_id) <= int(saved_history_id)
+
+class AdaptivePollInterval:
+    """Polls often while mail is arriving, and backs off (doubling the wait) while the mailbox is idle."""
+
+    def __init__(self, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.current = min_interval
+
+    def next(self, found_mail):
+        """Returns how many seconds to wait before the next poll."""
+        if found_mail:
+            self.current = self.min_interval
+        else:
+            self.current = min(self.current * 2, self.max_interval)
+        return self.current
@@ -0,0 +1,207 @@
+import os
+import re
+import sys
+import threading
+
+from gmail_service import build_service, load_credentials, refresh_credentials
+from metrics import configure_logging, get_logger
+from sync_service import SYNC_STATE_FILE, get_new_message_ids, save_sync_state
+from thread_store import THREAD_STORE_FILE, ThreadStore, get_thread_store
+from work_queue import WORK_QUEUE_FILE, WorkQueue, get_work_queue
+
+logger = get_logger(__name__)
+
+# One token file per mailbox, tokens/<account>.json, created with `python tenants.py add <account>`.
+# Without any, the assistant runs for the single mailbox in token.json, as it always did.
+TENANT_TOKEN_DIR = os.environ.get("TENANT_TOKEN_DIR", "tokens")
+# Every account keeps its sync state, work queue and thread store in a folder of its own
+TENANT_STATE_DIR = os.environ.get("TENANT_STATE_DIR", "accounts")
+# The accounts take turns: each gets at most this many emails processed before the next one's turn
+TENANT_QUANTUM = int(os.environ.get("TENANT_QUANTUM", "25"))
+# The mailbox of token.json, whose state files stay where they were before there were accounts
+DEFAULT_ACCOUNT = "default"
+
+# Account names end up in file and collection names
+ACCOUNT_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,40}$")
+
+class Tenant:
+    """
+    One mailbox: its credentials, Gmail service and state files.
+
+    The credentials are loaded once and refreshed (and saved) shortly before
+    they expire, and the Gmail service is built once, so later runs reuse its
+    HTTP connection and label cache. The Ollama backend and the embedding model
+    are not per account; every tenant shares the process-wide ones.
+    """
+
+    def __init__(self, name, token_file, state_dir="", interactive=False):
+        self.name = name
+        self.token_file = token_file
+        self.state_dir = state_dir
+        # Only the default account may open a browser to log in; the others are added with `tenants.py add`
+        self.interactive = interactive
+        self.email_address = None
+        self._service = None
+        self._work_queue = None
+        self._thread_store = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Tenant({self.name!r})"
+
+    def path(self, file_name):
+        """Where the account keeps one of its state files."""
+        if self.state_dir:
+            os.makedirs(self.state_dir, exist_ok=True)
+        return os.path.join(self.state_dir, file_name)
+
+    @property
+    def sync_state_file(self):
+        return self.path(SYNC_STATE_FILE)
+
+    def get_service(self):
+        """Returns the account's Gmail service, building it on first use and refreshing its credentials if needed."""
+        with self._lock:
+            if self._service is None:
+                credentials = load_credentials(self.token_file, interactive=self.interactive)
+                self._service = build_service("gmail", "v1", credentials)
+            else:
+                refresh_credentials(self._service._http.credentials, self.token_file)
+            return self._service
+
+    def get_email_address(self):
+        """The account's email address, asked from Gmail once."""
+        if self.email_address is None:
+            self.email_address = self.get_service().users().getProfile(userId='me').execute()['emailAddress']
+        return self.email_address
+
+    def work_queue(self):
+        with self._lock:
+            if self._work_queue is None:
+                self._work_queue = WorkQueue(self.path(WORK_QUEUE_FILE)) if self.state_dir else get_work_queue()
+            return self._work_queue
+
+    def thread_store(self):
+        with self._lock:
+            if self._thread_store is None:
+                self._thread_store = ThreadStore(self.path(THREAD_STORE_FILE)) if self.state_dir else get_thread_store()
+            return self._thread_store
+
+class TenantRegistry:
+    """The accounts the assistant works for, one per token file in token_dir."""
+
+    def __init__(self, token_dir=TENANT_TOKEN_DIR, state_dir=TENANT_STATE_DIR):
+        self.token_dir = token_dir
+        self.state_dir = state_dir
+        self._tenants = {}
+        self._lock = threading.Lock()
+
+    def _account_names(self):
+        if not os.path.isdir(self.token_dir):
+            return []
+        names = (file_name[:-len(".json")] for file_name in os.listdir(self.token_dir) if file_name.endswith(".json"))
+        return sorted(name for name in names if ACCOUNT_NAME.match(name))
+
+    def tenants(self):
+        """Every account, by name. Token files added since the last call are picked up."""
+        names = self._account_names()
+        with self._lock:
+            if not names:
+                names = [DEFAULT_ACCOUNT]
+                if DEFAULT_ACCOUNT not in self._tenants:
+                    self._tenants[DEFAULT_ACCOUNT] = Tenant(DEFAULT_ACCOUNT, "token.json", interactive=True)
+            for name in names:
+                if name not in self._tenants:
+                    self._tenants[name] = Tenant(name, os.path.join(self.token_dir, name + ".json"),
+                                                 os.path.join(self.state_dir, name))
+            return [self._tenants[name] for name in names]
+
+    def get(self, name=None):
+        """The account with the given name; None means the default account."""
+        with self._lock:
+            tenant = self._tenants.get(name or DEFAULT_ACCOUNT)
+        if tenant is None:
+            tenant = next((t for t in self.tenants() if t.name == (name or DEFAULT_ACCOUNT)), None)
+        if tenant is None and name is None:
+            # Accounts are configured, but this email came in without one (e.g. a single-email call)
+            tenant = self.tenants()[0]
+        if tenant is None:
+            raise KeyError(f"Unknown account {name}")
+        return tenant
+
+    def find_by_email(self, email_address):
+        """The account of an email address, or None. May ask Gmail for the addresses it does not know yet."""
+        for tenant in self.tenants():
+            try:
+                if tenant.get_email_address().lower() == email_address.lower():
+                    return tenant
+            except Exception as e:
+                logger.warning("Could not look up the address of an account", extra={"account": tenant.name, "error": str(e)})
+        return None
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_tenant_registry():
+    """Returns the shared TenantRegistry."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = TenantRegistry()
+        return _registry
+
+def thread_store_for(email):
+    """The thread store of the account an email belongs to."""
+    return get_tenant_registry().get(email.get('account')).thread_store()
+
+def collect_new_mail(tenant):
+    """Queues the new mail of an account and returns the IDs of its emails that are ready to be processed."""
+    new_ids, history_id = get_new_message_ids(tenant.get_service(), state_file=tenant.sync_state_file)
+    # New mail goes into the work queue first; from then on the queue remembers what is left to do
+    work_queue = tenant.work_queue()
+    work_queue.enqueue(new_ids)
+    save_sync_state(history_id, state_file=tenant.sync_state_file)
+    # New mail, plus anything interrupted or failed earlier that is due for a retry
+    msg_ids = work_queue.ready_ids()
+    if msg_ids:
+        logger.info("Mail to process", extra={"account": tenant.name, "emails": len(msg_ids), "new": len(new_ids)})
+    return msg_ids
+
+def fair_batches(ready_ids, quantum=TENANT_QUANTUM):
+    """
+    Takes turns between accounts: yields (tenant, msg_ids) with at most quantum emails of
+    each account per round, so a flooded inbox delays the others by one batch at most.
+    ready_ids maps every tenant to the IDs of its emails, in the order they should go.
+
+    Every batch runs in a pipeline of its own, which drains at the end and only orders
+    the emails inside it by priority. So once a single account has mail left (always,
+    with one account), all of its remaining emails go in one batch.
+    """
+    offsets = {tenant: 0 for tenant, msg_ids in ready_ids.items() if msg_ids}
+    while offsets:
+        for tenant in list(offsets):
+            start = offsets[tenant]
+            end = len(ready_ids[tenant]) if len(offsets) == 1 else start + quantum
+            yield tenant, ready_ids[tenant][start:end]
+            if end >= len(ready_ids[tenant]):
+                del offsets[tenant]
+            else:
+                offsets[tenant] = end
+
+
+if __name__ == "__main__":
+    configure_logging()
+    if len(sys.argv) == 3 and sys.argv[1] == "add":
+        name = sys.argv[2]
+        if not ACCOUNT_NAME.match(name):
+            sys.exit("Account names may only contain letters, digits, '-' and '_'.")
+        os.makedirs(TENANT_TOKEN_DIR, exist_ok=True)
+        # Opens the browser to log in to the mailbox, and saves its token
+        tenant = Tenant(name, os.path.join(TENANT_TOKEN_DIR, name + ".json"), interactive=True)
+        tenant.get_service()
+        print(f"Added account {name} ({tenant.get_email_address()}).")
+    elif len(sys.argv) == 2 and sys.argv[1] == "list":
+        for tenant in get_tenant_registry().tenants():
+            print(f"{tenant.name}: {tenant.token_file}")
+    else:
+        print("Usage: python tenants.py add <account> | python tenants.py list")
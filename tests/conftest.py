@@ -0,0 +1,124 @@
+import copy
+import os
+import sys
+import time
+
+import pytest
+
+# The modules live at the top of the repository, next to this folder
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.corpus import generate_mailbox  # noqa: E402
+from benchmarks.fake_gmail import FakeMailbox, build_fake_gmail_service, header  # noqa: E402
+from benchmarks.fake_ollama import FakeAsyncOllamaClient, FakeEncoder, FakeOllamaClient  # noqa: E402
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Every test runs in a folder of its own, so state files (queues, caches, tokens) never leak between tests."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+@pytest.fixture(autouse=True)
+def fresh_state(workdir, monkeypatch):
+    """Drops the process-wide queues, stores, caches and accounts, so each test opens its own in workdir."""
+    import llm_cache
+    import tenants
+    import thread_store
+    import triage
+    import work_queue
+    monkeypatch.setattr(llm_cache, "_cache", None)
+    monkeypatch.setattr(tenants, "_registry", None)
+    monkeypatch.setattr(thread_store, "_store", None)
+    monkeypatch.setattr(triage, "_model", None)
+    monkeypatch.setattr(triage, "_model_loaded", False)
+    monkeypatch.setattr(work_queue, "_queue", None)
+
+@pytest.fixture(autouse=True)
+def no_gmail_pacing(monkeypatch):
+    """The fake Gmail has no quota, so calls are not paced unless a test asks for it."""
+    import gmail_service
+    monkeypatch.setattr(gmail_service, "GMAIL_QUOTA_UNITS_PER_SECOND", 0)
+    monkeypatch.setattr(gmail_service, "GMAIL_BACKOFF_BASE", 0.001)
+
+@pytest.fixture
+def mailbox():
+    """A fake Gmail account with 20 generated messages."""
+    return FakeMailbox(generate_mailbox(20, seed=1))
+
+@pytest.fixture
+def new_message():
+    """A personal message that is not in the mailbox fixture yet, for add_message()."""
+    message = next(m for m in generate_mailbox(40, seed=2)[20:] if m['labelIds'] == ["INBOX", "UNREAD"]
+                   and "no-reply" not in header(m, "From") and not header(m, "List-Unsubscribe"))
+    return copy.deepcopy(message)
+
+@pytest.fixture
+def service(mailbox):
+    """A real googleapiclient Gmail service whose requests all go to the fake mailbox."""
+    return build_fake_gmail_service(mailbox)
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    """Swaps the Ollama clients for instant fake ones, and the embedding model for a fake encoder."""
+    import embedding_service
+    import rag_service
+    from llm_handler import backend
+    monkeypatch.setattr(embedding_service, "_service", None)
+    monkeypatch.setattr(backend, "_client", FakeOllamaClient(time_scale=0))
+    monkeypatch.setattr(backend, "_async_client", FakeAsyncOllamaClient(time_scale=0))
+    encoder = embedding_service.get_embedding_service()
+    monkeypatch.setattr(encoder, "_model", FakeEncoder())
+    # A knowledge base of its own; Chroma keeps one client per path, so the path has to differ too
+    monkeypatch.setattr(rag_service, "KNOWLEDGE_BASE_DIR", os.path.abspath("my_knowledge_base"))
+    monkeypatch.setattr(rag_service, "_client", None)
+    monkeypatch.setattr(rag_service, "_collections", {})
+    monkeypatch.setattr(rag_service, "_bm25_indexes", {})
+    return backend
+
+@pytest.fixture
+def default_tenant(service):
+    """The default account, with the fake Gmail service instead of token.json."""
+    from tenants import get_tenant_registry
+    tenant = get_tenant_registry().get()
+    tenant._service = service
+    return tenant
+
+@pytest.fixture
+def accounts(monkeypatch):
+    """Two accounts, work and home, each with a fake mailbox of its own. Returns (registry, mailboxes)."""
+    import tenants
+    os.makedirs("tokens")
+    for name in ("work", "home"):
+        with open(os.path.join("tokens", name + ".json"), "w") as f:
+            f.write("{}")
+    registry = tenants.TenantRegistry()
+    mailboxes = {}
+    for tenant, seed in zip(registry.tenants(), (1, 2)):
+        mailboxes[tenant.name] = FakeMailbox(generate_mailbox(6, seed=seed), email_address=f"{tenant.name}@example.com")
+        tenant._service = build_fake_gmail_service(mailboxes[tenant.name])
+    monkeypatch.setattr(tenants, "_registry", registry)
+    return registry, mailboxes
+
+@pytest.fixture
+def server_state(monkeypatch):
+    """The server module with no jobs and push settings of its own."""
+    import server
+    monkeypatch.setattr(server, "jobs", server.OrderedDict())
+    monkeypatch.setattr(server, "_running_job_id", None)
+    monkeypatch.setattr(server, "_rerun_requested", False)
+    monkeypatch.setattr(server, "_rerun_tenants", set())
+    monkeypatch.setattr(server, "_last_push_at", None)
+    monkeypatch.setattr(server, "GMAIL_PUSH_TOKEN", None)
+    yield server
+    # A job still running would go on writing state files after the test
+    deadline = time.monotonic() + 30
+    while server._running_job_id is not None and time.monotonic() < deadline:
+        time.sleep(0.02)
+
+@pytest.fixture
+def client(fake_llm, default_tenant, server_state):
+    """A FastAPI test client of the server, processing the fake mailbox with the fake LLM."""
+    from fastapi.testclient import TestClient
+    with TestClient(server_state.app) as client:
+        yield client
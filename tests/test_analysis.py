@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+import main
+from calendar_service import get_calendar_availability
+
+NOTE = "Project Atlas budget is 40k."
+
+@pytest.fixture
+def make_email(new_message):
+    """A personal email (so triage leaves it to the LLM) with the notes already looked up."""
+    def make(**fields):
+        return dict(main.parse_email(new_message), notes=[NOTE], **fields)
+    return make
+
+@pytest.fixture
+def contexts(fake_llm, monkeypatch):
+    """The context every LLM call of main is given, keyed by the function called."""
+    seen = {}
+
+    def recorder(name, result):
+        def record(email_content, *args, context=None, **kwargs):
+            seen[name] = context
+            return result
+        return record
+
+    monkeypatch.setattr(main, "classify_and_reply_local", recorder("classify_and_reply", ({'intent': 'meeting_request'}, "Sure.")))
+    monkeypatch.setattr(main, "generate_reply_local", recorder("reply", "Sure."))
+    return seen
+
+@pytest.fixture
+def calendar(service):
+    return get_calendar_availability(service)
+
+def test_single_pass_context_has_the_notes_and_the_free_slots(contexts, calendar, make_email, monkeypatch):
+    monkeypatch.setattr(main, "LLM_MODE", "single_pass")
+    main.analyze_email(make_email(thread_history="Earlier: Alice asked about Atlas."), calendar=calendar)
+
+    notes, slots, history = contexts["classify_and_reply"]
+    assert notes == NOTE
+    assert slots == calendar.describe_free_slots() and slots.startswith("My next free")
+    assert history == "Earlier: Alice asked about Atlas."
+
+def test_async_single_pass_gets_the_same_context(fake_llm, calendar, make_email, monkeypatch):
+    monkeypatch.setattr(main, "LLM_MODE", "single_pass")
+    seen = []
+
+    async def classify_and_reply(email_content, context=None):
+        seen.append(context)
+        return {'intent': 'meeting_request'}, "Sure."
+
+    monkeypatch.setattr(main, "classify_and_reply_async", classify_and_reply)
+    asyncio.run(main.analyze_email_async(make_email(), calendar=calendar))
+    assert seen == [[NOTE, calendar.describe_free_slots()]]
+
+def test_single_pass_without_a_calendar_has_only_the_notes(contexts, make_email, monkeypatch):
+    monkeypatch.setattr(main, "LLM_MODE", "single_pass")
+    main.analyze_email(make_email())
+    assert contexts["classify_and_reply"] == [NOTE]
+
+@pytest.mark.parametrize("intent, expected", [("meeting_request", "slots"), ("information_request", "notes")])
+def test_two_pass_context_depends_on_the_intent(contexts, calendar, make_email, monkeypatch, intent, expected):
+    monkeypatch.setattr(main, "LLM_MODE", "two_pass")
+    monkeypatch.setattr(main, "classify_email_intent_local", lambda content: {'intent': intent})
+    main.analyze_email(make_email(), calendar=calendar)
+
+    assert contexts["reply"] == ([calendar.describe_free_slots()] if expected == "slots" else [NOTE])
+
+def test_free_slots_cost_one_calendar_call_for_many_emails(contexts, calendar, make_email, mailbox, monkeypatch):
+    monkeypatch.setattr(main, "LLM_MODE", "single_pass")
+    for index in range(5):
+        main.analyze_email(make_email(thread_history=f"Earlier message {index}."), calendar=calendar)
+    assert mailbox.api_calls["calendar.freebusy.query"] == 1
+
+def test_an_unreadable_calendar_is_left_out(contexts, make_email, monkeypatch):
+    class BrokenCalendar:
+        def describe_free_slots(self):
+            raise RuntimeError("calendar API down")
+
+    monkeypatch.setattr(main, "LLM_MODE", "single_pass")
+    main.analyze_email(make_email(), calendar=BrokenCalendar())
+    assert contexts["classify_and_reply"] == [NOTE]
+
+@pytest.fixture
+def retrievals(monkeypatch):
+    """The query texts of every notes lookup, one list per call."""
+    calls = []
+
+    def retrieve_notes(query_texts, account=None):
+        calls.append(list(query_texts))
+        return [[NOTE] for _ in query_texts]
+
+    monkeypatch.setattr(main, "retrieve_notes", retrieve_notes)
+    return calls
+
+@pytest.fixture
+def fresh_emails(new_message):
+    """Three personal emails without notes."""
+    return [dict(main.parse_email(new_message), id=f"m{index}") for index in range(3)]
+
+def test_two_pass_looks_up_notes_only_for_information_requests(contexts, fresh_emails, retrievals, monkeypatch):
+    monkeypatch.setattr(main, "LLM_MODE", "two_pass")
+    main.prefetch_notes(fresh_emails)
+    assert retrievals == []
+
+    for email, intent in zip(fresh_emails, ["meeting_request", "information_request", "spam"]):
+        monkeypatch.setattr(main, "classify_email_intent_local", lambda content, intent=intent: {'intent': intent})
+        main.analyze_email(email)
+    assert len(retrievals) == 1
+    assert contexts["reply"] == [NOTE]
+
+def test_single_pass_looks_up_the_notes_of_a_batch_at_once(contexts, fresh_emails, retrievals, monkeypatch):
+    monkeypatch.setattr(main, "LLM_MODE", "single_pass")
+    main.prefetch_notes(fresh_emails)
+    for email in fresh_emails:
+        main.analyze_email(email)
+    assert [len(texts) for texts in retrievals] == [3]
+    assert all(email['notes'] == [NOTE] for email in fresh_emails)
@@ -0,0 +1,95 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+from benchmarks.corpus import generate_mailbox, generate_notes
+from benchmarks.fake_gmail import header
+from benchmarks.fake_ollama import FakeOllamaClient
+from benchmarks.run import REPO_ROOT, StageTimer, compare
+
+def scenario(emails_per_minute, api_calls=100, rss=100.0):
+    return {"emails_per_minute": emails_per_minute, "gmail": {"api_calls": api_calls}, "peak_rss_mb": rss}
+
+def report(**scenarios):
+    return {"settings": {"messages": 100}, "scenarios": scenarios}
+
+def test_stage_timer_times_every_call_even_failed_ones():
+    timer = StageTimer()
+    double = timer.wrap("double", lambda x: x * 2)
+    assert [double(i) for i in range(4)] == [0, 2, 4, 6]
+
+    def fail():
+        raise ValueError("boom")
+    with pytest.raises(ValueError):
+        timer.wrap("fail", fail)()
+
+    summary = timer.summary()
+    assert summary["double"]["count"] == 4
+    assert summary["fail"]["count"] == 1
+    assert summary["double"]["p50"] <= summary["double"]["p99"]
+
+def test_compare_flags_throughput_drops_beyond_the_tolerance(capsys):
+    baseline = report(pipeline=scenario(1000), query_rag=scenario(1000))
+    current = report(pipeline=scenario(850), query_rag=scenario(950))
+
+    assert compare(baseline, current) == ["pipeline"]
+    output = capsys.readouterr().out
+    assert "pipeline: throughput -15.0%" in output and "REGRESSION" in output
+    assert "query_rag: throughput -5.0%" in output
+
+def test_compare_skips_scenarios_that_failed_or_are_new(capsys):
+    baseline = report(pipeline={"error": "the scenario exited with status 1"})
+    current = report(pipeline=scenario(10), query_rag=scenario(10))
+    assert compare(baseline, current) == []
+
+def test_compare_warns_about_different_settings(capsys):
+    baseline = dict(report(pipeline=scenario(1000)), settings={"messages": 10})
+    compare(baseline, report(pipeline=scenario(1000)))
+    assert "different settings" in capsys.readouterr().out
+
+def test_generated_corpus_is_reproducible():
+    def outline(messages):
+        # Everything but the random MIME boundaries
+        return [(m['id'], m['threadId'], m['labelIds'], m['snippet'], header(m, "Subject")) for m in messages]
+
+    assert outline(generate_mailbox(30, seed=4)) == outline(generate_mailbox(30, seed=4))
+    assert outline(generate_mailbox(30, seed=4)) != outline(generate_mailbox(30, seed=5))
+    assert generate_notes(10, seed=4) == generate_notes(10, seed=4)
+
+def test_generated_mailbox_has_threads_and_bulk_mail():
+    messages = generate_mailbox(200, seed=0)
+    assert len({message['id'] for message in messages}) == 200
+    assert any(message['threadId'] != message['id'] for message in messages)
+    assert any("CATEGORY_PROMOTIONS" in message['labelIds'] for message in messages)
+    assert all(header(message, "Message-ID") for message in messages)
+
+def test_fake_ollama_answers_deterministically():
+    client = FakeOllamaClient(time_scale=0)
+    messages = [{"role": "user", "content": "Can we meet on Tuesday?"}]
+    first = client.chat(model="gemma3:4b", messages=messages, format="json")
+    second = client.chat(model="gemma3:4b", messages=messages, format="json")
+
+    assert first["message"]["content"] == second["message"]["content"]
+    assert json.loads(first["message"]["content"])["intent"] == "meeting_request"
+    assert first["prompt_eval_count"] > 0 and first["eval_count"] > 0
+
+def test_harness_runs_a_scenario_and_reports_regressions(workdir):
+    # A baseline no run can match, so the comparison has to report a regression
+    baseline = workdir / "baseline.json"
+    baseline.write_text(json.dumps(report(pipeline=scenario(10 ** 9))))
+    output = workdir / "results.json"
+    completed = subprocess.run(
+        [sys.executable, "-m", "benchmarks.run", "--scenarios", "pipeline", "--messages", "20", "--notes", "5",
+         "--fake-embeddings", "--load-time", "0", "--time-scale", "0", "--gmail-latency", "0",
+         "--output", str(output), "--compare", str(baseline)],
+        cwd=REPO_ROOT, capture_output=True, text=True, timeout=300,
+    )
+
+    assert completed.returncode == 1, completed.stdout + completed.stderr
+    assert "REGRESSION" in completed.stdout
+    result = json.loads(output.read_text())["scenarios"]["pipeline"]
+    assert result["emails"] == 20 and result["failed"] == 0
+    assert result["gmail"]["api_calls_by_method"]["gmail.users.messages.get"] == 20
+    assert {"parse", "analyze", "deliver"} <= set(result["stages"])
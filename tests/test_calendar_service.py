@@ -0,0 +1,109 @@
+import datetime
+import time
+
+import pytest
+
+import calendar_service
+from calendar_service import CalendarAvailability, check_calendar_availability, get_calendar_availability
+
+UTC = datetime.timezone.utc
+
+@pytest.fixture(autouse=True)
+def utc_local_time(monkeypatch):
+    """Working hours are in local time; the tests use UTC for it."""
+    monkeypatch.setenv("TZ", "UTC")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+@pytest.fixture
+def monday():
+    """A Monday a few days ahead, so the Friday before it is still in the future."""
+    day = datetime.datetime.now(UTC).replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=4)
+    return day + datetime.timedelta(days=-day.weekday() % 7)
+
+def at(day, hour, minute=0):
+    return day.replace(hour=hour, minute=minute)
+
+@pytest.fixture
+def busy(mailbox, monkeypatch, monday):
+    """Replaces the fake calendar's meetings with a list of (start, end) the test can change."""
+    intervals = [
+        (at(monday, 9), at(monday, 10)),
+        # Overlaps the one before, and the next one starts as it ends: all three become 9:00-11:30
+        (at(monday, 9, 30), at(monday, 11)),
+        (at(monday, 11), at(monday, 11, 30)),
+        (at(monday, 14), at(monday, 15)),
+    ]
+    monkeypatch.setattr(mailbox, "_freebusy", lambda body: {"calendars": {item["id"]: {"busy": [
+        {"start": start.isoformat(), "end": end.isoformat()} for start, end in intervals
+    ]} for item in body["items"]}})
+    return intervals
+
+@pytest.fixture
+def calendar(service, busy):
+    return CalendarAvailability(service)
+
+def test_overlapping_and_adjacent_events_are_merged(calendar, monday):
+    assert calendar.busy_between(monday, monday + datetime.timedelta(days=1)) == [
+        (at(monday, 9), at(monday, 11, 30)),
+        (at(monday, 14), at(monday, 15)),
+    ]
+    assert calendar.busy_between(at(monday, 10), at(monday, 14)) == [(at(monday, 9), at(monday, 11, 30))]
+    assert calendar.busy_between(at(monday, 11, 30), at(monday, 14)) == []
+
+@pytest.mark.parametrize("hour, minute, free", [
+    (8, 30, True),     # ends as the first meeting starts
+    (9, 0, False),
+    (11, 0, False),
+    (11, 30, True),
+    (13, 45, False),   # runs into the 14:00 meeting
+    (15, 0, True),
+])
+def test_is_free(calendar, monday, hour, minute, free):
+    assert calendar.is_free(at(monday, hour, minute)) is free
+
+def test_times_beyond_the_window_are_unknown(calendar):
+    assert calendar.is_free(datetime.datetime.now(UTC) + datetime.timedelta(days=30)) is None
+
+def test_free_slots_skip_meetings(calendar, monday):
+    slots = calendar.next_free_slots(count=6, after=at(monday, 8, 50))
+    assert [(slot.hour, slot.minute) for slot in slots] == [(11, 30), (12, 0), (12, 30), (13, 0), (13, 30), (15, 0)]
+    assert all(slot.date() == monday.date() for slot in slots)
+
+def test_free_slots_skip_evenings_and_weekends(calendar, monday):
+    friday_evening = at(monday - datetime.timedelta(days=3), 16, 45)
+    slots = calendar.next_free_slots(count=1, after=friday_evening)
+    assert slots == [at(monday, 11, 30)]
+
+def test_a_full_calendar_has_no_slots(calendar, busy):
+    busy[:] = [(datetime.datetime.now(UTC), datetime.datetime.now(UTC) + datetime.timedelta(days=60))]
+    calendar.refresh(force=True)
+    assert calendar.next_free_slots() == []
+    assert calendar.describe_free_slots().startswith("My calendar has no free 30-minute slot")
+
+def test_free_busy_is_fetched_once_per_ttl(calendar, mailbox, busy, monday, monkeypatch):
+    calendar.is_free(at(monday, 9))
+    calendar.next_free_slots(after=at(monday, 8))
+    calendar.busy_between(monday, at(monday, 23))
+    assert calendar.requests == 1
+    assert mailbox.api_calls["calendar.freebusy.query"] == 1
+
+    # A meeting added in the calendar shows up once the TTL has passed
+    busy.append((at(monday, 16), at(monday, 17)))
+    assert calendar.is_free(at(monday, 16)) is True
+    fetched_at = calendar._fetched_at
+    monkeypatch.setattr(calendar_service.time, "monotonic", lambda: fetched_at + calendar.ttl + 1)
+    assert calendar.is_free(at(monday, 16)) is False
+    assert calendar.requests == 2
+
+def test_every_service_has_one_availability(service, busy):
+    assert get_calendar_availability(service) is get_calendar_availability(service)
+
+def test_check_calendar_availability_lists_the_busy_slots(service, busy, monday):
+    slots = check_calendar_availability(service, monday.date())
+    assert slots == [
+        {"start": at(monday, 9).isoformat(), "end": at(monday, 11, 30).isoformat()},
+        {"start": at(monday, 14).isoformat(), "end": at(monday, 15).isoformat()},
+    ]
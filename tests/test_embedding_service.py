@@ -0,0 +1,98 @@
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from benchmarks.fake_ollama import FakeEncoder
+from benchmarks.run import REPO_ROOT
+from embedding_service import EmbeddingCache, EmbeddingService, text_hash
+
+def vector(seed, dimension=8):
+    values = np.random.default_rng(seed).random(dimension, dtype=np.float32)
+    return values / np.linalg.norm(values)
+
+@pytest.fixture
+def cache_dir(workdir):
+    return str(workdir / "cache")
+
+def test_vectors_are_found_again_after_a_reload(cache_dir):
+    EmbeddingCache(cache_dir, 8).add_many(["a", "b"], [vector(1), vector(2)])
+
+    found = EmbeddingCache(cache_dir, 8).get_many(["a", "b", "c"])
+    assert set(found) == {"a", "b"}
+    assert np.array_equal(found["a"], vector(1)) and np.array_equal(found["b"], vector(2))
+
+def test_the_file_grows_without_losing_vectors(cache_dir):
+    cache = EmbeddingCache(cache_dir, 8, initial_rows=4)
+    hashes = [str(i) for i in range(50)]
+    for start in range(0, 50, 7):
+        cache.add_many(hashes[start:start + 7], [vector(i) for i in range(start, min(start + 7, 50))])
+
+    assert cache.vectors.shape[0] >= 50
+    found = cache.get_many(hashes)
+    assert all(np.array_equal(found[str(i)], vector(i)) for i in range(50))
+
+def test_a_vector_is_stored_once(cache_dir):
+    cache = EmbeddingCache(cache_dir, 8)
+    cache.add_many(["a", "a"], [vector(1), vector(2)])
+    cache.add_many(["a"], [vector(3)])
+    assert np.array_equal(cache.get_many(["a"])["a"], vector(1))
+
+def test_two_instances_sharing_a_directory_keep_their_vectors_apart(cache_dir):
+    first = EmbeddingCache(cache_dir, 8, initial_rows=2)
+    second = EmbeddingCache(cache_dir, 8, initial_rows=2)
+    first.add_many(["x"], [vector(1)])
+    second.add_many(["y"], [vector(2)])
+    # The second one has to grow the file the first one has mapped
+    second.add_many(["z1", "z2", "z3"], [vector(3), vector(4), vector(5)])
+
+    for cache in (first, second):
+        found = cache.get_many(["x", "y", "z3"])
+        assert np.array_equal(found["x"], vector(1))
+        assert np.array_equal(found["y"], vector(2))
+        assert np.array_equal(found["z3"], vector(5))
+
+def test_processes_adding_at_the_same_time_do_not_overwrite_each_other(cache_dir):
+    script = (
+        "import sys, numpy as np\n"
+        "from embedding_service import EmbeddingCache\n"
+        "name, cache_dir = sys.argv[1], sys.argv[2]\n"
+        "cache = EmbeddingCache(cache_dir, 8, initial_rows=2)\n"
+        "for i in range(40):\n"
+        "    cache.add_many([f'{name}{i}'], [np.full(8, i + (100 if name == 'b' else 0), dtype=np.float32)])\n"
+    )
+    processes = [subprocess.Popen([sys.executable, "-c", script, name, cache_dir], cwd=REPO_ROOT)
+                 for name in ("a", "b")]
+    assert [process.wait(timeout=120) for process in processes] == [0, 0]
+
+    found = EmbeddingCache(cache_dir, 8).get_many([f"{name}{i}" for name in "ab" for i in range(40)])
+    assert len(found) == 80
+    assert all(found[f"a{i}"][0] == i and found[f"b{i}"][0] == i + 100 for i in range(40))
+
+def test_a_different_dimension_starts_over(cache_dir):
+    EmbeddingCache(cache_dir, 8).add_many(["a"], [vector(1)])
+    cache = EmbeddingCache(cache_dir, 4)
+    assert cache.get_many(["a"]) == {}
+    cache.add_many(["a"], [vector(1, dimension=4)])
+    assert np.array_equal(cache.get_many(["a"])["a"], vector(1, dimension=4))
+
+def test_service_encodes_only_texts_it_has_not_seen(cache_dir):
+    encoded = []
+
+    class CountingEncoder(FakeEncoder):
+        def encode(self, texts, **kwargs):
+            encoded.extend(texts)
+            return super().encode(texts, **kwargs)
+
+    service = EmbeddingService(cache_dir=cache_dir)
+    service._model = CountingEncoder()
+    first = service.encode(["hello there", "budget", "hello there"])
+    second = service.encode(["budget", "new text"])
+
+    assert encoded == ["hello there", "budget", "new text"]
+    assert np.array_equal(first[1], second[0])
+    assert service.encode([]).shape == (0, 384)
+    # Without the cache, nothing is read or stored
+    service.encode(["one-off query"], use_cache=False)
+    assert service.cache.get_many([text_hash("one-off query")]) == {}
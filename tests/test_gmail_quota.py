@@ -0,0 +1,143 @@
+import time
+from email.mime.text import MIMEText
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import gmail_service
+from gmail_service import (QuotaBucket, backoff_delay, batch_get_messages, get_quota_bucket, is_retryable_error,
+                           quota_units, send_email)
+
+def http_error(status, content=b"{}", **headers):
+    return HttpError(httplib2.Response(dict(headers, status=status)), content)
+
+@pytest.fixture
+def flaky(mailbox, monkeypatch):
+    """Makes the fake Gmail fail the next calls to some paths: flaky(status, times, path_part)."""
+    handle = mailbox.handle
+    failures = []
+
+    def failing_handle(method, path, query, body):
+        for failure in failures:
+            if failure["path"] in path and failure["times"]:
+                failure["times"] -= 1
+                return failure["status"], {"error": {"code": failure["status"], "message": "Injected failure"}}
+        return handle(method, path, query, body)
+
+    monkeypatch.setattr(mailbox, "handle", failing_handle)
+    return lambda status, times, path="": failures.append({"status": status, "times": times, "path": path})
+
+# --- Quota ---
+
+def test_quota_units_per_method():
+    assert quota_units("gmail.users.messages.send") == 100
+    assert quota_units("gmail.users.messages.get") == 5
+    assert quota_units("gmail.users.someNewMethod") == gmail_service.DEFAULT_QUOTA_UNITS
+    assert quota_units("calendar.freebusy.query") == 0
+
+def test_bucket_allows_a_burst_then_paces():
+    bucket = QuotaBucket(rate=200, burst=20)
+    assert bucket.acquire(20) == 0.0
+
+    started = time.monotonic()
+    waited = bucket.acquire(10)
+    assert waited == pytest.approx(0.05, abs=0.02)
+    assert time.monotonic() - started >= 0.04
+
+def test_bucket_with_no_rate_never_waits():
+    bucket = QuotaBucket(rate=0, burst=1)
+    assert bucket.acquire(1000) == 0.0
+
+def test_throttle_halves_the_rate_and_empties_the_bucket():
+    bucket = QuotaBucket(rate=160, burst=100)
+    bucket.throttle()
+    assert bucket.rate == pytest.approx(80, rel=0.01)
+    assert bucket.tokens <= 0
+    for _ in range(10):
+        bucket.throttle()
+    # Never below a sixteenth of the full rate
+    assert bucket.rate == pytest.approx(10, rel=0.01)
+
+def test_services_of_the_same_user_share_a_bucket(service):
+    clone = gmail_service.clone_gmail_service(service)
+    assert get_quota_bucket(service._http) is get_quota_bucket(clone._http)
+
+# --- What is retried ---
+
+def test_rate_limits_are_retried_for_every_method():
+    assert is_retryable_error(http_error(429), "gmail.users.messages.send")
+    assert is_retryable_error(http_error(403, b'{"reason": "rateLimitExceeded"}'), "gmail.users.messages.get")
+    assert not is_retryable_error(http_error(403, b'{"reason": "insufficientPermissions"}'), "gmail.users.messages.get")
+
+def test_server_errors_are_retried_only_for_idempotent_methods():
+    assert is_retryable_error(http_error(503), "gmail.users.messages.get")
+    assert not is_retryable_error(http_error(503), "gmail.users.messages.send")
+    assert not is_retryable_error(http_error(404), "gmail.users.messages.get")
+
+def test_backoff_is_capped_and_honours_retry_after(monkeypatch):
+    monkeypatch.setattr(gmail_service, "GMAIL_BACKOFF_BASE", 1.0)
+    monkeypatch.setattr(gmail_service, "GMAIL_BACKOFF_MAX", 32)
+    assert all(0 <= backoff_delay(attempt) <= 2 ** attempt for attempt in range(5))
+    assert all(backoff_delay(20) <= 32 for _ in range(20))
+    assert backoff_delay(0, http_error(429, **{"retry-after": "7"})) >= 7
+    assert backoff_delay(0, http_error(429, **{"retry-after": "600"})) <= 32
+
+# --- Retrying through the fake Gmail ---
+
+def test_rate_limited_call_is_retried_until_it_succeeds(mailbox, service, flaky):
+    flaky(429, times=2, path="/messages/")
+    msg_id = next(iter(mailbox.messages))
+    message = service.users().messages().get(userId='me', id=msg_id).execute()
+
+    assert message['id'] == msg_id
+    assert mailbox.http_requests == 3
+
+def test_retries_give_up_after_the_limit(mailbox, service, flaky, monkeypatch):
+    monkeypatch.setattr(gmail_service, "GMAIL_MAX_RETRIES", 2)
+    flaky(500, times=10, path="/messages/")
+    with pytest.raises(HttpError) as error:
+        service.users().messages().get(userId='me', id=next(iter(mailbox.messages))).execute()
+
+    assert error.value.resp.status == 500
+    assert mailbox.http_requests == 3
+
+def test_send_is_not_retried_after_a_server_error(mailbox, service, flaky):
+    flaky(503, times=1, path="/messages/send")
+    message = MIMEText("Thanks!")
+    message['to'] = "alice@example.com"
+
+    assert send_email(service, 'me', message) is None
+    assert mailbox.http_requests == 1
+    assert not mailbox.sent
+
+def test_batch_retries_only_the_rate_limited_calls(mailbox, service, flaky):
+    ids = list(mailbox.messages)[:10]
+    # The first three gets inside the batch are rate limited
+    flaky(429, times=3, path="/messages/")
+    messages, failed_ids = batch_get_messages(service, 'me', ids)
+
+    assert failed_ids == []
+    assert set(messages) == set(ids)
+    assert mailbox.http_requests == 2
+    assert mailbox.api_calls["gmail.users.messages.get"] == 10
+
+def test_batch_reports_calls_that_never_succeed(mailbox, service, flaky):
+    ids = list(mailbox.messages)[:4]
+    flaky(429, times=100, path=f"/messages/{ids[0]}")
+    messages, failed_ids = batch_get_messages(service, 'me', ids, max_retries=2)
+
+    assert failed_ids == [ids[0]]
+    assert set(messages) == set(ids[1:])
+    assert mailbox.http_requests == 3
+
+def test_paced_calls_wait_for_quota(mailbox, service, monkeypatch):
+    bucket = QuotaBucket(rate=100, burst=10)
+    monkeypatch.setitem(gmail_service._quota_buckets, service._http.credentials, bucket)
+    msg_ids = list(mailbox.messages)[:4]
+
+    started = time.monotonic()
+    for msg_id in msg_ids:
+        service.users().messages().get(userId='me', id=msg_id).execute()
+    # 20 units with 10 in the bucket: the other 10 come in at 100 per second
+    assert time.monotonic() - started >= 0.08
@@ -0,0 +1,104 @@
+from email.mime.text import MIMEText
+
+from gmail_service import apply_label_to_email, batch_apply_label, batch_get_messages, send_email_once
+
+def label_names(mailbox, msg_id):
+    names = {label_id: name for name, label_id in mailbox.labels.items()}
+    return {names[label_id] for label_id in mailbox.messages[msg_id]['labelIds']}
+
+def reply(message_id="<reply-1@example.com>"):
+    message = MIMEText("Thanks, see you then.")
+    message['to'] = "alice@example.com"
+    message['subject'] = "Re: Meeting"
+    message['Message-ID'] = message_id
+    return message
+
+# --- Batching ---
+
+def test_batch_get_messages_fetches_in_chunks(mailbox, service):
+    ids = list(mailbox.messages)
+    messages, failed_ids = batch_get_messages(service, 'me', ids, chunk_size=8)
+
+    assert failed_ids == []
+    assert set(messages) == set(ids)
+    assert messages[ids[0]]['payload'] == mailbox.messages[ids[0]]['payload']
+    # 20 gets in batches of 8 are three round trips
+    assert mailbox.http_requests == 3
+    assert mailbox.api_calls["gmail.users.messages.get"] == 20
+
+def test_batch_get_messages_skips_duplicate_ids(mailbox, service):
+    ids = list(mailbox.messages)[:3]
+    messages, failed_ids = batch_get_messages(service, 'me', ids + ids)
+
+    assert set(messages) == set(ids)
+    assert failed_ids == []
+    assert mailbox.api_calls["gmail.users.messages.get"] == 3
+
+def test_batch_get_messages_reports_missing_messages_without_retrying(mailbox, service):
+    ids = list(mailbox.messages)[:3]
+    messages, failed_ids = batch_get_messages(service, 'me', ids + ["deleted"])
+
+    assert set(messages) == set(ids)
+    assert failed_ids == ["deleted"]
+    # A 404 will not go away, so the batch is not sent again
+    assert mailbox.http_requests == 1
+
+def test_batch_get_messages_in_metadata_format(mailbox, service):
+    msg_id = next(iter(mailbox.messages))
+    messages, _ = batch_get_messages(service, 'me', [msg_id], msg_format='metadata')
+
+    assert "parts" not in messages[msg_id]['payload']
+    assert messages[msg_id]['payload']['headers']
+
+# --- Labeling ---
+
+def test_batch_apply_label_uses_batch_modify(mailbox, service):
+    ids = list(mailbox.messages)
+    failed_ids = batch_apply_label(service, 'me', ids, "AI Processed", chunk_size=8)
+
+    assert failed_ids == []
+    assert all("AI Processed" in label_names(mailbox, msg_id) for msg_id in ids)
+    assert mailbox.api_calls["gmail.users.messages.batchModify"] == 3
+    assert mailbox.api_calls["gmail.users.messages.modify"] == 0
+    # The label is created once and its ID cached for the later chunks
+    assert mailbox.api_calls["gmail.users.labels.create"] == 1
+    assert mailbox.api_calls["gmail.users.labels.list"] == 1
+
+def test_batch_apply_label_returns_the_ids_of_failed_chunks(mailbox, service, monkeypatch):
+    original = mailbox._messages
+
+    def failing_batch_modify(method, parts, query, body):
+        if parts == ["batchModify"]:
+            return 400, {"error": {"code": 400, "message": "Invalid ids"}}
+        return original(method, parts, query, body)
+
+    monkeypatch.setattr(mailbox, "_messages", failing_batch_modify)
+    ids = list(mailbox.messages)[:5]
+    assert batch_apply_label(service, 'me', ids, "AI Processed") == ids
+
+def test_apply_label_to_email_reuses_the_label(mailbox, service):
+    first, second = list(mailbox.messages)[:2]
+    apply_label_to_email(service, 'me', first, "AI Processed")
+    apply_label_to_email(service, 'me', second, "AI Processed")
+
+    assert "AI Processed" in label_names(mailbox, first)
+    assert "AI Processed" in label_names(mailbox, second)
+    assert mailbox.api_calls["gmail.users.labels.create"] == 1
+    assert mailbox.api_calls["gmail.users.labels.list"] == 1
+
+# --- Sending ---
+
+def test_send_email_once_sends_a_reply_only_once(mailbox, service):
+    sent = send_email_once(service, 'me', reply())
+    assert sent['id'] and not sent.get('already_sent')
+
+    again = send_email_once(service, 'me', reply())
+    assert again == {'id': sent['id'], 'already_sent': True}
+    assert len(mailbox.sent) == 1
+    assert mailbox.api_calls["gmail.users.messages.send"] == 1
+
+def test_send_email_once_sends_different_replies(mailbox, service):
+    send_email_once(service, 'me', reply("<reply-1@example.com>"))
+    send_email_once(service, 'me', reply("<reply-2@example.com>"))
+
+    assert len(mailbox.sent) == 2
@@ -0,0 +1,79 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import rag_service
+from benchmarks.run import REPO_ROOT
+from knowledge_ingest import chunk_text, html_to_text, iter_note_files, sync_knowledge_base
+
+@pytest.fixture
+def notes(workdir):
+    folder = workdir / "notes"
+    folder.mkdir()
+    (folder / "atlas.md").write_text("Atlas budget is 40k.\nThe Atlas deadline is in March.\n")
+    (folder / "lunch.txt").write_text("Lunch with Bob on Fridays.\n")
+    (folder / "ignored.pdf").write_text("Not a note.\n")
+    return folder
+
+@pytest.fixture
+def collection(fake_llm):
+    return rag_service.get_collection()
+
+def test_chunks_are_whole_lines_that_overlap():
+    lines = [f"line {i:02d} " + "x" * 30 for i in range(20)]
+    chunks = chunk_text("\n".join(lines), chunk_size=200, overlap=90)
+
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 200 for chunk in chunks)
+    assert all(line in lines for chunk in chunks for line in chunk.splitlines())
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk.splitlines()[0] in previous.splitlines()
+
+def test_a_long_line_is_cut_into_pieces():
+    chunks = chunk_text("y" * 1200, chunk_size=500, overlap=100)
+    assert all(len(chunk) <= 500 for chunk in chunks)
+    assert "".join(chunks).count("y") > 1200
+
+def test_html_notes_are_read_as_text(notes):
+    assert html_to_text("<p>Hello <b>there</b></p><script>x()</script>").split() == ["Hello", "there"]
+    assert [path.name for path in iter_note_files([notes])] == ["atlas.md", "lunch.txt"]
+
+def test_only_changed_notes_are_read_again(notes, collection):
+    manifest = str(notes.parent / "kb_manifest.json")
+    first = sync_knowledge_base(collection, [notes], manifest_file=manifest)
+    assert first["files_read"] == 2 and first["added"] == 2 and first["removed"] == 0
+
+    second = sync_knowledge_base(collection, [notes], manifest_file=manifest)
+    assert second == {"files_read": 0, "added": 0, "removed": 0, "kept": 2}
+
+    (notes / "lunch.txt").write_text("Lunch with Bob moved to Thursdays.\n")
+    (notes / "atlas.md").unlink()
+    third = sync_knowledge_base(collection, [notes], manifest_file=manifest)
+    assert third == {"files_read": 1, "added": 1, "removed": 2, "kept": 0}
+    assert collection.get(include=["documents"])["documents"] == ["Lunch with Bob moved to Thursdays."]
+    assert list(json.loads(open(manifest).read())) == [str(notes / "lunch.txt")]
+
+def test_chunks_are_added_in_batches(notes, collection, monkeypatch):
+    batches = []
+    upsert = collection.upsert
+    monkeypatch.setattr(collection, "upsert", lambda ids, **kwargs: batches.append(len(ids)) or upsert(ids=ids, **kwargs))
+    (notes / "long.txt").write_text("\n".join(f"Fact number {i}." for i in range(200)))
+
+    result = sync_knowledge_base(collection, [notes], batch_size=3, chunk_size=200, overlap=40)
+    assert sum(batches) == result["added"] > 3
+    assert max(batches) == 3
+
+def test_without_a_manifest_file_none_is_written(notes, collection):
+    sync_knowledge_base(collection, [notes])
+    written = [name for _, _, files in os.walk(notes.parent) for name in files]
+    assert not any(name.endswith("kb_manifest.json") for name in written)
+
+def test_script_refuses_to_sync_without_notes():
+    completed = subprocess.run([sys.executable, "create_knowledge_base.py", "nobody"], cwd=REPO_ROOT,
+                               capture_output=True, text=True, timeout=60)
+
+    assert completed.returncode == 1
+    assert "ERROR: No notes found." in completed.stdout
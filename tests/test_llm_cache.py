@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+import llm_cache
+import llm_handler
+from llm_cache import LLMCache, get_llm_cache, normalize_content
+from llm_handler import (cache_lookup, cache_store, classify_and_reply_async, classify_and_reply_local,
+                         classify_email_intent_async, classify_email_intent_local, generate_reply_async,
+                         generate_reply_local)
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(llm_cache.time, "time", clock)
+    return clock
+
+def test_whitespace_and_case_do_not_change_the_content():
+    assert normalize_content("  Hello\n\tWORLD  ") == normalize_content("hello world")
+    assert normalize_content("Order 12345 shipped") != normalize_content("Order 67890 shipped")
+    assert normalize_content("Order 12345 shipped", strip_digits=True) == normalize_content("Order 67890 shipped",
+                                                                                            strip_digits=True)
+
+def test_keys_depend_on_kind_model_and_prompt_version():
+    key = LLMCache.make_key("classify", "Hello", "gemma3:4b", "1")
+    assert key == LLMCache.make_key("classify", " hello ", "gemma3:4b", "1")
+    assert key != LLMCache.make_key("reply", "Hello", "gemma3:4b", "1")
+    assert key != LLMCache.make_key("classify", "Hello", "llama3:8b", "1")
+    assert key != LLMCache.make_key("classify", "Hello", "gemma3:4b", "2")
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = LLMCache("cache.sqlite3", ttl=60)
+    cache.set("k", {"intent": "spam"})
+    clock.now += 59
+    assert cache.get("k") == {"intent": "spam"}
+    clock.now += 2
+    assert cache.get("k") is None
+    # The expired entry is gone, not just hidden
+    assert cache.stats()["entries"] == 0
+
+def test_the_least_recently_used_entries_are_evicted(clock):
+    cache = LLMCache("cache.sqlite3", max_entries=2)
+    cache.set("a", 1)
+    clock.now += 1
+    cache.set("b", 2)
+    clock.now += 1
+    cache.get("a")
+    clock.now += 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+def test_hits_and_misses_are_counted():
+    cache = LLMCache("cache.sqlite3")
+    cache.set("a", "reply")
+    cache.get("a")
+    cache.get("a")
+    cache.get("b")
+    assert cache.stats() == {"hits": 2, "misses": 1, "hit_rate": pytest.approx(2 / 3), "entries": 1}
+
+def test_entries_survive_a_restart():
+    LLMCache("cache.sqlite3").set("a", ["classification", "reply"])
+    assert LLMCache("cache.sqlite3").get("a") == ["classification", "reply"]
+
+def test_a_new_prompt_version_misses_the_old_entries(fake_llm, monkeypatch):
+    key, _ = cache_lookup("reply", "Can we meet?")
+    cache_store(key, "Sure.")
+    assert cache_lookup("reply", "can we   meet?")[1] == "Sure."
+
+    monkeypatch.setattr(llm_handler, "PROMPT_VERSION", "2")
+    assert cache_lookup("reply", "Can we meet?")[1] is None
+
+def test_classifications_ignore_numbers(fake_llm):
+    first = classify_email_intent_local("Your order 1234 has shipped. Track it with code 998877.")
+    second = classify_email_intent_local("Your order 5678 has shipped. Track it with code 112233.")
+    assert first == second
+    assert fake_llm._client.calls["classify"] == 1
+
+def test_caching_can_be_turned_off(fake_llm, monkeypatch):
+    monkeypatch.setattr(llm_cache, "LLM_CACHE_ENABLED", False)
+    assert get_llm_cache() is None
+    assert cache_lookup("reply", "Can we meet?") == (None, None)
+    cache_store(None, "Sure.")
+
+@pytest.mark.parametrize("call_sync, call_async, kind", [
+    (classify_email_intent_local, classify_email_intent_async, "classify"),
+    (lambda email: generate_reply_local(email, "information_request"),
+     lambda email: generate_reply_async(email, "information_request"), "reply"),
+    (classify_and_reply_local, classify_and_reply_async, "classify_and_reply"),
+])
+def test_blocking_and_async_calls_share_the_cache(fake_llm, call_sync, call_async, kind):
+    email = "Could you send me the latest figures?"
+    first = call_sync(email)
+    assert first and asyncio.run(call_async(email)) == first
+    assert fake_llm._client.calls[kind] == 1
+    assert fake_llm._async_client.calls[kind] == 0
+
+def test_a_failed_single_pass_call_returns_nothing_and_is_not_cached(fake_llm, monkeypatch):
+    def broken(messages, **kwargs):
+        raise ConnectionError("Ollama is not running")
+    monkeypatch.setattr(fake_llm, "chat", broken)
+    assert classify_and_reply_local("Could you send me the latest figures?") == (None, None)
+    assert cache_lookup("classify_and_reply", "\0Could you send me the latest figures?")[1] is None
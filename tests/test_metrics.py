@@ -0,0 +1,114 @@
+import json
+import logging
+
+import pytest
+
+import metrics
+from metrics import StructuredFormatter, inc, observe, register_collector, render_prometheus, stage
+
+@pytest.fixture
+def fresh_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, "_counters", {})
+    monkeypatch.setattr(metrics, "_histograms", {})
+    monkeypatch.setattr(metrics, "_collectors", [])
+
+def log_record(message, **fields):
+    record = logging.makeLogRecord({"name": "mail_assistant.test", "levelno": logging.INFO, "levelname": "INFO",
+                                    "msg": message})
+    record.__dict__.update(fields)
+    return record
+
+def test_counters_are_rendered_with_help_and_type(fresh_metrics):
+    inc("gmail_api_calls_total", method="gmail.users.messages.get")
+    inc("gmail_api_calls_total", 4, method="gmail.users.messages.get")
+    inc("gmail_api_calls_total", method="gmail.users.messages.send")
+
+    text = render_prometheus()
+    assert text.count("# TYPE mail_assistant_gmail_api_calls_total counter") == 1
+    assert "# HELP mail_assistant_gmail_api_calls_total Gmail and Calendar API calls" in text
+    assert 'mail_assistant_gmail_api_calls_total{method="gmail.users.messages.get"} 5\n' in text
+    assert 'mail_assistant_gmail_api_calls_total{method="gmail.users.messages.send"} 1\n' in text
+
+def test_label_values_are_escaped(fresh_metrics):
+    inc("stage_errors_total", stage='say "hi"\nback\\slash')
+    assert 'stage="say \\"hi\\"\\nback\\\\slash"' in render_prometheus()
+
+def test_histograms_have_cumulative_buckets(fresh_metrics):
+    for seconds in (0.001, 0.2, 0.3, 100):
+        observe("stage_seconds", seconds, stage="generate")
+
+    lines = render_prometheus().splitlines()
+    assert 'mail_assistant_stage_seconds_bucket{stage="generate",le="0.005"} 1' in lines
+    assert 'mail_assistant_stage_seconds_bucket{stage="generate",le="0.25"} 2' in lines
+    assert 'mail_assistant_stage_seconds_bucket{stage="generate",le="0.5"} 3' in lines
+    assert 'mail_assistant_stage_seconds_bucket{stage="generate",le="60.0"} 3' in lines
+    assert 'mail_assistant_stage_seconds_bucket{stage="generate",le="+Inf"} 4' in lines
+    assert 'mail_assistant_stage_seconds_count{stage="generate"} 4' in lines
+    assert 'mail_assistant_stage_seconds_sum{stage="generate"} 100.501' in lines
+
+def test_stage_times_blocks_and_counts_errors(fresh_metrics):
+    with stage("parse"):
+        pass
+    with pytest.raises(ValueError):
+        with stage("parse"):
+            raise ValueError("bad MIME")
+
+    @stage("classify")
+    def classify():
+        return "spam"
+
+    assert classify() == "spam"
+    text = render_prometheus()
+    assert 'mail_assistant_stage_seconds_count{stage="parse"} 2' in text
+    assert 'mail_assistant_stage_seconds_count{stage="classify"} 1' in text
+    assert 'mail_assistant_stage_errors_total{stage="parse"} 1' in text
+    assert 'stage_errors_total{stage="classify"}' not in text
+
+def test_collectors_are_asked_on_every_scrape(fresh_metrics):
+    calls = []
+
+    def collector():
+        calls.append(1)
+        return [("ollama_requests_total", "counter", "Ollama requests.", {"model": "gemma3:4b"}, len(calls))]
+
+    def broken():
+        raise RuntimeError("backend gone")
+
+    register_collector(broken)
+    register_collector(collector)
+    assert 'mail_assistant_ollama_requests_total{model="gemma3:4b"} 1' in render_prometheus()
+    # A failing collector is skipped, and the others still report
+    assert 'mail_assistant_ollama_requests_total{model="gemma3:4b"} 2' in render_prometheus()
+
+def test_text_log_lines_end_with_their_fields():
+    formatter = StructuredFormatter()
+    record = log_record("Message sent", msg_id="abc", subject="Lunch plans", attempt=2)
+    assert formatter.format(record) == 'Message sent msg_id=abc subject="Lunch plans" attempt=2'
+
+    warning = log_record("Gmail call failed", status=429)
+    warning.levelno, warning.levelname = logging.WARNING, "WARNING"
+    assert formatter.format(warning) == "WARNING: Gmail call failed status=429"
+
+def test_json_log_lines_are_one_object_each():
+    line = StructuredFormatter(json_lines=True).format(log_record("Applied label", label="ProcessedByAI", messages=3))
+    entry = json.loads(line)
+
+    assert "\n" not in line
+    assert entry["message"] == "Applied label"
+    assert entry["level"] == "INFO"
+    assert entry["logger"] == "mail_assistant.test"
+    assert entry["label"] == "ProcessedByAI" and entry["messages"] == 3
+
+def test_metrics_endpoint_reports_the_processing_stages(fake_llm, mailbox, service):
+    from fastapi.testclient import TestClient
+    import server
+
+    server.process_email_for_server(service, {'id': next(iter(mailbox.messages))})
+    response = TestClient(server.app).get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    for stage_name in ("parse", "classify", "generate", "send", "label"):
+        assert f'mail_assistant_stage_seconds_count{{stage="{stage_name}"}}' in response.text
+    assert 'mail_assistant_gmail_api_calls_total{method="gmail.users.messages.get"}' in response.text
+    assert "mail_assistant_ollama_" in response.text
@@ -0,0 +1,119 @@
+import base64
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from benchmarks.run import REPO_ROOT
+from mime_parser import (decode_part, extract_body, get_charset, payload_from_eml, select_text_parts,
+                         strip_quotes_and_signature)
+from token_budget import estimate_tokens
+
+FIXTURES = Path(__file__).parent / "fixtures" / "eml"
+
+def parse_fixture(name):
+    return extract_body(payload_from_eml((FIXTURES / name).read_bytes()))
+
+def text_part(text, mime_type="text/plain", charset="utf-8", **fields):
+    return dict({'mimeType': mime_type, 'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; charset="{charset}"'}],
+                 'body': {'data': base64.urlsafe_b64encode(text.encode(charset)).decode().rstrip("=")}}, **fields)
+
+def multipart(mime_type, *parts):
+    return {'mimeType': mime_type, 'headers': [], 'body': {}, 'parts': list(parts)}
+
+# --- The fixture corpus ---
+
+@pytest.mark.parametrize("name, kept, dropped", [
+    ("plain_reply_with_quote.eml", ["Could you add the budget review", "Thanks,\nAnn"],
+     ["draft agenda", "wrote:"]),
+    ("outlook_html_only.eml", ["the invoice total is 1.250 €. Café costs are included.", "Carol"],
+     ["Sent: Tuesday", "what is the total", "margin"]),
+    ("nested_mixed_alternative.eml", ["the contract draft for Phoenix is attached."], ["<b>", "%PDF"]),
+    ("latin1_base64.eml", ["können wir das Treffen", "Grüße\nJürgen"], []),
+    ("japanese_iso2022jp.eml", ["来週の会議の資料を送ってください。"], []),
+    ("forwarded_as_attachment.eml", ["Can you check the date?", "we confirm the conference room"], []),
+    ("newsletter_html_alternative.eml", ["Spring sale", "Everything 30% off until Sunday.\nShop now"],
+     ["track()", "color:red"]),
+    ("mobile_unknown_charset.eml", ["Running 10 minutes late, start without me."], ["Sent from my iPhone"]),
+])
+def test_fixture_bodies(name, kept, dropped):
+    body = parse_fixture(name)
+    assert all(text in body for text in kept), body
+    assert not any(text in body for text in dropped), body
+
+def test_every_fixture_has_a_body():
+    paths = sorted(FIXTURES.glob("*.eml"))
+    assert len(paths) >= 8
+    assert all(parse_fixture(path.name) for path in paths)
+
+def test_benchmark_runs_over_the_fixtures():
+    completed = subprocess.run([sys.executable, "mime_parser.py", str(FIXTURES)], cwd=REPO_ROOT,
+                               capture_output=True, text=True, timeout=60)
+    assert completed.returncode == 0, completed.stderr
+    assert "8 email(s):" in completed.stdout
+
+# --- Walking the MIME tree ---
+
+def test_nested_alternatives_prefer_plain_text():
+    payload = multipart("multipart/mixed",
+                        multipart("multipart/related",
+                                  multipart("multipart/alternative",
+                                            text_part("<p>HTML version</p>", "text/html"),
+                                            text_part("Plain version"))),
+                        text_part("Second inline part"))
+    assert extract_body(payload) == "Plain version\n\nSecond inline part"
+
+def test_html_is_used_when_there_is_no_plain_text():
+    payload = multipart("multipart/alternative",
+                        text_part("<html><body><p>Only <i>HTML</i> here</p><script>x()</script></body></html>",
+                                  "text/html"))
+    assert extract_body(payload) == "Only HTML here"
+
+def test_attachments_are_skipped():
+    attachment = text_part("secret,csv,data", filename="report.csv")
+    disposition = text_part("inline? no", headers=[{'name': 'Content-Disposition', 'value': 'attachment; filename="a.txt"'}])
+    payload = multipart("multipart/mixed", text_part("See attached."), attachment, disposition)
+    assert select_text_parts(payload) == [payload['parts'][0]]
+    assert extract_body(payload) == "See attached."
+
+# --- Charsets ---
+
+def test_charsets_are_honoured_and_unknown_ones_fall_back_to_utf8():
+    assert decode_part(text_part("Grüße", charset="iso-8859-1")) == "Grüße"
+    assert decode_part(text_part("Grüße", charset="cp1252")) == "Grüße"
+    assert get_charset({'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset=x-nonsense'}]}) == "utf-8"
+    assert get_charset({'headers': []}) == "utf-8"
+
+def test_parts_without_data_are_empty():
+    assert decode_part({'mimeType': 'text/plain', 'body': {'attachmentId': 'abc', 'size': 10 ** 7}}) == ""
+
+# --- Quotes and signatures ---
+
+def test_quoted_history_and_signatures_are_stripped():
+    assert strip_quotes_and_signature("Yes.\n\nOn Tue, 5 Mar 2024, Ann <ann@example.com> wrote:\n> Lunch?") == "Yes.\n"
+    assert strip_quotes_and_signature("Yes.\n-----Original Message-----\nFrom: Ann") == "Yes."
+    assert strip_quotes_and_signature("Yes.\n-- \nBob Marsh\nCEO") == "Yes."
+    assert strip_quotes_and_signature("Yes.\n> inline quote\nAnd more.") == "Yes.\nAnd more."
+
+def test_forwarded_headers_are_kept():
+    text = "FYI\n---------- Forwarded message ---------\nFrom: Ann <ann@example.com>\nDate: Tue, 5 Mar 2024\n\nThe venue is booked."
+    assert "The venue is booked." in strip_quotes_and_signature(text)
+
+# --- The safety cap ---
+
+def test_long_bodies_keep_their_start_and_end():
+    body = "Dear team,\n" + "\n".join(f"Line {i} of the report." for i in range(5000)) + "\nPlease confirm by noon."
+    extracted = extract_body(text_part(body), max_tokens=500)
+
+    assert estimate_tokens(extracted) <= 510
+    assert extracted.startswith("Dear team,")
+    assert extracted.endswith("Please confirm by noon.")
+
+def test_oversized_parts_are_decoded_from_both_ends():
+    text = "Start of the part. " + "filler " * 50000 + "The question at the end?"
+    decoded = decode_part(text_part(text), max_bytes=3000)
+
+    assert len(decoded) < 3100
+    assert decoded.startswith("Start of the part.")
+    assert decoded.endswith("The question at the end?")
@@ -0,0 +1,106 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from benchmarks.fake_gmail import header
+import main
+import server
+from pipeline import AsyncEmailPipeline, EmailPipeline
+from triage import estimate_priority
+from work_queue import WorkQueue
+
+class UnreachableOllama:
+    """An Ollama client whose server is down."""
+
+    def chat(self, *args, **kwargs):
+        raise ConnectionError("Ollama is not running")
+
+class UnreachableAsyncOllama:
+    async def chat(self, *args, **kwargs):
+        raise ConnectionError("Ollama is not running")
+
+def run_pipeline(kind, service, work_queue):
+    ids = work_queue.ready_ids()
+    if kind == "threads":
+        pipeline = EmailPipeline(service, main.parse_email, main.analyze_email, server.send_reply_for_server,
+                                 work_queue=work_queue, prioritize=estimate_priority)
+        pipeline.run(ids)
+    else:
+        pipeline = AsyncEmailPipeline(service, main.parse_email, main.analyze_email_async, server.send_reply_for_server,
+                                      ThreadPoolExecutor(max_workers=1), work_queue=work_queue,
+                                      prioritize=estimate_priority)
+        asyncio.run(pipeline.run(ids))
+    return pipeline
+
+def personal_message_id(mailbox):
+    """A message that needs a reply from the LLM (not bulk or automated mail)."""
+    return next(msg_id for msg_id, message in mailbox.messages.items() if message['labelIds'] == ["INBOX", "UNREAD"]
+                and "no-reply" not in header(message, "From") and not header(message, "List-Unsubscribe"))
+
+def replied_to(mailbox):
+    """The Message-IDs the sent replies answer."""
+    return {header(message, "In-Reply-To") for message in mailbox.sent}
+
+def labeled_ids(mailbox):
+    label_id = mailbox.labels.get("ProcessedByAI")
+    return {msg_id for msg_id, message in mailbox.messages.items() if label_id in message['labelIds']}
+
+@pytest.fixture
+def work_queue(mailbox):
+    queue = WorkQueue("work_queue.sqlite3")
+    queue.enqueue(list(mailbox.messages))
+    return queue
+
+@pytest.mark.parametrize("kind", ["threads", "asyncio"])
+def test_pipeline_answers_and_labels_every_email(kind, fake_llm, mailbox, service, work_queue):
+    pipeline = run_pipeline(kind, service, work_queue)
+
+    assert sorted(pipeline.processed_ids) == sorted(mailbox.messages)
+    assert labeled_ids(mailbox) == set(mailbox.messages)
+    assert mailbox.sent
+    assert work_queue.stats()["stages"]["labeled"] == len(mailbox.messages)
+    # The labels went out in batches, not one call per email
+    assert mailbox.api_calls["gmail.users.messages.modify"] == 0
+
+@pytest.mark.parametrize("kind", ["threads", "asyncio"])
+def test_emails_sent_before_a_crash_are_only_labeled(kind, fake_llm, mailbox, service, work_queue):
+    msg_id = personal_message_id(mailbox)
+    work_queue.advance(msg_id, "sent", outcome="Reply sent")
+    run_pipeline(kind, service, work_queue)
+
+    assert msg_id in labeled_ids(mailbox)
+    assert header(mailbox.messages[msg_id], "Message-ID") not in replied_to(mailbox)
+    assert mailbox.sent
+
+@pytest.mark.parametrize("kind", ["threads", "asyncio"])
+def test_stored_analyses_are_not_asked_again(kind, fake_llm, mailbox, service, work_queue, monkeypatch):
+    msg_id = personal_message_id(mailbox)
+    analysis = {"classification": {"intent": "information_request", "priority": "medium"},
+                "reply_body": "Stored reply from the previous run.", "context": None}
+    work_queue.advance(msg_id, "drafted", analysis=analysis)
+    analyzed = []
+    for name in ("analyze_email", "analyze_email_async"):
+        analyze = getattr(main, name)
+        monkeypatch.setattr(main, name, lambda email, *args, analyze=analyze, **kwargs: analyzed.append(email['id'])
+                            or analyze(email, *args, **kwargs))
+    run_pipeline(kind, service, work_queue)
+
+    assert analyzed and msg_id not in analyzed
+    assert header(mailbox.messages[msg_id], "Message-ID") in replied_to(mailbox)
+    assert msg_id in labeled_ids(mailbox)
+
+@pytest.mark.parametrize("kind", ["threads", "asyncio"])
+def test_llm_failures_are_retried_instead_of_labeled(kind, fake_llm, mailbox, service, work_queue, monkeypatch):
+    monkeypatch.setattr(fake_llm, "_client", UnreachableOllama())
+    monkeypatch.setattr(fake_llm, "_async_client", UnreachableAsyncOllama())
+    pipeline = run_pipeline(kind, service, work_queue)
+
+    # Only the mail triage settles without the LLM (bulk and automated mail) is finished
+    needs_llm = set(mailbox.messages) - labeled_ids(mailbox)
+    assert needs_llm
+    assert set(pipeline.failed_ids) == needs_llm
+    assert not mailbox.sent
+    stats = work_queue.stats()
+    assert stats["retrying"] == len(needs_llm)
+    assert stats["stages"]["labeled"] == len(mailbox.messages) - len(needs_llm)
@@ -0,0 +1,94 @@
+from collections import OrderedDict
+
+import pytest
+
+import rag_service
+from knowledge_ingest import sync_knowledge_base
+from rag_service import BM25Index, get_bm25_index, get_collection, retrieve_notes, select_results, tokenize
+
+NOTES = {
+    "atlas.txt": "Project Atlas budget is 40k, approved by Carol.",
+    "phoenix.txt": "Dana Lee is the contact for project Phoenix.",
+    "lunch.txt": "Team lunch is every Friday at noon.",
+}
+
+@pytest.fixture
+def notes(workdir):
+    folder = workdir / "notes"
+    folder.mkdir()
+    for name, text in NOTES.items():
+        (folder / name).write_text(text + "\n")
+    return folder
+
+@pytest.fixture
+def knowledge_base(fake_llm, notes, monkeypatch):
+    monkeypatch.setattr(rag_service, "_query_cache", OrderedDict())
+    collection = get_collection()
+    sync_knowledge_base(collection, [notes], manifest_file=rag_service.manifest_path())
+    return collection
+
+def count_rebuilds(monkeypatch):
+    builds = []
+    monkeypatch.setattr(rag_service, "BM25Index", lambda *args: builds.append(1) or BM25Index(*args))
+    return builds
+
+def test_stopwords_are_not_keywords():
+    assert tokenize("Who is the contact for Project-Phoenix?") == ["contact", "project", "phoenix"]
+
+def test_bm25_ranks_rare_terms_higher():
+    index = BM25Index(["a", "b", "c"], list(NOTES.values()))
+    matches = index.search("phoenix project", 3)
+    assert [index.ids[doc_index] for doc_index, _ in matches] == ["b", "a"]
+    assert index.search("unknownword", 3) == []
+
+def test_weak_results_are_left_out():
+    assert select_results([(0.2, "weak")]) == []
+    assert select_results([(0.9, "best"), (0.8, "close"), (0.5, "far")]) == ["best", "close"]
+    assert select_results([(0.9, str(i)) for i in range(10)], max_results=4) == ["0", "1", "2", "3"]
+
+def test_each_query_gets_its_own_notes(knowledge_base):
+    phoenix, atlas, nothing = retrieve_notes(["Who is the contact for Phoenix?", "What is the Atlas budget?",
+                                              "zebra"])
+    assert phoenix[0] == NOTES["phoenix.txt"]
+    assert atlas[0] == NOTES["atlas.txt"]
+    assert nothing == []
+
+def test_an_empty_knowledge_base_finds_nothing(fake_llm):
+    assert retrieve_notes(["Atlas budget", "Phoenix"]) == [[], []]
+    assert retrieve_notes([]) == []
+
+def test_repeated_queries_are_embedded_once(knowledge_base, monkeypatch):
+    from embedding_service import get_embedding_service
+    encoder = get_embedding_service()
+    encoded = []
+    encode = encoder.encode
+    monkeypatch.setattr(encoder, "encode", lambda texts, **kwargs: encoded.extend(texts) or encode(texts, **kwargs))
+
+    retrieve_notes(["Atlas budget", "Atlas budget", "Phoenix"])
+    retrieve_notes(["Atlas budget"])
+    assert encoded == ["Atlas budget", "Phoenix"]
+
+def test_bm25_index_is_reused_while_the_notes_are_unchanged(knowledge_base, monkeypatch):
+    get_bm25_index()
+    builds = count_rebuilds(monkeypatch)
+    get_bm25_index()
+    retrieve_notes(["Atlas budget"])
+    assert builds == []
+
+def test_bm25_index_is_rebuilt_after_a_sync(knowledge_base, notes, monkeypatch):
+    get_bm25_index()
+    builds = count_rebuilds(monkeypatch)
+    # An edit keeps the number of chunks, but the sync rewrites the manifest
+    (notes / "lunch.txt").write_text("Team lunch moved to Thursday.\n")
+    sync_knowledge_base(knowledge_base, [notes], manifest_file=rag_service.manifest_path())
+
+    assert "Team lunch moved to Thursday." in get_bm25_index().documents
+    assert builds == [1]
+
+def test_bm25_index_is_rebuilt_after_chunks_are_added(knowledge_base, monkeypatch):
+    get_bm25_index()
+    builds = count_rebuilds(monkeypatch)
+    knowledge_base.add(ids=["extra"], documents=["The office wifi password is on the fridge."])
+
+    assert "extra" in get_bm25_index().ids
+    assert builds == [1]
@@ -0,0 +1,133 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+import pytest
+
+import scheduler
+from scheduler import AsyncPriorityScheduler, PriorityScheduler, get_latency_stats, percentile, record_latency
+from triage import estimate_priority
+
+@pytest.fixture(autouse=True)
+def fresh_latencies(monkeypatch):
+    monkeypatch.setattr(scheduler, "_latencies", {priority: deque(maxlen=10) for priority in scheduler.PRIORITIES})
+    monkeypatch.setattr(scheduler, "_deadline_misses", {priority: 0 for priority in scheduler.PRIORITIES})
+
+def drain(queue):
+    items = []
+    while len(queue):
+        item, priority = queue.get()
+        queue.task_done(priority)
+        items.append(item)
+    return items
+
+def test_earliest_deadline_goes_first():
+    queue = PriorityScheduler(maxsize=10)
+    now = time.monotonic()
+    for item, priority in [("bulk", "low"), ("question", "medium"), ("urgent", "high")]:
+        queue.put(item, priority, enqueued_at=now)
+    assert drain(queue) == ["urgent", "question", "bulk"]
+
+def test_same_priority_keeps_arrival_order():
+    queue = PriorityScheduler(maxsize=10)
+    now = time.monotonic()
+    for index in range(5):
+        queue.put(index, "medium", enqueued_at=now)
+    assert drain(queue) == [0, 1, 2, 3, 4]
+
+def test_unknown_priorities_count_as_medium():
+    queue = PriorityScheduler(maxsize=10)
+    now = time.monotonic()
+    queue.put("medium", "medium", enqueued_at=now - 1)
+    queue.put("unknown", None, enqueued_at=now)
+    queue.put("high", "high", enqueued_at=now)
+    assert drain(queue) == ["high", "medium", "unknown"]
+
+def test_old_low_priority_mail_is_not_starved():
+    queue = PriorityScheduler(maxsize=10)
+    now = time.monotonic()
+    queue.put("fresh urgent", "high", enqueued_at=now)
+    # Past its deadline, so it goes before mail that is still within its own
+    queue.put("waited an hour", "low", enqueued_at=now - scheduler.PRIORITY_DEADLINES["low"])
+    assert drain(queue) == ["waited an hour", "fresh urgent"]
+
+def test_low_priority_mail_gets_at_most_half_the_workers():
+    queue = PriorityScheduler(maxsize=10, workers=2)
+    now = time.monotonic()
+    queue.put("bulk 1", "low", enqueued_at=now - 5000)
+    queue.put("bulk 2", "low", enqueued_at=now - 5000)
+    queue.put("question", "medium", enqueued_at=now)
+
+    assert queue.get() == ("bulk 1", "low")
+    # The second worker is kept for other mail while one is busy with bulk mail
+    assert queue.get() == ("question", "medium")
+    queue.task_done("low")
+    assert queue.get() == ("bulk 2", "low")
+
+def test_get_waits_for_work_and_ends_after_close():
+    queue = PriorityScheduler(maxsize=10)
+    results = []
+    worker = threading.Thread(target=lambda: results.extend([queue.get(), queue.get()]))
+    worker.start()
+    time.sleep(0.05)
+    queue.put("late", "high")
+    queue.close()
+    worker.join(timeout=5)
+
+    assert results == [("late", "high"), None]
+
+def test_put_waits_while_the_queue_is_full():
+    queue = PriorityScheduler(maxsize=1)
+    queue.put("first", "medium")
+    producer = threading.Thread(target=queue.put, args=("second", "medium"))
+    producer.start()
+    time.sleep(0.05)
+    assert producer.is_alive() and len(queue) == 1
+
+    queue.task_done(queue.get()[1])
+    producer.join(timeout=5)
+    assert queue.get() == ("second", "medium")
+
+def test_async_scheduler_orders_the_same_way():
+    async def run():
+        queue = AsyncPriorityScheduler(maxsize=10)
+        now = time.monotonic()
+        for item, priority in [("bulk", "low"), ("question", "medium"), ("urgent", "high")]:
+            await queue.put(item, priority, enqueued_at=now)
+        await queue.close()
+        items = []
+        while (entry := await queue.get()) is not None:
+            items.append(entry[0])
+            await queue.task_done(entry[1])
+        return items
+
+    assert asyncio.run(run()) == ["urgent", "question", "bulk"]
+
+def test_latency_stats_count_missed_deadlines():
+    for seconds in [1, 2, 3, 4, 100]:
+        record_latency("high", seconds)
+    record_latency("nonsense", 5)
+
+    stats = get_latency_stats()
+    assert stats["high"]["count"] == 5
+    assert stats["high"]["p50"] == 3
+    assert stats["high"]["p99"] == 100
+    assert stats["high"]["deadline_misses"] == 1
+    assert stats["medium"]["count"] == 1
+    assert stats["low"]["count"] == 0
+
+def test_percentile_is_nearest_rank():
+    assert percentile([], 0.5) == 0.0
+    assert percentile([1, 2, 3, 4], 0.5) == 2
+    assert percentile([1, 2, 3, 4], 0.95) == 4
+
+def test_estimate_priority_from_headers():
+    def email(subject="Lunch", sender="Alice <alice@example.com>", labels=("INBOX",), headers=None):
+        return {"subject": subject, "sender": sender, "label_ids": list(labels), "headers": headers or {}}
+
+    assert estimate_priority(email()) == "medium"
+    assert estimate_priority(email(labels=("INBOX", "IMPORTANT"))) == "high"
+    assert estimate_priority(email(subject="Action required: contract by EOD")) == "high"
+    assert estimate_priority(email(sender="no-reply@shop.example.com")) == "low"
+    assert estimate_priority(email(headers={"list-unsubscribe": "<mailto:x@example.com>"})) == "low"
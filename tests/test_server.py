@@ -0,0 +1,145 @@
+import time
+
+import pytest
+
+from benchmarks.fake_gmail import header
+from sync_service import build_push_notification, load_sync_state
+
+def wait_for(client, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] not in ("queued", "running"):
+            return job
+        assert time.monotonic() < deadline, f"job {job_id} did not finish"
+        time.sleep(0.02)
+
+def latest_job(client):
+    import server
+    return wait_for(client, next(reversed(server.jobs)))
+
+def test_process_emails_answers_and_labels_the_inbox(client, mailbox):
+    started = client.post("/process-emails")
+    assert started.status_code == 202
+    job = wait_for(client, started.json()["job_id"])
+
+    assert job["status"] == "succeeded"
+    assert job["emails"] == len(mailbox.messages)
+    assert mailbox.sent
+    processed = mailbox.labels["ProcessedByAI"]
+    assert all(processed in message['labelIds'] for message in mailbox.messages.values())
+
+def test_push_processes_only_the_new_message(client, mailbox, default_tenant, new_message):
+    wait_for(client, client.post("/process-emails").json()["job_id"])
+    mailbox.reset_stats()
+
+    message = new_message
+    history_id = mailbox.add_message(message)
+    response = client.post("/gmail/push", json=build_push_notification("me@example.com", history_id))
+    assert response.status_code == 204
+    job = latest_job(client)
+
+    assert job["status"] == "succeeded"
+    assert job["emails"] == 1
+    assert len(job["details"]) == 1 and header(message, "Subject") in job["details"][0]
+    assert mailbox.labels["ProcessedByAI"] in mailbox.messages[message['id']]['labelIds']
+    # The incremental sync read the history instead of listing the inbox
+    assert mailbox.api_calls["gmail.users.history.list"] >= 1
+    assert mailbox.api_calls["gmail.users.messages.get"] == 1
+    assert int(load_sync_state(default_tenant.sync_state_file)["history_id"]) >= history_id
+
+def test_repeated_push_starts_no_job(client, mailbox, new_message):
+    import server
+    wait_for(client, client.post("/process-emails").json()["job_id"])
+    history_id = mailbox.add_message(new_message)
+    client.post("/gmail/push", json=build_push_notification("me@example.com", history_id))
+    latest_job(client)
+    jobs = len(server.jobs)
+
+    response = client.post("/gmail/push", json=build_push_notification("me@example.com", history_id))
+    assert response.status_code == 204
+    assert len(server.jobs) == jobs
+
+def test_push_for_an_unknown_address_is_ignored(client):
+    import server
+    response = client.post("/gmail/push", json=build_push_notification("someone@else.com", 99999))
+    assert response.status_code == 204
+    assert not server.jobs
+    # It does not count as a working push either, so the fallback poll keeps going
+    assert server._last_push_at is None
+
+def test_push_processes_only_the_notified_account(accounts, fake_llm, server_state):
+    from fastapi.testclient import TestClient
+    _, mailboxes = accounts
+
+    with TestClient(server_state.app) as client:
+        response = client.post("/gmail/push", json=build_push_notification("home@example.com", 99999))
+        assert response.status_code == 204
+        job = latest_job(client)
+
+    assert job["status"] == "succeeded"
+    assert job["accounts"] == ["home"]
+    assert job["emails"] == len(mailboxes["home"].messages)
+    assert server_state._last_push_at is not None
+    # The other account's mailbox was not even listed
+    assert mailboxes["work"].api_calls["gmail.users.messages.list"] == 0
+    assert mailboxes["work"].api_calls["gmail.users.history.list"] == 0
+
+def test_a_push_during_a_job_reruns_only_its_account(accounts, fake_llm, server_state):
+    import asyncio
+    server = server_state
+    work = accounts[0].get("work")
+
+    async def run():
+        first, _ = server.request_processing()
+        _, started = server.request_processing(work)
+        assert not started
+        await first['task']
+        # The rerun was started when the first job finished
+        rerun = server.jobs[next(reversed(server.jobs))]
+        await rerun['task']
+        return first, rerun
+
+    first, rerun = asyncio.run(run())
+    assert first["accounts"] is None and first["emails"] == 12
+    assert rerun["accounts"] == ["work"] and rerun["status"] == "succeeded"
+
+def test_unreadable_push_is_acknowledged(client):
+    import server
+    response = client.post("/gmail/push", json={"message": {"data": "???"}})
+    assert response.status_code == 204
+    assert not server.jobs
+
+def test_push_needs_the_token_when_one_is_set(client, monkeypatch):
+    import server
+    monkeypatch.setattr(server, "GMAIL_PUSH_TOKEN", "secret")
+    body = build_push_notification("me@example.com", 1)
+    assert client.post("/gmail/push?token=wrong", json=body).status_code == 403
+    assert client.post("/gmail/push?token=secret", json=body).status_code == 204
+
+def test_fake_push_posts_for_the_address_of_an_account(accounts, monkeypatch, capsys):
+    import contextlib
+    import json
+    import runpy
+    import sys
+    import urllib.request
+    from sync_service import parse_push_notification
+    posted = []
+
+    @contextlib.contextmanager
+    def urlopen(request):
+        posted.append(parse_push_notification(json.loads(request.data)))
+        yield type("Response", (), {"status": 204})
+
+    monkeypatch.setattr(urllib.request, "urlopen", urlopen)
+    monkeypatch.setattr(sys, "argv", ["fake_push.py", "home"])
+    runpy.run_module("fake_push", run_name="__main__")
+    monkeypatch.setattr(sys, "argv", ["fake_push.py", "work", "42"])
+    runpy.run_module("fake_push", run_name="__main__")
+
+    assert posted == [("home@example.com", 1), ("work@example.com", 42)]
+    assert "home@example.com (home)" in capsys.readouterr().out
+
+    monkeypatch.setattr(sys, "argv", ["fake_push.py", "nobody"])
+    with pytest.raises(SystemExit):
+        runpy.run_module("fake_push", run_name="__main__")
@@ -0,0 +1,148 @@
+import asyncio
+import builtins
+import json
+import time
+
+import pytest
+
+import llm_handler
+import main
+import server
+from llm_handler import cache_lookup, generate_reply_stream_async, generate_reply_stream_local, reply_cache_content
+
+EMAIL_CONTENT = "Subject: Budget\n\nCould you send me the current Atlas budget?"
+
+class CutOffOllama:
+    """An Ollama client whose streams end before the final chunk, like a dropped connection."""
+
+    def __init__(self, pieces=("Sure, ", "the budget")):
+        self.pieces = pieces
+
+    def chat(self, model, messages, stream=False, **kwargs):
+        return ({"message": {"content": piece}, "done": False} for piece in self.pieces)
+
+def cached_reply(email_content=EMAIL_CONTENT, intent="information_request"):
+    return cache_lookup('reply', reply_cache_content(email_content, intent, None))[1]
+
+def parsed_email(mailbox, msg_id=None):
+    message = mailbox.messages[msg_id or next(iter(mailbox.messages))]
+    return main.parse_email(message)
+
+def test_streamed_reply_comes_in_pieces_and_is_cached(fake_llm):
+    pieces = list(generate_reply_stream_local(EMAIL_CONTENT, "information_request"))
+
+    assert len(pieces) > 1
+    assert cached_reply() == "".join(pieces)
+    # Served from the cache the second time, in one piece
+    assert list(generate_reply_stream_local(EMAIL_CONTENT, "information_request")) == ["".join(pieces)]
+
+def test_async_stream_matches_the_sync_one(fake_llm):
+    async def collect():
+        return [piece async for piece in generate_reply_stream_async(EMAIL_CONTENT, "information_request")]
+
+    assert "".join(asyncio.run(collect())) == cached_reply()
+
+@pytest.mark.parametrize("pieces", [("Sure, ", "the budget"), ()])
+def test_cut_off_streams_are_not_cached(fake_llm, monkeypatch, pieces):
+    monkeypatch.setattr(fake_llm, "_client", CutOffOllama(pieces))
+    assert "".join(generate_reply_stream_local(EMAIL_CONTENT, "information_request")) == "".join(pieces)
+    assert cached_reply() is None
+
+def test_empty_replies_are_not_cached(fake_llm):
+    key, _ = cache_lookup('reply', "some content")
+    llm_handler.cache_store(key, "")
+    assert cache_lookup('reply', "some content")[1] is None
+
+def test_deferred_reply_is_streamed_to_the_prompt(fake_llm, mailbox, service, monkeypatch, capsys):
+    monkeypatch.setattr(builtins, "input", lambda prompt="": "yes")
+    email = parsed_email(mailbox)
+    analysis = {'classification': {'intent': 'information_request'}, 'reply_body': None, 'deferred': True,
+                'context': None}
+
+    assert main.confirm_and_send(service, email, analysis) == "AI-generated reply sent."
+    reply = cached_reply(email['content_for_llm'])
+    assert reply and reply in capsys.readouterr().out
+    assert len(mailbox.sent) == 1
+
+def test_an_empty_stream_is_not_sent(fake_llm, mailbox, service, monkeypatch):
+    monkeypatch.setattr(fake_llm, "_client", CutOffOllama(()))
+    monkeypatch.setattr(builtins, "input", lambda prompt="": "yes")
+    analysis = {'classification': {'intent': 'information_request'}, 'reply_body': None, 'deferred': True,
+                'context': None}
+
+    with pytest.raises(RuntimeError):
+        main.confirm_and_send(service, parsed_email(mailbox), analysis)
+    assert not mailbox.sent
+
+def test_server_writes_the_reply_of_a_deferred_analysis(fake_llm, mailbox, service):
+    email = parsed_email(mailbox)
+    analysis = {'classification': {'intent': 'information_request'}, 'reply_body': None, 'deferred': True,
+                'context': None}
+
+    outcome = server.send_reply_for_server(service, email, analysis)
+    assert outcome.endswith("AI-generated reply sent.")
+    assert len(mailbox.sent) == 1
+
+@pytest.mark.parametrize("stream_replies", [False, True])
+def test_replies_are_only_deferred_when_streaming(fake_llm, mailbox, service, monkeypatch, stream_replies):
+    monkeypatch.setattr(builtins, "input", lambda prompt="": "no")
+    analyses = []
+    analyze = main.analyze_email
+    monkeypatch.setattr(main, "analyze_email", lambda *args, **kwargs: analyses.append(analyze(*args, **kwargs))
+                        or analyses[-1])
+    monkeypatch.setattr(main, "STREAM_REPLIES", stream_replies)
+
+    main.process_single_email(service, {'id': parsed_email(mailbox)['id']})
+    assert bool(analyses[0].get('deferred')) == stream_replies
+
+def read_events(response):
+    events = []
+    event = None
+    for line in response.iter_lines():
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            events.append((event, json.loads(line[len("data: "):])))
+            if event == "done":
+                break
+    return events
+
+def test_stream_follows_a_job_from_the_start(client, mailbox, monkeypatch):
+    collect_new_mail = server.collect_new_mail
+
+    def collect_once_followed(tenant):
+        # The job waits for the stream to start following it, so no event is missed
+        deadline = time.monotonic() + 10
+        while not server.jobs[server._running_job_id]['listeners'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return collect_new_mail(tenant)
+
+    monkeypatch.setattr(server, "collect_new_mail", collect_once_followed)
+    job_id = client.post("/process-emails").json()["job_id"]
+    with client.stream("GET", f"/jobs/{job_id}/stream") as response:
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = read_events(response)
+
+    kinds = [event for event, _ in events]
+    assert kinds[0] == "job" and events[0][1]["job_id"] == job_id
+    assert kinds[-1] == "done"
+    assert kinds.count("email") == len(mailbox.messages)
+    assert kinds.count("outcome") == len(mailbox.messages)
+    assert "token" in kinds
+    assert events[-1][1]["status"] == "succeeded"
+
+def test_stream_of_a_finished_job_ends_at_once(client, mailbox):
+    job_id = client.post("/process-emails").json()["job_id"]
+    task = server.jobs[job_id]['task']
+    while not task.done():
+        time.sleep(0.02)
+
+    with client.stream("GET", f"/jobs/{job_id}/stream") as response:
+        events = read_events(response)
+    assert [event for event, _ in events] == ["job", "done"]
+    assert len(events[0][1]["details"]) == len(mailbox.messages)
+
+def test_streaming_starts_no_job(client):
+    assert client.get("/jobs/unknown/stream").status_code == 404
+    assert client.get("/process-emails/stream").status_code in (404, 405)
+    assert not server.jobs
@@ -0,0 +1,69 @@
+from sync_service import (AdaptivePollInterval, build_push_notification, get_new_message_ids, is_history_processed,
+                          load_sync_state, parse_push_notification, save_sync_state)
+
+def test_first_sync_scans_the_whole_inbox(mailbox, service):
+    msg_ids, history_id = get_new_message_ids(service)
+
+    assert set(msg_ids) == set(mailbox.messages)
+    assert int(history_id) == mailbox.history_id
+    assert mailbox.api_calls["gmail.users.history.list"] == 0
+
+def test_later_syncs_only_list_new_mail(mailbox, service, new_message):
+    _, history_id = get_new_message_ids(service)
+    save_sync_state(history_id)
+    mailbox.reset_stats()
+
+    message = new_message
+    mailbox.add_message(message)
+    msg_ids, latest = get_new_message_ids(service)
+
+    assert msg_ids == [message['id']]
+    assert int(latest) == mailbox.history_id
+    assert mailbox.api_calls["gmail.users.messages.list"] == 0
+
+def test_sync_ignores_label_changes_and_sent_mail(mailbox, service):
+    _, history_id = get_new_message_ids(service)
+    save_sync_state(history_id)
+
+    msg_id = next(iter(mailbox.messages))
+    service.users().messages().modify(userId='me', id=msg_id, body={'removeLabelIds': ['UNREAD']}).execute()
+    assert get_new_message_ids(service)[0] == []
+
+def test_pending_ids_are_returned_again(mailbox, service):
+    _, history_id = get_new_message_ids(service)
+    save_sync_state(history_id, pending_ids=["left-over"])
+
+    msg_ids, _ = get_new_message_ids(service)
+    assert msg_ids == ["left-over"]
+
+def test_expired_history_falls_back_to_a_full_scan(mailbox, service):
+    save_sync_state(str(mailbox.first_history_id - 500))
+
+    msg_ids, _ = get_new_message_ids(service)
+    assert set(msg_ids) == set(mailbox.messages)
+    assert mailbox.api_calls["gmail.users.messages.list"] == 1
+
+def test_push_notifications_round_trip():
+    body = build_push_notification("me@example.com", 4321)
+    assert parse_push_notification(body) == ("me@example.com", 4321)
+
+def test_malformed_push_notifications_are_rejected():
+    for body in ({}, {"message": {"data": "bm90IGpzb24="}}, None):
+        try:
+            parse_push_notification(body)
+        except ValueError:
+            continue
+        raise AssertionError(f"{body!r} was accepted")
+
+def test_history_is_processed_up_to_the_saved_id():
+    assert not is_history_processed(10)
+    save_sync_state("10")
+    assert is_history_processed(10)
+    assert is_history_processed(9)
+    assert not is_history_processed(11)
+    assert load_sync_state()["history_id"] == "10"
+
+def test_poll_interval_backs_off_while_idle():
+    interval = AdaptivePollInterval(min_interval=60, max_interval=600)
+    assert [interval.next(found_mail=False) for _ in range(5)] == [120, 240, 480, 600, 600]
+    assert interval.next(found_mail=True) == 60
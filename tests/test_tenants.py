@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+from tenants import TenantRegistry, collect_new_mail, fair_batches
+from sync_service import load_sync_state
+
+def add_token(name):
+    os.makedirs("tokens", exist_ok=True)
+    with open(os.path.join("tokens", name + ".json"), "w") as f:
+        f.write("{}")
+
+# --- Taking turns ---
+
+def test_accounts_take_turns_a_quantum_at_a_time():
+    ready = {"a": list(range(60)), "b": list(range(30))}
+    batches = [(tenant, len(ids)) for tenant, ids in fair_batches(ready, quantum=25)]
+    # Once only one account has mail left, the rest of it goes in one batch
+    assert batches == [("a", 25), ("b", 25), ("a", 25), ("b", 5), ("a", 10)]
+
+def test_a_single_account_is_not_sliced():
+    assert [(tenant, len(ids)) for tenant, ids in fair_batches({"a": list(range(120))}, quantum=25)] == [("a", 120)]
+
+def test_batches_keep_the_order_and_skip_empty_accounts():
+    ready = {"a": ["a1", "a2", "a3"], "b": [], "c": ["c1"]}
+    assert list(fair_batches(ready, quantum=2)) == [("a", ["a1", "a2"]), ("c", ["c1"]), ("a", ["a3"])]
+    assert list(fair_batches({})) == []
+
+# --- Accounts ---
+
+def test_without_token_files_there_is_only_the_default_account():
+    tenants = TenantRegistry().tenants()
+    assert [tenant.name for tenant in tenants] == ["default"]
+    assert tenants[0].token_file == "token.json"
+    # The default account keeps its state files where they always were
+    assert tenants[0].sync_state_file == "sync_state.json"
+
+def test_every_token_file_is_an_account():
+    add_token("work")
+    add_token("home")
+    add_token("bad name")
+    registry = TenantRegistry()
+    assert [tenant.name for tenant in registry.tenants()] == ["home", "work"]
+
+    add_token("later")
+    assert [tenant.name for tenant in registry.tenants()] == ["home", "later", "work"]
+    # The same Tenant object is returned every time, so its service and caches are reused
+    assert registry.get("work") is registry.get("work")
+
+def test_get_without_a_name_falls_back_to_the_first_account():
+    add_token("work")
+    registry = TenantRegistry()
+    assert registry.get().name == "work"
+    with pytest.raises(KeyError):
+        registry.get("nobody")
+
+def test_accounts_keep_their_state_apart(accounts):
+    registry, _ = accounts
+    work, home = registry.get("work"), registry.get("home")
+
+    assert work.sync_state_file == os.path.join("accounts", "work", "sync_state.json")
+    assert work.work_queue() is not home.work_queue()
+    assert work.thread_store() is not home.thread_store()
+    assert os.path.exists(os.path.join("accounts", "home", "work_queue.sqlite3"))
+
+def test_collect_new_mail_queues_each_mailbox_separately(accounts):
+    registry, mailboxes = accounts
+    for tenant in registry.tenants():
+        msg_ids = collect_new_mail(tenant)
+        assert set(msg_ids) == set(mailboxes[tenant.name].messages)
+        assert int(load_sync_state(tenant.sync_state_file)["history_id"]) == mailboxes[tenant.name].history_id
+
+    # Nothing is finished yet, so the queued mail is still ready; nothing new was found
+    work = registry.get("work")
+    assert set(collect_new_mail(work)) == set(mailboxes["work"].messages)
+    assert mailboxes["work"].api_calls["gmail.users.messages.list"] == 1
+
+def test_find_by_email_asks_each_account_once(accounts):
+    registry, mailboxes = accounts
+    assert registry.find_by_email("HOME@example.com").name == "home"
+    assert registry.find_by_email("work@example.com").name == "work"
+    assert registry.find_by_email("stranger@example.com") is None
+    assert mailboxes["home"].api_calls["gmail.users.getProfile"] == 1
+
+def test_server_processes_every_account(accounts, fake_llm, server_state):
+    import asyncio
+    registry, mailboxes = accounts
+
+    async def run():
+        job, _ = server_state.start_processing_job()
+        await job['task']
+        return job
+
+    job = asyncio.run(run())
+    assert job['status'] == "succeeded"
+    assert job['message'] == "Processed 12 of 12 email(s) in 2 account(s)."
+    for name, mailbox in mailboxes.items():
+        processed = mailbox.labels["ProcessedByAI"]
+        assert all(processed in message['labelIds'] for message in mailbox.messages.values()), name
@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+from benchmarks.fake_gmail import header
+from thread_store import ThreadStore, summarize
+
+def email(msg_id, thread_id, body, sent_at, sender="Alice <alice@example.com>", replies_to=None):
+    """A parsed email the way main.parse_email returns it, with only the fields the store uses."""
+    return {
+        'id': msg_id, 'thread_id': thread_id, 'message_id_header': f"<{msg_id}@example.com>",
+        'internal_date': sent_at, 'sender': sender, 'body': body,
+        'headers': {'in-reply-to': replies_to} if replies_to else {},
+    }
+
+@pytest.fixture
+def store():
+    return ThreadStore("thread_store.sqlite3")
+
+def test_history_lists_earlier_messages_oldest_first(store, service):
+    first = email("m1", "t1", "Can we meet on Tuesday?", 1_700_000_000_000)
+    second = email("m2", "t1", "Tuesday works, 10:00?", 1_700_000_060_000, sender="Bob <bob@example.com>",
+                   replies_to="<m1@example.com>")
+    third = email("m3", "t1", "Great, see you then.", 1_700_000_120_000, replies_to="<m2@example.com>")
+    store.fill_gaps(service, [first, second, third])
+
+    assert first['thread_history'] is None
+    history = third['thread_history'].splitlines()
+    assert "Alice <alice@example.com>: Can we meet on Tuesday?" in history[1]
+    assert "Bob <bob@example.com>: Tuesday works, 10:00?" in history[2]
+    assert len(history) == 3
+    # Everything the emails refer to was known, so Gmail was not asked
+    assert store.requests == 0
+
+def test_other_threads_do_not_leak_into_the_history(store, service):
+    store.record_emails([email("m1", "t1", "About the budget", 1_700_000_000_000)])
+    other = email("m2", "t2", "Unrelated", 1_700_000_060_000)
+    store.fill_gaps(service, [other])
+    assert other['thread_history'] is None
+
+def test_unknown_references_fetch_the_thread_once(store, mailbox, service):
+    original = next(iter(mailbox.messages.values()))
+    reply = email("new", original['threadId'], "Any news on this?", int(original['internalDate']) + 60_000,
+                  replies_to=header(original, "Message-ID"))
+    store.fill_gaps(service, [reply])
+
+    assert store.requests == 1
+    assert mailbox.api_calls["gmail.users.threads.get"] == 1
+    assert original['snippet'][:40] in reply['thread_history']
+
+    # The thread is now known, so the next email in it needs no request
+    follow_up = email("newer", original['threadId'], "Ping", int(original['internalDate']) + 120_000,
+                      replies_to=header(original, "Message-ID"))
+    store.fill_gaps(service, [follow_up])
+    assert store.requests == 1
+
+def test_references_gmail_does_not_have_are_not_fetched_again(store, mailbox, service):
+    original = next(iter(mailbox.messages.values()))
+    reply = email("new", original['threadId'], "Re: list mail", int(original['internalDate']) + 60_000,
+                  replies_to="<never-delivered@lists.example.com>")
+    store.fill_gaps(service, [reply])
+    assert store.requests == 1
+
+    store.fill_gaps(service, [dict(reply, id="again")])
+    assert store.requests == 1
+    assert not store.unknown_references(reply)
+
+def test_sent_replies_are_part_of_the_history(store, service):
+    question = email("m1", "t1", "Could you send the report?", int(time.time() * 1000) - 60_000)
+    store.record_emails([question])
+    store.record_reply(question, "<reply-m1@example.com>", "Sure, attached.")
+
+    follow_up = email("m2", "t1", "Thanks!", int(time.time() * 1000) + 1000, replies_to="<reply-m1@example.com>")
+    store.fill_gaps(service, [follow_up])
+    assert "Me: Sure, attached." in follow_up['thread_history']
+    assert store.requests == 0
+
+def test_history_keeps_only_the_latest_messages(store, service):
+    emails = [email(f"m{i}", "t1", f"message {i}", 1_700_000_000_000 + i * 60_000) for i in range(10)]
+    store.fill_gaps(service, emails)
+
+    lines = emails[-1]['thread_history'].splitlines()[1:]
+    assert [line.rsplit(": ", 1)[1] for line in lines] == ["message 5", "message 6", "message 7", "message 8"]
+
+def test_prune_forgets_old_messages(store):
+    store.record_emails([email("m1", "t1", "old", 1_700_000_000_000)])
+    store.prune(retention_days=-1)
+    assert store.history(email("m2", "t1", "new", 1_700_000_060_000)) is None
+
+def test_store_survives_a_restart(service):
+    ThreadStore("thread_store.sqlite3").record_emails([email("m1", "t1", "Before the restart", 1_700_000_000_000)])
+    history = ThreadStore("thread_store.sqlite3").history(email("m2", "t1", "After", 1_700_000_060_000))
+    assert "Before the restart" in history
+
+def test_summarize_cuts_at_a_word():
+    assert summarize("  short\n text ") == "short text"
+    summary = summarize("word " * 100, max_chars=22)
+    assert summary == "word word word word..."
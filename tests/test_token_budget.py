@@ -0,0 +1,114 @@
+import base64
+
+import pytest
+
+from mime_parser import extract_body
+from token_budget import TokenBudget, context_items, estimate_tokens, join_context, truncate_head_tail
+
+def build_messages(email_content, context):
+    system = "You are an email assistant."
+    user = f"Context:\n{context}\n\nEmail:\n{email_content}" if context else f"Email:\n{email_content}"
+    return [{'role': 'system', 'content': system}, {'role': 'user', 'content': user}]
+
+def words(count, word="word"):
+    return " ".join(f"{word}{i}" for i in range(count))
+
+@pytest.fixture
+def budget():
+    return TokenBudget(num_ctx=2048, num_predict=512, classify_predict=64, classify_budget=512)
+
+def test_budgets_leave_room_for_the_answer(budget):
+    assert budget.budgets == {"classify": 512, "reply": 1536, "classify_and_reply": 1536}
+    assert TokenBudget(num_ctx=512, num_predict=128, classify_predict=64).budgets["classify"] == 448
+
+def test_tokens_are_estimated_from_the_length():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd") == 1
+    assert estimate_tokens("abcde") == 2
+    assert estimate_tokens("abcdef", chars_per_token=2) == 3
+
+def test_head_and_tail_are_kept():
+    text = "Hi Bob, " + words(500) + " Can you send the report by Friday? Thanks, Ann"
+    cut = truncate_head_tail(text, 100)
+
+    assert cut.startswith("Hi Bob, word0 ")
+    assert cut.endswith("by Friday? Thanks, Ann")
+    assert "\n[...]\n" in cut
+    assert len(cut) <= 400
+    # The start gets the larger share
+    head, tail = cut.split("\n[...]\n")
+    assert len(head) > len(tail)
+    assert truncate_head_tail("short", 100) == "short"
+
+def test_a_short_prompt_is_left_alone(budget):
+    email, context, messages = budget.fit("reply", build_messages, "Lunch?", ["Bob likes sushi."])
+    assert email == "Lunch?"
+    assert context == "Bob likes sushi."
+    assert messages == build_messages("Lunch?", "Bob likes sushi.")
+
+def test_a_long_email_keeps_its_start_and_end(budget):
+    email = "Hello, " + words(2000) + " what time works for you?"
+    fitted, _, messages = budget.fit("classify", build_messages, email)
+
+    assert fitted.startswith("Hello, ") and fitted.endswith("what time works for you?")
+    assert budget.count_messages(messages) <= budget.budgets["classify"]
+
+def test_the_least_relevant_context_is_dropped_first(budget):
+    notes = [f"note {rank}: " + words(150, f"n{rank}_") for rank in range(6)]
+    email = "Could you send me the budget? " + words(100)
+    fitted, context, messages = budget.fit("reply", build_messages, email, notes)
+
+    kept = context.split("\n\n")
+    assert fitted == email
+    assert kept == notes[:len(kept)]
+    assert 0 < len(kept) < len(notes)
+    assert budget.count_messages(messages) <= budget.budgets["reply"]
+    assert budget.stats()["reply"]["context_dropped"] == len(notes) - len(kept)
+
+def test_the_email_keeps_its_share_when_the_context_is_long(budget):
+    fitted, context, _ = budget.fit("reply", build_messages, words(3000), [words(3000, "note")])
+
+    available = int(budget.budgets["reply"] * 0.9) - budget.count_messages(build_messages("", None))
+    assert budget.count(fitted) >= available // 2 - 5
+    assert context and "[...]" in context
+
+def test_record_calibrates_the_estimate(budget):
+    messages = build_messages("x" * 3000, None)
+    chars = sum(len(message['content']) for message in messages)
+    # The model turned out to use 3 characters per token
+    for _ in range(30):
+        budget.record("classify", messages, {'prompt_eval_count': chars // 3 + 8})
+    assert budget.chars_per_token == pytest.approx(3.0, abs=0.05)
+
+def test_record_ignores_cached_prefixes_and_missing_counts(budget):
+    messages = build_messages("x" * 3000, None)
+    budget.record("classify", messages, {'prompt_eval_count': 20})
+    budget.record("classify", messages, {})
+    budget.record("classify", messages, None)
+    assert budget.chars_per_token == 4.0
+
+def test_stats_report_prompt_tokens_per_stage(budget):
+    _, _, messages = budget.fit("classify", build_messages, "Lunch?")
+    estimated = budget.count_messages(messages)
+    budget.record("classify", messages, {'prompt_eval_count': 40})
+    stats = budget.stats()["classify"]
+
+    assert stats["calls"] == 1 and stats["budget"] == 512
+    assert stats["prompt_tokens_per_call"] == 40
+    assert stats["estimated_tokens_per_call"] == estimated
+
+def test_context_items_and_join():
+    assert context_items(None) == []
+    assert context_items("one") == ["one"]
+    assert context_items(["one", "", None, "two"]) == ["one", "two"]
+    assert join_context([]) is None
+    assert join_context(["one", "two"]) == "one\n\ntwo"
+
+def test_the_end_of_a_long_email_reaches_the_budget(budget):
+    body = "Hi Carol,\n" + "\n".join(words(12) for _ in range(3000)) + "\nCan we move the review to Monday?\nAnn"
+    payload = {'mimeType': 'text/plain', 'headers': [], 'body': {
+        'data': base64.urlsafe_b64encode(body.encode()).decode().rstrip("=")}}
+    fitted, _, _ = budget.fit("reply", build_messages, extract_body(payload))
+
+    assert fitted.startswith("Hi Carol,")
+    assert fitted.endswith("Can we move the review to Monday?\nAnn")
@@ -0,0 +1,123 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+import triage
+from benchmarks.run import REPO_ROOT
+from triage import HashedNaiveBayes, check_headers, estimate_priority, get_triage_stats, triage_email
+
+BULK = ["Huge spring sale, 30% off everything, shop now and save", "Your weekly newsletter: top deals and offers",
+        "Limited time offer: free shipping on all orders", "Flash sale ends tonight, unsubscribe any time"] * 3
+PERSONAL = ["Can we move our meeting to Thursday afternoon?", "Could you send me the Atlas budget before Friday?",
+            "Thanks for the notes, I have a question about the contract", "Are you free for lunch next week?"] * 3
+
+def make_email(sender="Ann Keller <ann@example.org>", subject="Lunch?", label_ids=("INBOX",), **headers):
+    return {'sender': sender, 'subject': subject, 'label_ids': list(label_ids),
+            'headers': {name.lower().replace("_", "-"): value for name, value in headers.items()},
+            'content_for_llm': f"Subject: {subject}\nFrom: {sender}\n\nAre you free for lunch on Friday?"}
+
+@pytest.fixture(autouse=True)
+def fresh_stats(monkeypatch):
+    monkeypatch.setattr(triage, "_triage_stats", {"checked": 0, "settled": 0, "reasons": {}})
+
+# --- Header rules ---
+
+@pytest.mark.parametrize("email, reason", [
+    (make_email(label_ids=["INBOX", "CATEGORY_PROMOTIONS"]), "label:CATEGORY_PROMOTIONS"),
+    (make_email(label_ids=["SPAM"]), "label:SPAM"),
+    (make_email(List_Unsubscribe="<mailto:leave@list.example>"), "header:List-Unsubscribe"),
+    (make_email(Precedence=" Bulk "), "header:Precedence"),
+    (make_email(Precedence="list"), "header:Precedence"),
+    (make_email(Auto_Submitted="auto-replied"), "header:Auto-Submitted"),
+    (make_email(sender="Shop <no-reply@shop.example>"), "sender:no-reply"),
+    (make_email(sender="donotreply@bank.example"), "sender:no-reply"),
+    (make_email(sender="MAILER-DAEMON@mx.example"), "sender:no-reply"),
+])
+def test_bulk_and_automated_mail_is_recognized(email, reason):
+    assert check_headers(email) == reason
+
+@pytest.mark.parametrize("email", [
+    make_email(),
+    make_email(Auto_Submitted="no"),
+    make_email(Precedence="first-class"),
+    make_email(label_ids=["INBOX", "IMPORTANT", "CATEGORY_PERSONAL"]),
+    # "reply" alone is not a no-reply sender
+    make_email(sender="Replyteam Lead <lead@replyteam.example>"),
+])
+def test_personal_mail_is_left_to_the_llm(email):
+    assert check_headers(email) is None
+    assert triage_email(email) is None
+
+def test_triage_settles_bulk_mail_as_spam_and_counts_it():
+    assert triage_email(make_email(Precedence="bulk")) == {"intent": "spam", "priority": "low",
+                                                            "triage": "header:Precedence"}
+    triage_email(make_email())
+    assert get_triage_stats() == {"checked": 2, "settled": 1, "reasons": {"header:Precedence": 1},
+                                  "llm_calls_avoided": 0.5}
+
+@pytest.mark.parametrize("email, priority", [
+    (make_email(List_Unsubscribe="<https://list.example>"), "low"),
+    (make_email(label_ids=["INBOX", "IMPORTANT"]), "high"),
+    (make_email(subject="URGENT: contract"), "high"),
+    (make_email(subject="Action required by EOD"), "high"),
+    (make_email(subject="Lunch?"), "medium"),
+])
+def test_priority_from_headers(email, priority):
+    assert estimate_priority(email) == priority
+
+# --- The local classifier ---
+
+def trained_model():
+    model = HashedNaiveBayes()
+    model.train([(text, "bulk") for text in BULK] + [(text, "personal") for text in PERSONAL])
+    return model
+
+def test_naive_bayes_tells_bulk_from_personal_mail():
+    model = trained_model()
+    bulk = model.predict_proba("Big sale: 50% off all shoes, shop now")
+    personal = model.predict_proba("Could we meet on Thursday about the budget?")
+
+    assert bulk["bulk"] > 0.9
+    assert personal["personal"] > 0.9
+    assert sum(bulk.values()) == pytest.approx(1.0)
+    assert HashedNaiveBayes().predict_proba("anything") == {}
+
+def test_a_saved_model_predicts_the_same(workdir):
+    model = trained_model()
+    model.save("model.json")
+    loaded = HashedNaiveBayes.load("model.json")
+    text = "Weekly deals and offers, free shipping"
+    assert loaded.predict_proba(text) == pytest.approx(model.predict_proba(text))
+
+def test_the_model_only_settles_mail_it_is_sure_about(workdir, monkeypatch):
+    trained_model().save("triage_model.json")
+    monkeypatch.setattr(triage, "TRIAGE_MODEL_FILE", "triage_model.json")
+    sale = make_email(subject="Spring sale")
+    sale['content_for_llm'] = "Huge spring sale, 30% off everything, shop now and save. Free shipping on all orders."
+
+    assert triage_email(sale)["triage"] == "model"
+    assert triage_email(make_email()) is None
+    monkeypatch.setattr(triage, "TRIAGE_MODEL_THRESHOLD", 1.01)
+    assert triage_email(sale) is None
+
+def test_a_broken_model_file_is_ignored(workdir, monkeypatch):
+    with open("triage_model.json", "w") as f:
+        f.write("{not json")
+    monkeypatch.setattr(triage, "TRIAGE_MODEL_FILE", "triage_model.json")
+    assert triage.get_triage_model() is None
+    assert triage_email(make_email()) is None
+
+def test_train_command_writes_the_model(workdir):
+    with open("labelled.jsonl", "w") as f:
+        for text in BULK:
+            f.write(json.dumps({"text": text, "label": "bulk"}) + "\n")
+        for text in PERSONAL:
+            f.write(json.dumps({"text": text, "label": "personal"}) + "\n")
+    completed = subprocess.run([sys.executable, f"{REPO_ROOT}/triage.py", "train", "labelled.jsonl"], cwd=workdir,
+                               capture_output=True, text=True, timeout=60)
+
+    assert completed.returncode == 0, completed.stderr
+    assert "Trained triage model on 24 email(s)" in completed.stdout
+    assert HashedNaiveBayes.load(str(workdir / "triage_model.json")).doc_counts == {"bulk": 12, "personal": 12}
@@ -0,0 +1,60 @@
+import time
+
+from work_queue import STAGES, WorkQueue
+
+def test_messages_move_through_the_stages():
+    queue = WorkQueue("work_queue.sqlite3")
+    queue.enqueue(["m1", "m2"])
+    assert queue.ready_ids() == ["m1", "m2"]
+
+    queue.advance("m1", "drafted", analysis={"classification": {"intent": "other"}, "reply_body": "Hi"})
+    queue.advance(["m1", "m2"], "labeled")
+    assert queue.ready_ids() == []
+    assert queue.stats()["stages"] == dict.fromkeys(STAGES, 0) | {"labeled": 2}
+
+def test_messages_never_move_backwards():
+    queue = WorkQueue("work_queue.sqlite3")
+    queue.advance("m1", "sent")
+    queue.advance("m1", "fetched")
+    queue.enqueue(["m1"])
+    assert queue.ids_in_stage(["m1"], "sent") == ["m1"]
+
+def test_analysis_is_kept_across_stages_and_restarts():
+    analysis = {"classification": {"intent": "meeting_request", "priority": "high"}, "reply_body": "Tuesday works."}
+    queue = WorkQueue("work_queue.sqlite3")
+    queue.advance("m1", "drafted", analysis=analysis)
+    queue.advance("m1", "sent", outcome="Reply sent")
+
+    reopened = WorkQueue("work_queue.sqlite3")
+    assert reopened.get_analysis("m1") == analysis
+    assert reopened.get_analysis("unknown") is None
+    assert reopened.ids_in_stage(["m1", "m2"], "sent") == ["m1"]
+
+def test_failures_are_retried_later_and_given_up_eventually():
+    queue = WorkQueue("work_queue.sqlite3", max_attempts=3)
+    queue.enqueue(["m1", "m2"])
+    queue.fail("m1", "Ollama is down")
+    assert queue.ready_ids() == ["m2"]
+    assert queue.stats()["retrying"] == 1
+
+    for _ in range(2):
+        queue.fail("m1", "Ollama is down")
+    assert queue.stats()["given_up"] == 1
+    assert queue.stats()["retrying"] == 0
+
+def test_success_resets_the_retry_counter():
+    queue = WorkQueue("work_queue.sqlite3")
+    queue.enqueue(["m1"])
+    queue.fail("m1", "timeout")
+    queue.advance("m1", "fetched")
+    assert queue.ready_ids() == ["m1"]
+    assert queue.stats()["retrying"] == 0
+
+def test_prune_forgets_only_old_labeled_messages():
+    queue = WorkQueue("work_queue.sqlite3")
+    queue.enqueue(["m1", "m2"])
+    queue.advance("m1", "labeled")
+    time.sleep(0.01)
+    queue.prune(retention_days=0)
+    assert queue.stats()["stages"]["labeled"] == 0
+    assert queue.ready_ids() == ["m2"]
@@ -0,0 +1,177 @@
+import datetime
+import html
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from gmail_service import batch_get_threads
+from mime_parser import get_part_header
+
+# Where summaries of the messages seen so far are kept, by message and thread
+THREAD_STORE_FILE = os.environ.get("THREAD_STORE_FILE", "thread_store.sqlite3")
+# A reply is given at most this many earlier messages of its thread...
+THREAD_HISTORY_MESSAGES = int(os.environ.get("THREAD_HISTORY_MESSAGES", "4"))
+# ...each squeezed to about this many characters, so the history stays small next to the email itself
+THREAD_SUMMARY_CHARS = 300
+# Messages are forgotten this many days after they were stored
+THREAD_RETENTION_DAYS = 90
+
+MESSAGE_ID = re.compile(r"<[^<>\s]+>")
+
+def summarize(text, max_chars=THREAD_SUMMARY_CHARS):
+    """Squeezes a message body onto one line of about max_chars characters."""
+    text = " ".join(text.split())
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(" ", 0, max_chars)
+    return text[:cut if cut > max_chars // 2 else max_chars] + "..."
+
+def referenced_ids(email):
+    """The Message-IDs an email replies to, from its References and In-Reply-To headers."""
+    headers = email['headers']
+    return set(MESSAGE_ID.findall(headers.get('references', '') + " " + headers.get('in-reply-to', '')))
+
+class ThreadStore:
+    """
+    Summaries of the messages of every thread seen so far, kept in SQLite.
+
+    Emails are recorded as they are parsed and replies as they are sent, so the
+    history of a conversation is usually known without asking Gmail. Only when
+    an email refers to messages the store has never seen are the threads
+    fetched, all in one batch of threads().get calls in metadata format, whose
+    snippets serve as the summaries of those messages.
+    """
+
+    def __init__(self, path=THREAD_STORE_FILE):
+        self.path = path
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " msg_id TEXT PRIMARY KEY, thread_id TEXT NOT NULL, message_id_header TEXT, internal_date INTEGER NOT NULL,"
+            " sender TEXT, summary TEXT, stored_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS messages_thread ON messages (thread_id, internal_date)")
+        # A sent reply is stored under its Message-ID until Gmail's copy of it turns up; this keeps only one of them
+        self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS messages_message_id ON messages (message_id_header)")
+        # Messages that are referenced but that Gmail does not have either (e.g. sent to a list we are not on)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS missing (message_id_header TEXT PRIMARY KEY, thread_id TEXT, stored_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def _add(self, rows):
+        now = time.time()
+        with self._lock:
+            # Summaries of our own parsing are better than snippets, so existing rows are kept
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO messages (msg_id, thread_id, message_id_header, internal_date, sender, summary, stored_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [row + (now,) for row in rows]
+            )
+            self._conn.commit()
+
+    def record_emails(self, emails):
+        """Stores parsed emails (from main.parse_email)."""
+        self._add([
+            (email['id'], email['thread_id'], email['message_id_header'] or None, email.get('internal_date', 0),
+             email['sender'], summarize(email['body']))
+            for email in emails if email.get('thread_id')
+        ])
+
+    def record_reply(self, email, message_id_header, reply_body):
+        """Stores the reply sent to an email, so the next message in its thread finds it."""
+        if email.get('thread_id'):
+            self._add([(message_id_header, email['thread_id'], message_id_header, int(time.time() * 1000),
+                        "Me", summarize(reply_body))])
+
+    def record_thread(self, thread):
+        """Stores the messages of a thread resource fetched in metadata format."""
+        self._add([
+            (message['id'], message.get('threadId', thread['id']),
+             get_part_header(message.get('payload', {}), 'message-id') or None, int(message.get('internalDate', 0)),
+             get_part_header(message.get('payload', {}), 'from'), summarize(html.unescape(message.get('snippet', ''))))
+            for message in thread.get('messages', [])
+        ])
+
+    def unknown_references(self, email):
+        """The Message-IDs an email refers to that the store knows nothing about."""
+        references = referenced_ids(email)
+        if not references:
+            return set()
+        with self._lock:
+            known = {row[0] for row in self._conn.execute(
+                "SELECT message_id_header FROM messages WHERE thread_id = ?", (email['thread_id'],))}
+            known |= {row[0] for row in self._conn.execute(
+                "SELECT message_id_header FROM missing WHERE thread_id = ?", (email['thread_id'],))}
+        return references - known
+
+    def fill_gaps(self, service, emails, user_id='me'):
+        """
+        Records emails and sets email['thread_history'] on each of them (None if there is none).
+        Threads with messages the store has not seen are fetched first, in one batch request.
+        """
+        emails = [email for email in emails if email.get('thread_id')]
+        self.record_emails(emails)
+        gaps = {}
+        for email in emails:
+            unknown = self.unknown_references(email)
+            if unknown:
+                gaps.setdefault(email['thread_id'], set()).update(unknown)
+        if gaps:
+            self.requests += len(gaps)
+            threads, _ = batch_get_threads(service, user_id, list(gaps))
+            for thread in threads.values():
+                self.record_thread(thread)
+            # Whatever is still unknown is not in the mailbox; remember that, so it is not fetched again
+            now = time.time()
+            with self._lock:
+                for thread_id in threads:
+                    known = {row[0] for row in self._conn.execute(
+                        "SELECT message_id_header FROM messages WHERE thread_id = ?", (thread_id,))}
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO missing (message_id_header, thread_id, stored_at) VALUES (?, ?, ?)",
+                        [(message_id, thread_id, now) for message_id in gaps[thread_id] - known]
+                    )
+                self._conn.commit()
+        for email in emails:
+            email['thread_history'] = self.history(email)
+
+    def history(self, email, max_messages=THREAD_HISTORY_MESSAGES):
+        """A compact summary of the messages before email in its thread, oldest first, or None."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT internal_date, sender, summary FROM messages"
+                " WHERE thread_id = ? AND msg_id != ? AND internal_date <= ? ORDER BY internal_date DESC LIMIT ?",
+                (email['thread_id'], email['id'], email.get('internal_date') or int(time.time() * 1000), max_messages)
+            ).fetchall()
+        if not rows:
+            return None
+        lines = [
+            f"- {datetime.datetime.fromtimestamp(internal_date / 1000).strftime('%d %b %H:%M')}, {sender}: {summary}"
+            for internal_date, sender, summary in reversed(rows) if summary
+        ]
+        return "Earlier messages in this conversation (oldest first):\n" + "\n".join(lines) if lines else None
+
+    def prune(self, retention_days=THREAD_RETENTION_DAYS):
+        """Forgets messages stored more than retention_days ago."""
+        cutoff = time.time() - retention_days * 24 * 3600
+        with self._lock:
+            self._conn.execute("DELETE FROM messages WHERE stored_at < ?", (cutoff,))
+            self._conn.execute("DELETE FROM missing WHERE stored_at < ?", (cutoff,))
+            self._conn.commit()
+
+# The store is opened on first use, so importing this module does not create the file
+_store = None
+_store_lock = threading.Lock()
+
+def get_thread_store():
+    """Returns the shared ThreadStore."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ThreadStore()
+        return _store
@@ -0,0 +1,160 @@
+import math
+import os
+import threading
+
+# Tokens a chat template adds around every message (role markers and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+# The starting estimate of characters per token, refined from the prompt sizes Ollama reports
+DEFAULT_CHARS_PER_TOKEN = 4.0
+# Classification only needs the gist of an email, so it gets a small prompt and a fast prefill
+CLASSIFY_TOKEN_BUDGET = int(os.environ.get("CLASSIFY_TOKEN_BUDGET", "1024"))
+# Estimates are a little off until they are calibrated, so only this share of a budget is planned for
+SAFETY_MARGIN = 0.9
+# When the email and the context do not both fit, the email keeps at least this share of the budget
+EMAIL_SHARE = 0.5
+# Of a truncated email, this share is taken from the start; the rest from the end (sign-off, the actual question)
+HEAD_SHARE = 2 / 3
+
+def context_items(context):
+    """Turns context (None, a string, or a list of strings, most relevant first) into a list."""
+    if not context:
+        return []
+    if isinstance(context, str):
+        return [context]
+    return [item for item in context if item]
+
+def join_context(items):
+    """Formats context items for the prompt, or None if there are none."""
+    return "\n\n".join(items) or None
+
+def estimate_tokens(text, chars_per_token=DEFAULT_CHARS_PER_TOKEN):
+    """
+    Estimates the number of tokens in a text from its length. The model's tokenizer is
+    not available to the client, so this is an estimate, not a count.
+    """
+    return math.ceil(len(text) / chars_per_token) if text else 0
+
+def truncate_head_tail(text, max_tokens, chars_per_token=DEFAULT_CHARS_PER_TOKEN):
+    """Cuts text to about max_tokens tokens, keeping its start and its end."""
+    max_chars = int(max_tokens * chars_per_token)
+    if len(text) <= max_chars:
+        return text
+    marker = "\n[...]\n"
+    keep = max(max_chars - len(marker), 0)
+    head = text[:int(keep * HEAD_SHARE)]
+    tail = text[len(text) - (keep - len(head)):] if keep > len(head) else ""
+    # Do not cut words in half
+    head = head[:head.rfind(" ")] if " " in head[-40:] else head
+    tail = tail[tail.find(" ") + 1:] if " " in tail[:40] else tail
+    return head + marker + tail
+
+class TokenBudget:
+    """
+    Fits prompts into per-stage token budgets.
+
+    Tokens are estimated from the length of the text, not counted with the model's
+    tokenizer, with a characters-per-token ratio calibrated against the prompt_eval_count Ollama reports for every call.
+    Emails that are too long keep their start and end; context items are dropped
+    least relevant first. The prompt tokens used per stage are collected for stats.
+    """
+
+    def __init__(self, num_ctx, num_predict, classify_predict, classify_budget=CLASSIFY_TOKEN_BUDGET):
+        # Generation gets whatever of the context window the reply itself does not need
+        self.budgets = {
+            "classify": min(classify_budget, num_ctx - classify_predict),
+            "reply": num_ctx - num_predict,
+            "classify_and_reply": num_ctx - num_predict,
+        }
+        self.chars_per_token = DEFAULT_CHARS_PER_TOKEN
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def count(self, text):
+        """Estimates the number of tokens in a text."""
+        return estimate_tokens(text, self.chars_per_token)
+
+    def count_messages(self, messages):
+        """Estimates the number of prompt tokens of a list of chat messages."""
+        return sum(self.count(message['content']) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+    def truncate_head_tail(self, text, max_tokens):
+        """Cuts text to about max_tokens tokens, keeping its start and its end."""
+        return truncate_head_tail(text, max_tokens, self.chars_per_token)
+
+    def fit(self, stage, build_messages, email_content, context=None):
+        """
+        Fits an email and its context into the budget of a stage.
+
+        build_messages(email_content, context) builds the chat messages; it is
+        called with empty content to measure the fixed part of the prompt.
+        Returns (email_content, context, messages) with context joined into a
+        string (or None), and records what had to be cut.
+        """
+        budget = self.budgets[stage]
+        items = context_items(context)
+        available = int(budget * SAFETY_MARGIN) - self.count_messages(build_messages("", None))
+        email_tokens = self.count(email_content)
+        item_tokens = [self.count(item) for item in items]
+
+        truncated = dropped = 0
+        if email_tokens + sum(item_tokens) > available:
+            # The email gets its share, or more if the context leaves room for it
+            email_limit = max(int(available * EMAIL_SHARE), available - sum(item_tokens)) if items else available
+            if email_tokens > email_limit:
+                email_content = self.truncate_head_tail(email_content, email_limit)
+                email_tokens = self.count(email_content)
+                truncated = 1
+            # Drop the least relevant context until the rest fits
+            while items and email_tokens + sum(item_tokens) > available:
+                if len(items) == 1:
+                    items[0] = self.truncate_head_tail(items[0], max(available - email_tokens, 0))
+                    item_tokens[0] = self.count(items[0])
+                    break
+                items.pop()
+                item_tokens.pop()
+                dropped += 1
+
+        context = join_context(items)
+        messages = build_messages(email_content, context)
+        with self._lock:
+            stats = self._stats.setdefault(stage, {
+                "calls": 0, "budget": budget, "estimated_tokens": 0, "prompt_tokens": 0,
+                "measured_calls": 0, "emails_truncated": 0, "context_dropped": 0,
+            })
+            stats["calls"] += 1
+            stats["estimated_tokens"] += self.count_messages(messages)
+            stats["emails_truncated"] += truncated
+            stats["context_dropped"] += dropped
+        return email_content, context, messages
+
+    def record(self, stage, messages, response):
+        """Records the real prompt size of a call and refines the characters-per-token estimate."""
+        prompt_tokens = (response.get('prompt_eval_count') or 0) if response else 0
+        if not prompt_tokens:
+            return
+        with self._lock:
+            stats = self._stats.get(stage)
+            if stats is not None:
+                stats["prompt_tokens"] += prompt_tokens
+                stats["measured_calls"] += 1
+            estimated = self.count_messages(messages)
+            # Ollama does not count a prompt prefix it had cached, so much smaller counts are not used
+            if prompt_tokens < estimated / 2:
+                return
+            content_tokens = prompt_tokens - MESSAGE_OVERHEAD_TOKENS * len(messages)
+            chars = sum(len(message['content']) for message in messages)
+            if content_tokens > 0:
+                observed = min(max(chars / content_tokens, 1.5), 8.0)
+                self.chars_per_token = 0.8 * self.chars_per_token + 0.2 * observed
+
+    def stats(self):
+        """Returns the budget and the average prompt tokens per call of every stage."""
+        with self._lock:
+            report = {"chars_per_token": self.chars_per_token}
+            for stage, stats in self._stats.items():
+                report[stage] = dict(stats)
+                report[stage]["estimated_tokens_per_call"] = stats["estimated_tokens"] / stats["calls"]
+                report[stage]["prompt_tokens_per_call"] = (
+                    stats["prompt_tokens"] / stats["measured_calls"] if stats["measured_calls"] else 0.0
+                )
+            return report
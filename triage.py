@@ -0,0 +1,192 @@
+import json
+import math
+import os
+import re
+import sys
+import threading
+import zlib
+
+from metrics import get_logger
+
+logger = get_logger(__name__)
+
+# --- Header rules ---
+# Gmail labels that mean the email is bulk mail nobody expects a reply to
+BULK_LABELS = {"SPAM", "CATEGORY_PROMOTIONS", "CATEGORY_SOCIAL"}
+# Values of the Precedence header used by mailing lists and bulk senders
+BULK_PRECEDENCE = {"bulk", "junk", "list"}
+NO_REPLY_SENDER = re.compile(r"\b(no[-_.]?reply|do[-_.]?not[-_.]?reply|mailer-daemon)\b", re.IGNORECASE)
+# Subjects that ask for a quick answer; together with Gmail's IMPORTANT label they make an email high priority
+URGENT_SUBJECT = re.compile(r"\b(urgent|asap|immediately|emergency|time[- ]sensitive|action required|today|eod)\b", re.IGNORECASE)
+
+# --- Optional local classifier ---
+# A naive Bayes model over hashed word features, trained with `python triage.py train <file>`
+TRIAGE_MODEL_FILE = os.environ.get("TRIAGE_MODEL_FILE", "triage_model.json")
+# Only settle an email without the LLM when the model is at least this sure it is bulk mail
+TRIAGE_MODEL_THRESHOLD = float(os.environ.get("TRIAGE_MODEL_THRESHOLD", "0.98"))
+HASHED_FEATURES = 2 ** 18
+
+# How many emails were checked and how many were settled without the LLM, by reason
+_triage_stats = {"checked": 0, "settled": 0, "reasons": {}}
+_triage_stats_lock = threading.Lock()
+
+def tokenize(text):
+    """Splits text into lowercase word tokens."""
+    return re.findall(r"[a-z0-9']+", text.lower())
+
+def hash_features(text):
+    """Counts the hashed word features of a text. crc32 is used because it is stable between runs."""
+    features = {}
+    for token in tokenize(text):
+        index = zlib.crc32(token.encode("utf-8")) % HASHED_FEATURES
+        features[index] = features.get(index, 0) + 1
+    return features
+
+class HashedNaiveBayes:
+    """A small multinomial naive Bayes classifier over hashed word features."""
+
+    def __init__(self, doc_counts=None, feature_counts=None, feature_totals=None):
+        self.doc_counts = doc_counts or {}
+        self.feature_counts = feature_counts or {}
+        self.feature_totals = feature_totals or {}
+
+    def train(self, examples):
+        """Trains on (text, label) pairs."""
+        for text, label in examples:
+            self.doc_counts[label] = self.doc_counts.get(label, 0) + 1
+            counts = self.feature_counts.setdefault(label, {})
+            for index, count in hash_features(text).items():
+                counts[index] = counts.get(index, 0) + count
+                self.feature_totals[label] = self.feature_totals.get(label, 0) + count
+
+    def predict_proba(self, text):
+        """Returns the probability of each label for a text."""
+        features = hash_features(text)
+        total_docs = sum(self.doc_counts.values())
+        log_probs = {}
+        for label, doc_count in self.doc_counts.items():
+            counts = self.feature_counts.get(label, {})
+            # Laplace smoothing over the hashed feature space
+            denominator = self.feature_totals.get(label, 0) + HASHED_FEATURES
+            log_prob = math.log(doc_count / total_docs)
+            for index, count in features.items():
+                log_prob += count * math.log((counts.get(index, 0) + 1) / denominator)
+            log_probs[label] = log_prob
+        if not log_probs:
+            return {}
+        highest = max(log_probs.values())
+        exps = {label: math.exp(value - highest) for label, value in log_probs.items()}
+        total = sum(exps.values())
+        return {label: value / total for label, value in exps.items()}
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({
+                "doc_counts": self.doc_counts,
+                "feature_counts": self.feature_counts,
+                "feature_totals": self.feature_totals,
+            }, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            data = json.load(f)
+        # JSON object keys are strings, the feature indexes are ints
+        feature_counts = {
+            label: {int(index): count for index, count in counts.items()}
+            for label, counts in data["feature_counts"].items()
+        }
+        return cls(data["doc_counts"], feature_counts, data["feature_totals"])
+
+_model = None
+_model_loaded = False
+
+def get_triage_model():
+    """Returns the trained triage model, or None if none has been trained."""
+    global _model, _model_loaded
+    if not _model_loaded:
+        _model_loaded = True
+        if os.path.exists(TRIAGE_MODEL_FILE):
+            try:
+                _model = HashedNaiveBayes.load(TRIAGE_MODEL_FILE)
+            except (OSError, ValueError, KeyError) as error:
+                logger.warning("Could not load the triage model", extra={"file": TRIAGE_MODEL_FILE, "error": str(error)})
+    return _model
+
+def check_headers(email):
+    """Returns the reason the headers mark the email as bulk or automated, or None."""
+    headers = email['headers']
+    bulk_labels = BULK_LABELS.intersection(email['label_ids'])
+    if bulk_labels:
+        return f"label:{sorted(bulk_labels)[0]}"
+    if 'list-unsubscribe' in headers:
+        return "header:List-Unsubscribe"
+    if headers.get('precedence', '').strip().lower() in BULK_PRECEDENCE:
+        return "header:Precedence"
+    # Never answer auto-replies and other automatic mail, it can start a mail loop
+    if headers.get('auto-submitted', 'no').strip().lower() != 'no':
+        return "header:Auto-Submitted"
+    if NO_REPLY_SENDER.search(email['sender']):
+        return "sender:no-reply"
+    return None
+
+def triage_email(email):
+    """
+    Settles obvious bulk and automated mail before it reaches the LLM.
+
+    Returns a classification like the LLM's ({"intent": "spam", ...}) with the
+    reason in "triage", or None if the email needs the LLM.
+    """
+    reason = check_headers(email)
+    if reason is None:
+        model = get_triage_model()
+        if model is not None:
+            bulk_probability = model.predict_proba(email['content_for_llm']).get("bulk", 0.0)
+            if bulk_probability >= TRIAGE_MODEL_THRESHOLD:
+                reason = "model"
+
+    with _triage_stats_lock:
+        _triage_stats["checked"] += 1
+        if reason is not None:
+            _triage_stats["settled"] += 1
+            _triage_stats["reasons"][reason] = _triage_stats["reasons"].get(reason, 0) + 1
+
+    if reason is None:
+        return None
+    return {"intent": "spam", "priority": "low", "triage": reason}
+
+def estimate_priority(email):
+    """
+    Guesses the priority of an email from its headers alone, before the LLM has seen it:
+    'low' for bulk and automated mail, 'high' for important or urgent-sounding mail, else 'medium'.
+    """
+    if check_headers(email) is not None:
+        return "low"
+    if "IMPORTANT" in email['label_ids'] or URGENT_SUBJECT.search(email['subject']):
+        return "high"
+    return "medium"
+
+def get_triage_stats():
+    """Returns how many emails were triaged and the fraction of LLM calls that were avoided."""
+    with _triage_stats_lock:
+        stats = {
+            "checked": _triage_stats["checked"],
+            "settled": _triage_stats["settled"],
+            "reasons": dict(_triage_stats["reasons"]),
+        }
+    stats["llm_calls_avoided"] = stats["settled"] / stats["checked"] if stats["checked"] else 0.0
+    return stats
+
+
+if __name__ == "__main__":
+    # Train the model from a JSON Lines file with one {"text": ..., "label": "bulk" or "personal"} per line
+    if len(sys.argv) != 3 or sys.argv[1] != "train":
+        print("Usage: python triage.py train <labelled_emails.jsonl>")
+        sys.exit(1)
+
+    with open(sys.argv[2], "r") as f:
+        examples = [(row["text"], row["label"]) for row in map(json.loads, f) if row.get("text")]
+    model = HashedNaiveBayes()
+    model.train(examples)
+    model.save(TRIAGE_MODEL_FILE)
+    print(f"Trained triage model on {len(examples)} email(s) and saved it to {TRIAGE_MODEL_FILE}.")
@@ -0,0 +1,155 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from metrics import get_logger
+
+logger = get_logger(__name__)
+
+# Where the processing state of every message is kept
+WORK_QUEUE_FILE = os.environ.get("WORK_QUEUE_FILE", "work_queue.sqlite3")
+# After this many failed attempts a message is left alone until it is retried by hand
+WORK_MAX_ATTEMPTS = int(os.environ.get("WORK_MAX_ATTEMPTS", "8"))
+# Labeled messages are forgotten after this many days
+WORK_RETENTION_DAYS = 30
+
+# The stages a message goes through, in order
+STAGES = ["queued", "fetched", "classified", "drafted", "sent", "labeled"]
+# The first retry delay (in seconds) for a message stuck in each stage; it doubles with every failure.
+# Failing to fetch or label is usually a short Gmail hiccup, failing in the LLM stages an Ollama restart.
+RETRY_BACKOFF = {"queued": 30, "fetched": 60, "classified": 60, "drafted": 120, "sent": 30}
+MAX_RETRY_BACKOFF = 3600
+
+class WorkQueue:
+    """
+    A durable record of where every message is in processing, kept in SQLite.
+
+    Every stage a message reaches is committed right away, together with the
+    LLM analysis once it exists, so after a crash or restart the work continues
+    where it stopped and finished LLM calls are not repeated. Failures are
+    retried with exponential backoff per stage.
+    """
+
+    def __init__(self, path=WORK_QUEUE_FILE, max_attempts=WORK_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS work_items ("
+            " msg_id TEXT PRIMARY KEY, stage TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt_at REAL NOT NULL DEFAULT 0, last_error TEXT, analysis TEXT, outcome TEXT,"
+            " created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS work_items_stage ON work_items (stage, next_attempt_at)")
+        self._conn.commit()
+
+    def enqueue(self, msg_ids):
+        """Adds messages to the queue. Messages it already knows keep their state."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO work_items (msg_id, stage, created_at, updated_at) VALUES (?, 'queued', ?, ?)",
+                [(msg_id, now, now) for msg_id in msg_ids]
+            )
+            self._conn.commit()
+
+    def ready_ids(self):
+        """Returns the unfinished messages that are due, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT msg_id FROM work_items WHERE stage != 'labeled' AND next_attempt_at <= ? AND attempts < ?"
+                " ORDER BY created_at",
+                (time.time(), self.max_attempts)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def ids_in_stage(self, msg_ids, stage):
+        """Returns the ones of msg_ids that are in the given stage."""
+        with self._lock:
+            in_stage = {row[0] for row in self._conn.execute("SELECT msg_id FROM work_items WHERE stage = ?", (stage,))}
+        return [msg_id for msg_id in msg_ids if msg_id in in_stage]
+
+    def get_analysis(self, msg_id):
+        """Returns the stored LLM analysis of a message, or None if it has not been analyzed yet."""
+        with self._lock:
+            row = self._conn.execute("SELECT analysis FROM work_items WHERE msg_id = ?", (msg_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def advance(self, msg_ids, stage, analysis=None, outcome=None):
+        """Moves messages to a stage and resets their retry counter. Messages never move backwards."""
+        if isinstance(msg_ids, str):
+            msg_ids = [msg_ids]
+        now = time.time()
+        with self._lock:
+            for msg_id in msg_ids:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO work_items (msg_id, stage, created_at, updated_at) VALUES (?, 'queued', ?, ?)",
+                    (msg_id, now, now)
+                )
+                row = self._conn.execute("SELECT stage FROM work_items WHERE msg_id = ?", (msg_id,)).fetchone()
+                if STAGES.index(stage) < STAGES.index(row[0]):
+                    continue
+                self._conn.execute(
+                    "UPDATE work_items SET stage = ?, attempts = 0, next_attempt_at = 0, last_error = NULL,"
+                    " analysis = COALESCE(?, analysis), outcome = COALESCE(?, outcome), updated_at = ? WHERE msg_id = ?",
+                    (stage, json.dumps(analysis) if analysis is not None else None, outcome, now, msg_id)
+                )
+            self._conn.commit()
+
+    def fail(self, msg_id, error):
+        """Records a failed attempt and schedules the next one with exponential backoff and jitter."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT stage, attempts FROM work_items WHERE msg_id = ?", (msg_id,)).fetchone()
+            stage, attempts = row if row else ("queued", 0)
+            attempts += 1
+            delay = min(RETRY_BACKOFF.get(stage, 60) * 2 ** (attempts - 1), MAX_RETRY_BACKOFF)
+            # Jitter, so messages that failed together are not all retried at the same moment
+            delay *= random.uniform(0.5, 1.5)
+            self._conn.execute(
+                "INSERT INTO work_items (msg_id, stage, attempts, next_attempt_at, last_error, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (msg_id) DO UPDATE SET attempts = excluded.attempts,"
+                " next_attempt_at = excluded.next_attempt_at, last_error = excluded.last_error, updated_at = excluded.updated_at",
+                (msg_id, stage, attempts, now + delay, str(error), now, now)
+            )
+            self._conn.commit()
+        if attempts >= self.max_attempts:
+            logger.warning("Giving up on email", extra={"msg_id": msg_id, "attempts": attempts, "error": str(error)})
+
+    def prune(self, retention_days=WORK_RETENTION_DAYS):
+        """Forgets messages that were labeled more than retention_days ago."""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM work_items WHERE stage = 'labeled' AND updated_at < ?",
+                (time.time() - retention_days * 24 * 3600,)
+            )
+            self._conn.commit()
+
+    def stats(self):
+        """Returns the number of messages per stage, waiting for a retry, and given up on."""
+        with self._lock:
+            stages = dict(self._conn.execute("SELECT stage, COUNT(*) FROM work_items GROUP BY stage").fetchall())
+            retrying = self._conn.execute(
+                "SELECT COUNT(*) FROM work_items WHERE stage != 'labeled' AND attempts > 0 AND attempts < ?",
+                (self.max_attempts,)
+            ).fetchone()[0]
+            given_up = self._conn.execute(
+                "SELECT COUNT(*) FROM work_items WHERE stage != 'labeled' AND attempts >= ?", (self.max_attempts,)
+            ).fetchone()[0]
+        return {"stages": {stage: stages.get(stage, 0) for stage in STAGES}, "retrying": retrying, "given_up": given_up}
+
+# The queue is opened on first use, so importing this module does not create the file
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_work_queue():
+    """Returns the shared WorkQueue."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = WorkQueue()
+        return _queue